@@ -0,0 +1,92 @@
+"""
+Benchmark: how much of a clause's synthesis time is G2P, and what the phoneme cache leaves of it.
+
+Every clause is phonemized with Kokoro's own G2P, then run through the model from those phonemes, so
+the two are timed separately. The same clauses are then looked up in a warm `PhonemeCache`, once
+whole and once rebuilt from the word cache alone:
+
+	python benchmarks/bench_g2p_cache.py --model ./data/models/kokoro.pth --voice ./data/voices/af.pt [--rounds 3]
+"""
+import argparse
+import statistics
+import time
+
+from Orca.utils.PhonemeCache import PhonemeCache, PhonemeCacheConfig
+from Orca.utils.TTS import TTSClient, TTSClientConfig
+
+CLAUSES = [
+	"Hi there!",
+	"Okay.",
+	"Sure, I can do that.",
+	"Thanks for asking.",
+	"That sounds like fun!",
+	"I'm not sure about that.",
+	"Give me a second.",
+	"Good morning, everyone.",
+	"What do you think?",
+	"Let me check the weather for you.",
+	"It's going to rain later today.",
+	"I'll remember that for next time."
+]
+
+def timed(run) -> tuple[float, object]:
+	start = time.perf_counter()
+	result = run()
+	return (time.perf_counter() - start) * 1000, result
+
+def summary(name: str, samples: list[float]):
+	print(f"{name:>14}: mean {statistics.mean(samples):7.2f}ms | p50 {statistics.median(samples):7.2f}ms | max {max(samples):7.2f}ms")
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--model", required=True)
+	parser.add_argument("--voice", required=True)
+	parser.add_argument("--rounds", type=int, default=3)
+	args = parser.parse_args()
+
+	tts = TTSClient(TTSClientConfig(model_path=args.model, voice_pack=args.voice, pitch_shift=0.0))
+	pipeline = tts.pipeline
+
+	def g2p(clause: str) -> list[str]:
+		_, tokens = pipeline.g2p(clause)
+		return [phonemes for _, phonemes, _ in pipeline.en_tokenize(tokens) if phonemes]
+
+	def model(chunks: list[str]):
+		for phonemes in chunks:
+			for _ in pipeline.generate_from_tokens(phonemes, args.voice):
+				pass
+
+	# First calls load lexicons and warm the model up
+	model(g2p("Warm up."))
+
+	cold, inference = [], []
+	for _ in range(args.rounds):
+		for clause in CLAUSES:
+			elapsed, chunks = timed(lambda: g2p(clause))
+			cold.append(elapsed)
+			elapsed, _ = timed(lambda: model(chunks))
+			inference.append(elapsed)
+
+	cache = PhonemeCache(PhonemeCacheConfig(enabled=True, min_count=1), pipeline)
+	for clause in CLAUSES:
+		cache.phonemize(clause)
+	clause_hits = [timed(lambda: cache.phonemize(clause))[0] for _ in range(args.rounds) for clause in CLAUSES]
+
+	# New phrasings of known words, only the word cache can answer
+	cache.clauses.clear()
+	word_hits = []
+	for clause in CLAUSES:
+		elapsed, _ = timed(lambda: cache._from_words(clause))
+		word_hits.append(elapsed)
+
+	summary("g2p", cold)
+	summary("model", inference)
+	summary("clause cache", clause_hits)
+	summary("word cache", word_hits)
+	share = statistics.mean(cold) / (statistics.mean(cold) + statistics.mean(inference))
+	print(f"G2P is {share * 100:.0f}% of a clause before caching, {statistics.mean(clause_hits) / statistics.mean(cold) * 100:.2f}% of that remains on a clause hit")
+	answered = sum(cache._from_words(clause) is not None for clause in CLAUSES)
+	print(f"word cache alone answers {answered} of {len(CLAUSES)} clauses")
+
+if __name__ == "__main__":
+	main()
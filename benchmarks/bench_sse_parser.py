@@ -0,0 +1,109 @@
+"""
+Microbenchmark: per-token cost of parsing llama-server's SSE stream.
+
+Compares the original line-based `json.loads` loop from `LLMClient.get_streaming_response`
+against `SSEParser`, over the same bytes split into network-sized chunks.
+
+	python benchmarks/bench_sse_parser.py [--tokens 20000] [--repeat 5]
+"""
+import argparse
+import json
+import random
+import time
+
+from Orca.utils.SSEParser import SSEParser
+
+def build_stream(n_tokens: int) -> bytes:
+	words = ["Hello", " there", ",", " how", " are", " you", " today", "?", " I", "'m", " \"fine\"", "\n"]
+	parts = []
+	for i in range(n_tokens):
+		chunk = {
+			"choices": [{"finish_reason": None, "index": 0, "delta": {"content": words[i % len(words)]}}],
+			"created": 1760000000,
+			"id": "chatcmpl-0123456789abcdef",
+			"model": "Emma",
+			"system_fingerprint": "b6000-abcdef12",
+			"object": "chat.completion.chunk"
+		}
+		parts.append(b"data: " + json.dumps(chunk, separators=(",", ":")).encode() + b"\n\n")
+	final = {
+		"choices": [{"finish_reason": "stop", "index": 0, "delta": {}}],
+		"timings": {"prompt_n": 12, "cache_n": 2048, "predicted_n": n_tokens, "prompt_per_second": 4000.0, "predicted_per_second": 90.0}
+	}
+	parts.append(b"data: " + json.dumps(final, separators=(",", ":")).encode() + b"\n\n")
+	parts.append(b"data: [DONE]\n\n")
+	return b"".join(parts)
+
+def split_chunks(stream: bytes, seed: int = 0) -> list[bytes]:
+	# Mimic what the socket hands over: arbitrary sizes that cut through lines and UTF-8 sequences
+	rng = random.Random(seed)
+	chunks = []
+	i = 0
+	while i < len(stream):
+		n = rng.randint(64, 1024)
+		chunks.append(stream[i:i + n])
+		i += n
+	return chunks
+
+def iter_lines(chunks):
+	pending = b""
+	for chunk in chunks:
+		pending += chunk
+		lines = pending.split(b"\n")
+		pending = lines.pop()
+		yield from lines
+	if pending:
+		yield pending
+
+def legacy(chunks) -> list[str]:
+	out = []
+	for line in iter_lines(chunks):
+		line = line.strip()
+		if not line:
+			continue
+		if line == b"data: [DONE]" or line == b"[DONE]":
+			break
+		line = line.removeprefix(b"data:").lstrip()
+		line = line.decode("utf-8", errors="ignore").strip()
+		try:
+			chunk = json.loads(line)
+			out.append(chunk.get("choices", [{}])[0].get("delta", {}).get("content", ""))
+		except Exception:
+			continue
+	return [token for token in out if token]
+
+def current(chunks) -> list[str]:
+	out = []
+	parser = SSEParser()
+	for chunk in chunks:
+		for event in parser.feed(chunk):
+			if event.done:
+				return out
+			if event.content:
+				out.append(event.content)
+	return out
+
+def bench(name, fn, chunks, n_tokens, repeat):
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn(chunks)
+		best = min(best, time.perf_counter() - start)
+	print(f"{name:>8}: {best * 1000:8.2f}ms total | {best / n_tokens * 1e6:6.2f}us/token")
+	return best
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--tokens", type=int, default=20000)
+	parser.add_argument("--repeat", type=int, default=5)
+	args = parser.parse_args()
+
+	chunks = split_chunks(build_stream(args.tokens))
+	assert legacy(chunks) == current(chunks), "parsers disagree"
+
+	old = bench("legacy", legacy, chunks, args.tokens, args.repeat)
+	new = bench("SSEParser", current, chunks, args.tokens, args.repeat)
+	print(f"speedup: {old / new:.2f}x")
+
+if __name__ == "__main__":
+	main()
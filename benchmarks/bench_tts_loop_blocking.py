@@ -0,0 +1,115 @@
+"""
+Benchmark: how long the event loop stalls while a reply is synthesized.
+
+Compares the original `run_in_executor(None, tts.text_to_audio, text)` pattern, which only builds the
+generator off the loop and then runs every clause on it, against `StreamingTTSWorker`. A ticker task
+measures how late it wakes up while the audio is produced.
+
+The default synthesizer stands in for Kokoro with numpy work plus `trim_and_pad`'s windowed RMS.
+It only needs numpy, Kokoro and torch are imported just for `--model`. Pass a real model to measure Kokoro itself:
+
+	python benchmarks/bench_tts_loop_blocking.py [--clauses 8] [--clause-ms 60]
+	python benchmarks/bench_tts_loop_blocking.py --model ./data/models/kokoro.pth --voice ./data/voices/af.pt
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from Orca.utils.StreamOutputHandler import audio_to_base64, encode_audio, float32_to_pcm16
+from Orca.utils.StreamingTTSWorker import StreamingTTSWorker
+
+class FakeTTS:
+	""" Roughly Kokoro's shape: heavy numeric work per clause, then a Python level pass over the audio """
+	sample_rate = 24000
+
+	def __init__(self, clause_ms: float):
+		self.clause_ms = clause_ms
+		self.weights = np.random.default_rng(0).standard_normal((256, 256)).astype(np.float32)
+
+	def text_to_audio(self, text: str):
+		for clause in text.split("."):
+			if not clause.strip():
+				continue
+			deadline = time.perf_counter() + self.clause_ms / 1000 * 0.8
+			state = self.weights
+			while time.perf_counter() < deadline:
+				state = np.tanh(state @ self.weights)
+			audio = np.resize(state.ravel(), self.sample_rate).astype(np.float32) * 0.1
+			# trim_and_pad's RMS windows hold the GIL
+			window = 256
+			rms = [np.sqrt(np.mean(audio[i:i + window] ** 2)) for i in range(0, len(audio), window)]
+			yield audio[:len(rms) * window]
+
+	def close(self):
+		pass
+
+async def ticker(stop: asyncio.Event, lags: list[float], interval: float = 0.001):
+	while not stop.is_set():
+		expected = time.perf_counter() + interval
+		await asyncio.sleep(interval)
+		lags.append(max(0.0, time.perf_counter() - expected))
+
+async def legacy(tts, text: str) -> int:
+	loop = asyncio.get_running_loop()
+	sent = 0
+	chunks = await loop.run_in_executor(None, tts.text_to_audio, text)
+	for pcm in chunks:
+		if pcm.size == 0:
+			continue
+		pcm16 = float32_to_pcm16(pcm)
+		await loop.run_in_executor(None, audio_to_base64, pcm16)
+		sent += 1
+	return sent
+
+async def worker(tts, text: str, streaming: StreamingTTSWorker) -> int:
+	sent = 0
+	async for _ in streaming.stream(text, encode_audio):
+		sent += 1
+	return sent
+
+async def measure(name: str, run) -> tuple[float, float]:
+	stop = asyncio.Event()
+	lags = []
+	task = asyncio.create_task(ticker(stop, lags))
+	await asyncio.sleep(0.05)
+	start = time.perf_counter()
+	chunks = await run()
+	elapsed = time.perf_counter() - start
+	stop.set()
+	await task
+
+	lags = sorted(lags)
+	p99 = lags[int(len(lags) * 0.99)] if lags else 0.0
+	print(f"{name:>8}: {elapsed * 1000:8.1f}ms for {chunks} chunks | loop lag max {lags[-1] * 1000:7.1f}ms, p99 {p99 * 1000:7.1f}ms, {len(lags)} ticks")
+	return lags[-1], elapsed
+
+async def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--clauses", type=int, default=8)
+	parser.add_argument("--clause-ms", type=float, default=60.0)
+	parser.add_argument("--model")
+	parser.add_argument("--voice")
+	parser.add_argument("--pitch-shift", type=float, default=0.0)
+	args = parser.parse_args()
+
+	if args.model:
+		from Orca.utils.TTS import TTSClient, TTSClientConfig
+		tts = TTSClient(TTSClientConfig(model_path=args.model, voice_pack=args.voice, pitch_shift=args.pitch_shift))
+	else:
+		tts = FakeTTS(args.clause_ms)
+	text = " ".join(f"This is clause number {i} of the reply." for i in range(args.clauses))
+
+	streaming = StreamingTTSWorker(tts)
+	# Warm both paths up so first-call costs don't land on either side
+	await legacy(tts, "Warm up.")
+	await worker(tts, "Warm up.", streaming)
+
+	old_lag, _ = await measure("legacy", lambda: legacy(tts, text))
+	new_lag, _ = await measure("worker", lambda: worker(tts, text, streaming))
+	print(f"worst stall: {old_lag * 1000:.1f}ms -> {new_lag * 1000:.1f}ms")
+	streaming.close()
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -1,2 +1,8 @@
-from .core import Orca
 __version__ = "0.1.0"
+
+def __getattr__(name):
+	# Loaded on first use, so Orca.utils can be imported without pulling in Kokoro and torch
+	if name == "Orca":
+		from .core import Orca
+		return Orca
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,4 +1,5 @@
 import yaml
+import aiohttp.web
 import asyncio
 import argparse
 import os
@@ -8,12 +9,21 @@ from pathlib import Path
 from dotenv import load_dotenv
 
 from .utils.LLM import LLMClient, LLMClientConfig, LLMHyperparameters
+from .utils.LLMPool import LLMPool, LLMPoolConfig
+from .utils.MockLLM import MockLLMServer, MockLLMServerConfig
 from .utils.STT import STTClient, STTClientConfig, STTHyperparameters
 from .utils.TTS import TTSClient, TTSClientConfig
+from .utils.AudioCache import AudioCacheConfig
+from .utils.PhonemeCache import PhonemeCacheConfig
+from .utils.StreamingTTSWorker import StreamingTTSWorker
+from .utils.TTSPool import TTSPool, TTSPoolConfig
+from .utils.StreamOutputHandler import StreamOutputConfig
 
 from .utils.AIOApp import AIOApp, AIOAppConfig
 
-from .utils.Context import Context
+from .utils.Context import Context, ContextPolicyConfig
+from .utils.ConversationJournal import ConversationJournal
+from .utils.PromptLayout import PromptLayout, PromptLayoutConfig
 from .utils.EventBus import EventBus, EventBusConfig
 from .utils.WebSocket import WebSocket, WebSocketConfig
 
@@ -21,10 +31,18 @@ from .utils.ClientManager import ClientManager
 from .utils.FunctionRegistry import FunctionRegistry
 
 from .utils.BarrierTracker import BarrierTracker
+from .utils.GenerationScheduler import GenerationScheduler, GenerationSchedulerConfig
+from .utils.PrefillWarmer import PrefillWarmer
+from .utils.Compactor import Compactor, CompactorConfig
+from .utils.PromptSnapshots import PromptSnapshots
+from .utils.Readiness import wait_until_ready
+from .utils.Metrics import Metrics, GenerationMetrics
+from .utils.SamplerPresets import SamplerPresets
+from .utils.TurnGate import TurnGate, TurnGateConfig
 
 from .utils.Events import (
-	ClientConnectEvent, ClientDisconnectEvent, ClientMessageEvent, FunctionReturnEvent, RebuildPromptEvent,
-	Schema_ConnectEvent, Schema_DisconnectEvent, Schema_MessageEvent, Schema_FunctionResultEvent
+	ClientConnectEvent, ClientDisconnectEvent, ClientMessageEvent, FunctionReturnEvent, RebuildPromptEvent, CancelGenerationEvent, ResetContextEvent,
+	Schema_ConnectEvent, Schema_DisconnectEvent, Schema_MessageEvent, Schema_FunctionResultEvent, Schema_CancelEvent
 )
 
 from .utils.ScriptManager import ScriptManager
@@ -45,31 +63,70 @@ class Orca:
 
 		# subprocesses
 		self.llm = None
+		self.mock_llm = None
+		self.warmer = None
+		self.snapshots = None
+		self.compactor = None
+		self.turn_gate = None
 		self.stt = None
 		self.tts = None
+		self.tts_worker = None
+		# Queue sizes between the LLM, synthesis and the audio sends
+		self.stream_output = StreamOutputConfig(**self.config["tts"].get("pipeline", {}))
 
 		# connectivity
 		self.http = None
 		self.ws = None
 
 		# prompts
-		now = datetime.now()
-		self.system_prompt_replacements = {
-			"<date>": now.strftime("%Y-%m-%d"),
-			"<time>": now.strftime("%I:%M %p")
-		}
-		self.context = Context(self.config["chat"]["system_prompt"], self.system_prompt_replacements)
+		self.prompt_layout = PromptLayout(PromptLayoutConfig(
+			layout=self.config["chat"].get("prompt_layout", "inline"),
+			**self.config["chat"].get("prompt_layout_options", {})
+		))
+		self.system_prompt_replacements = self.prompt_layout.replacements(datetime.now())
+		# Leave room for the reply, by default the largest n_predict a generation asks for
+		context_length = self.config["chat"]["context_length"]
+		self.context = Context(
+			self.config["chat"]["system_prompt"],
+			self.system_prompt_replacements,
+			token_budget=self.config["chat"].get("context_budget", context_length - 512),
+			trim_target=self.config["chat"].get("context_trim_target", 0.75),
+			policy=ContextPolicyConfig(**self.config["chat"].get("context_policy", {}))
+		)
+
+		# Carry the conversation over restarts
+		self.journal = None
+		conversation_log_dir = os.getenv("CONVERSATION_LOG_DIR")
+		if conversation_log_dir and self.config["chat"].get("journal", True):
+			self.journal = ConversationJournal(Path(conversation_log_dir) / f"{self.config['name']}.journal")
+			self.context.attach_journal(self.journal)
 
 		self.client_manager = ClientManager()
 		self.script_manager = ScriptManager(self, self.config.get("scripts", []))
 		self.function_registry = FunctionRegistry()
 		self.barriers = BarrierTracker()
+		# Input types that interrupt a generation that is still talking
+		self.barge_in = set(self.config["chat"].get("barge_in", ["audio"]))
+		self.scheduler = GenerationScheduler(GenerationSchedulerConfig(
+			slots=self.config["chat"].get("slots", 1),
+			**self.config["chat"].get("scheduler", {})
+		))
+		# Validated here so a typo in a preset fails at startup rather than on the first generation
+		self.presets = SamplerPresets(
+			self.config["chat"].get("presets"),
+			self.config["chat"].get("generation_presets")
+		)
+
+		# Per generation metrics, served at /generations
+		self.generation_metrics = GenerationMetrics(self.config["chat"].get("metrics_history", 200))
 
 		# events
 		self.event_bus = EventBus(EventBusConfig(
 			user_data=self
 		))
 		self._shutdown_evt = asyncio.Event()
+		# Set once the backends have loaded, client events wait on it
+		self._ready_evt = asyncio.Event()
 		self._event_task: asyncio.Task | None = None
 
 	async def run(self):
@@ -82,19 +139,79 @@ class Orca:
 			await self.stop()
 
 	async def start(self):
+		startup = Metrics()
+		startup.start_timer("startup")
+		timeout = self.config.get("startup_timeout", 300)
+
+		if self.journal:
+			self.journal.start()
+
 		host = os.getenv("HOST_ADDRESS", "127.0.0.1")
 		subprocess_log_dir = os.getenv("SUBPROCESS_LOG_DIR")
 		backend_path = Path(__file__).parent.parent
 
-		self.llm = LLMClient(LLMClientConfig(
-			backend_location=backend_path / os.getenv("LLAMA_BACKEND"),
-			host=host,
-			port=int(os.getenv("LLM_PORT")),
-			model=self.config["chat"]["model_path"],
-			alias=self.config["name"],
-			context_length=self.config["chat"]["context_length"],
-			log_dir=subprocess_log_dir
-		))
+		# The mock backend stands in for llama-server so the pipeline can be benchmarked without a GPU
+		use_mock = self.config["chat"].get("backend") == "mock"
+		if use_mock:
+			self.mock_llm = MockLLMServer(MockLLMServerConfig(
+				host=host,
+				port=int(os.getenv("LLM_PORT")),
+				**self.config["chat"].get("mock", {})
+			))
+			await self.mock_llm.start()
+
+		# Every backend serves the same model, spawned ones each get their own port
+		slot_save_path = self.config["chat"].get("slot_save_path")
+		self.llm = LLMPool(LLMPoolConfig(**self.config["chat"].get("pool", {})))
+		backends = self.config["chat"].get("backends") or [{ "name": "local", "spawn": not use_mock }]
+		for i, backend in enumerate(backends):
+			self.llm.add(backend.get("name", f"llm-{i}"), LLMClientConfig(
+				backend_location=backend_path / os.getenv("LLAMA_BACKEND", ""),
+				host=backend.get("host", host),
+				port=int(backend.get("port", os.getenv("LLM_PORT"))),
+				model=backend.get("model_path", self.config["chat"]["model_path"]),
+				alias=self.config["name"],
+				context_length=self.config["chat"]["context_length"],
+				parallel=self.config["chat"].get("slots", 1),
+				spawn_server=backend.get("spawn", True),
+				record_path=self.config["chat"].get("record"),
+				slot_save_path=slot_save_path if backend.get("spawn", True) else None,
+				log_dir=subprocess_log_dir,
+				# connect_timeout, read_timeout, pool_size and keepalive_timeout
+				**self.config["chat"].get("http", {})
+			))
+		# Every backend adds its own slots to the scheduler
+		self.scheduler.set_backends({name: self.config["chat"].get("slots", 1) for name in self.llm.backends}, self.llm.is_available)
+
+		self.warmer = PrefillWarmer(self.llm, self.scheduler, self.context, self.config["chat"].get("prefill_warming", True))
+		# Inline <date> and <time> change the system prompt every minute, its snapshot would never be reused
+		if slot_save_path is not None and not self.prompt_layout.stable:
+			print("Prompt snapshots need prompt_layout: \"stable\", slot_save_path is ignored")
+		self.snapshots = PromptSnapshots(self.llm, self.scheduler, self.context, enabled=slot_save_path is not None and self.prompt_layout.stable)
+		self.compactor = Compactor(self.llm, self.scheduler, self.context, self.warmer, CompactorConfig(**self.config["chat"].get("compaction", {})))
+
+		# An optional cheap check that skips generations which would only be silence
+		gate_config = TurnGateConfig(**self.config["chat"].get("turn_gate", {}))
+		gate_client = None
+		if gate_config.enabled and gate_config.mode == "model":
+			# Its own llama-server, it can't share a port with any chat backend
+			taken = {int(backend.get("port", os.getenv("LLM_PORT"))) for backend in backends if backend.get("host", host) == gate_config.model.get("host", host)}
+			if "port" not in gate_config.model or int(gate_config.model["port"]) in taken:
+				raise ValueError(f"turn_gate.model.port must be set to a port no chat backend uses, taken: {', '.join(map(str, sorted(taken)))}")
+			gate_client = LLMClient(LLMClientConfig(**{
+				"backend_location": backend_path / os.getenv("LLAMA_BACKEND", ""),
+				"host": host,
+				"alias": f"{self.config['name']}-gate",
+				"log_dir": subprocess_log_dir,
+				**gate_config.model
+			}))
+		self.turn_gate = TurnGate(
+			self.llm,
+			self.config["chat"].get("silence_token", "<silence>"),
+			gate_config,
+			gate_client,
+			others=[self.config["chat"].get("thinking_token", "<thinking>"), self.config["chat"].get("function_token", "`")]
+		)
 
 		self.stt = STTClient(STTClientConfig(
 			backend_location=backend_path / os.getenv("WHISPER_BACKEND"),
@@ -104,15 +221,63 @@ class Orca:
 			vad=self.config["stt"]["vad_path"],
 			log_dir=subprocess_log_dir
 		))
-		self.tts = TTSClient(TTSClientConfig(
+		tts_config = TTSClientConfig(
 			model_path=self.config["tts"]["model_path"],
 			voice_pack=self.config["tts"]["voice_pack"],
-			pitch_shift=self.config["tts"]["pitch_shift"]
-		))
+			pitch_shift=self.config["tts"]["pitch_shift"],
+			cache=AudioCacheConfig(**self.config["tts"].get("cache", {})),
+			phonemes=PhonemeCacheConfig(**self.config["tts"].get("phonemes", {}))
+		)
+		tts_pool_config = TTSPoolConfig(
+			workers=self.config["tts"].get("workers", 1),
+			torch_threads=self.config["tts"].get("torch_threads", 0)
+		)
+
+		async def _get_slots(request):
+			return aiohttp.web.json_response(await self.scheduler.report(self.llm))
+		async def _get_backends(request):
+			return aiohttp.web.json_response(self.llm.report())
+		async def _drain_backend(request):
+			name = request.match_info["name"]
+			if name not in self.llm.backends:
+				return aiohttp.web.json_response({ "error": f"unknown backend {name}" }, status=404)
+			try:
+				await self.llm.drain(name)
+			except ValueError as e:
+				return aiohttp.web.json_response({ "error": str(e) }, status=409)
+			return aiohttp.web.json_response(self.llm.report())
+		async def _get_turn_gate(request):
+			return aiohttp.web.json_response(self.turn_gate.report())
+		async def _get_tts_cache(request):
+			return aiohttp.web.json_response(self.tts_worker.cache_report() if self.tts_worker else None)
+		async def _get_generations(request):
+			return aiohttp.web.json_response(self.generation_metrics.report())
+		async def _get_generation(request):
+			generation = self.generation_metrics.get(request.match_info["generation_id"])
+			if generation is None:
+				return aiohttp.web.json_response({ "error": "unknown generation" }, status=404)
+			return aiohttp.web.json_response(generation)
+		async def _reset_context(request):
+			self.event_bus.push_event(ResetContextEvent())
+			return aiohttp.web.json_response({ "status": "ok" })
 
 		self.http = AIOApp(AIOAppConfig(
 			host=host,
-			port=int(os.getenv("HTTP_PORT"))
+			port=int(os.getenv("HTTP_PORT")),
+			get_endpoints={
+				"/slots": _get_slots,
+				"/backends": _get_backends,
+				"/generations": _get_generations,
+				"/generations/{generation_id}": _get_generation,
+				"/turn_gate": _get_turn_gate,
+				"/tts_cache": _get_tts_cache
+			},
+			post_endpoints={
+				"/reset": _reset_context
+			},
+			delete_endpoints={
+				"/backends/{name}": _drain_backend
+			}
 		))
 
 		self.ws = WebSocket(WebSocketConfig(
@@ -121,13 +286,20 @@ class Orca:
 		))
 
 		async def _on_connect(ws, payload):
+			await self._ready_evt.wait()
 			self.event_bus.push_event(ClientConnectEvent(ws, payload))
 		async def _on_disconnect(ws, payload):
+			await self._ready_evt.wait()
 			self.event_bus.push_event(ClientDisconnectEvent(ws))
 		async def _on_message(ws, payload):
+			await self._ready_evt.wait()
 			self.event_bus.push_event(ClientMessageEvent(ws, payload))
 		async def _on_function_result(ws, payload):
+			await self._ready_evt.wait()
 			self.event_bus.push_event(FunctionReturnEvent(payload))
+		async def _on_cancel(ws, payload):
+			await self._ready_evt.wait()
+			self.event_bus.push_event(CancelGenerationEvent(payload))
 
 		async def _on_open_input_stream(ws, payload):
 			pass
@@ -141,6 +313,7 @@ class Orca:
 		self.ws.add_event("disconnect", _on_disconnect, Schema_DisconnectEvent)
 		self.ws.add_event("message", _on_message, Schema_MessageEvent)
 		self.ws.add_event("function_result", _on_function_result, Schema_FunctionResultEvent)
+		self.ws.add_event("cancel", _on_cancel, Schema_CancelEvent)
 
 		self.ws.register_on_disconnect("disconnect")
 
@@ -151,13 +324,43 @@ class Orca:
 		# Load scripts
 		self.script_manager.load_scripts()
 
-		self.event_bus.push_event(RebuildPromptEvent())
-
-		# Turn on connectivity
+		# Accept connections straight away, their events queue up until the backends are ready
 		await self.http.start()
 		await self.ws.start()
 
+		# The servers load their models while kokoro loads in a thread
+		async def _load_tts():
+			with startup.time("tts_load"):
+				if tts_pool_config.workers > 1:
+					self.tts_worker = TTSPool(tts_config, tts_pool_config)
+					if not await self.tts_worker.start(timeout):
+						print("No TTS worker loaded, speech will fail")
+				else:
+					self.tts = await asyncio.to_thread(TTSClient, tts_config)
+					self.tts_worker = StreamingTTSWorker(self.tts)
+		async def _llm_ready():
+			with startup.time("llm_ready"):
+				ready, _ = await asyncio.gather(self.llm.wait_ready(timeout), self.turn_gate.wait_ready(timeout))
+				if not ready:
+					print("No LLM backend became ready, generations will fail until one does")
+			with startup.time("presets"):
+				try:
+					await self.presets.compile(self.llm)
+				except Exception as e:
+					print(f"Sampler presets will compile on first use: {e}")
+		async def _stt_ready():
+			with startup.time("stt_ready"):
+				await wait_until_ready("STT server", lambda: asyncio.to_thread(self.stt.health), timeout)
+
+		await asyncio.gather(_load_tts(), _llm_ready(), _stt_ready())
+		self.llm.start()
+
+		startup.stop_timer("startup")
+		startup.print()
+
+		self.event_bus.push_event(RebuildPromptEvent(restore_snapshot="startup"))
 		self._event_task = asyncio.create_task(self.event_loop())
+		self._ready_evt.set()
 
 	async def stop(self):
 		self._shutdown_evt.set()
@@ -190,11 +393,27 @@ class Orca:
 				pass
 
 		# Close subprocesses
-		for p in (self.llm, self.stt):
-			try:
-				p.close()
-			except Exception:
-				pass
+		try:
+			await self.llm.close()
+		except Exception:
+			pass
+
+		if self.turn_gate:
+			await self.turn_gate.close()
+
+		if self.mock_llm:
+			await self.mock_llm.stop()
+
+		try:
+			self.stt.close()
+		except Exception:
+			pass
+
+		if self.tts_worker:
+			self.tts_worker.close()
+
+		if self.journal:
+			await self.journal.close()
 
 	async def event_loop(self):
 		while not self._shutdown_evt.is_set():
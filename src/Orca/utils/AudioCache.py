@@ -0,0 +1,173 @@
+import hashlib
+import numpy as np
+import os
+import time
+import unicodedata
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+@dataclass
+class AudioCacheConfig:
+	enabled: bool = False
+	# Memory held by the in-process LRU
+	memory_mb: float = 64
+	# Directory for the on-disk tier, None keeps the cache in memory only
+	path: str | None = None
+	disk_mb: float = 1024
+	# Longer clauses are rarely said twice and aren't stored
+	max_chars: int = 80
+
+def normalize_clause(clause: str) -> str:
+	return " ".join(unicodedata.normalize("NFKC", clause).split())
+
+def file_fingerprint(path: str, sample: int = 1 << 20) -> str:
+	""" Hash of a file's size and its first and last MiB, cheap enough for a model on every load """
+	digest = hashlib.sha1()
+	with open(path, "rb") as f:
+		size = os.fstat(f.fileno()).st_size
+		digest.update(str(size).encode("utf-8"))
+		digest.update(f.read(sample))
+		if size > sample:
+			f.seek(max(sample, size - sample))
+			digest.update(f.read(sample))
+	return digest.hexdigest()[:16]
+
+class AudioCache:
+	""" Final float32 audio per clause, a byte bounded LRU in memory in front of memory-mapped files on disk """
+	def __init__(self, config: AudioCacheConfig, fingerprint: str):
+		self.config = config
+		# Model, voice and pitch, anything that changes the audio for the same text
+		self.fingerprint = fingerprint
+		self.memory_limit = int(config.memory_mb * 1024 * 1024)
+		self.disk_limit = int(config.disk_mb * 1024 * 1024)
+
+		self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+		self.memory_bytes = 0
+
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		self.bytes_saved = 0
+
+		self.directory = Path(config.path) if config.path else None
+		# Sizes of the files on disk, oldest use first
+		self.disk: OrderedDict[str, int] = OrderedDict()
+		self.disk_bytes = 0
+		if self.directory:
+			self.directory.mkdir(parents=True, exist_ok=True)
+			entries = []
+			for entry in os.scandir(self.directory):
+				if entry.name.endswith(".f32"):
+					stat = entry.stat()
+					entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+				elif entry.name.endswith(".tmp") and entry.stat().st_mtime < time.time() - 60:
+					# Left behind by a store that was interrupted
+					os.unlink(entry.path)
+			for _, key, size in sorted(entries):
+				self.disk[key] = size
+				self.disk_bytes += size
+
+	def key(self, clause: str) -> str | None:
+		""" None for clauses too long to be worth caching """
+		text = normalize_clause(clause)
+		if not text or len(text) > self.config.max_chars:
+			return None
+		return hashlib.sha1(f"{self.fingerprint}\n{text}".encode("utf-8")).hexdigest()
+
+	def get(self, key: str) -> np.ndarray | None:
+		audio = self.memory.get(key)
+		if audio is not None:
+			self.memory.move_to_end(key)
+		elif self.directory and (key in self.disk or (self.directory / f"{key}.f32").exists()):
+			# Files another worker stored since startup are picked up too
+			audio = self._load(key)
+			if audio is None:
+				self.misses += 1
+				return None
+			self.disk_hits += 1
+			self._remember(key, audio)
+		else:
+			self.misses += 1
+			return None
+
+		self.hits += 1
+		self.bytes_saved += audio.nbytes
+		return audio
+
+	def put(self, key: str, audio: np.ndarray):
+		if audio.size == 0:
+			return
+		audio = np.ascontiguousarray(audio, dtype=np.float32)
+		audio.setflags(write=False)
+		self._remember(key, audio)
+		if self.directory and key not in self.disk and audio.nbytes <= self.disk_limit:
+			self._store(key, audio)
+
+	def _remember(self, key: str, audio: np.ndarray):
+		if audio.nbytes > self.memory_limit:
+			return
+		previous = self.memory.pop(key, None)
+		if previous is not None:
+			self.memory_bytes -= previous.nbytes
+		self.memory[key] = audio
+		self.memory_bytes += audio.nbytes
+		while self.memory_bytes > self.memory_limit:
+			_, evicted = self.memory.popitem(last=False)
+			self.memory_bytes -= evicted.nbytes
+
+	def _load(self, key: str) -> np.ndarray | None:
+		path = self.directory / f"{key}.f32"
+		try:
+			mapped = np.memmap(path, dtype=np.float32, mode="r")
+			audio = np.array(mapped)
+			del mapped
+			# Recently used files survive eviction, here and after a restart
+			os.utime(path)
+		except (OSError, ValueError):
+			# Removed by another worker's eviction, or cut short
+			self.disk_bytes -= self.disk.pop(key, 0)
+			return None
+		if key not in self.disk:
+			self.disk[key] = audio.nbytes
+			self.disk_bytes += audio.nbytes
+		self.disk.move_to_end(key)
+		audio.setflags(write=False)
+		return audio
+
+	def _store(self, key: str, audio: np.ndarray):
+		path = self.directory / f"{key}.f32"
+		temporary = path.with_suffix(f".{os.getpid()}.tmp")
+		try:
+			mapped = np.memmap(temporary, dtype=np.float32, mode="w+", shape=audio.shape)
+			mapped[:] = audio
+			mapped.flush()
+			del mapped
+			# Other workers only ever see complete files
+			os.replace(temporary, path)
+		except OSError as e:
+			print(f"[tts cache] couldn't store clause audio: {e}")
+			temporary.unlink(missing_ok=True)
+			return
+
+		self.disk[key] = audio.nbytes
+		self.disk_bytes += audio.nbytes
+		while self.disk_bytes > self.disk_limit and self.disk:
+			evicted, size = self.disk.popitem(last=False)
+			self.disk_bytes -= size
+			(self.directory / f"{evicted}.f32").unlink(missing_ok=True)
+
+	def report(self) -> dict:
+		lookups = self.hits + self.misses
+		return {
+			"hits": self.hits,
+			"disk_hits": self.disk_hits,
+			"misses": self.misses,
+			"hit_rate": self.hits / lookups if lookups else 0.0,
+			"bytes_saved": self.bytes_saved,
+			"memory_entries": len(self.memory),
+			"memory_bytes": self.memory_bytes,
+			"disk_entries": len(self.disk),
+			"disk_bytes": self.disk_bytes
+		}
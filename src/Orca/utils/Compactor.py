@@ -0,0 +1,116 @@
+import asyncio
+import time
+import uuid
+
+from dataclasses import dataclass
+
+from .GenerationScheduler import COMPACTION_GENERATION
+from .LLM import LLMHyperparameters
+
+SUMMARY_INSTRUCTIONS = (
+	"Summarize the conversation below for your own memory. Keep names, facts, preferences, open questions "
+	"and anything that was promised or still pending. Write plain prose, reply with the summary only."
+)
+
+@dataclass
+class CompactorConfig:
+	enabled: bool = True
+	# Fraction of the token budget the context has to reach before older turns are summarized
+	threshold: float = 0.6
+	# Most recent messages that are always kept verbatim
+	keep_recent: int = 8
+	# Fewer messages than this aren't worth a summary
+	min_messages: int = 4
+	# Seconds without a new turn before compaction starts
+	idle_delay: float = 2.0
+	summary_tokens: int = 384
+	summary_prefix: str = "Summary of the earlier conversation:\n"
+
+class Compactor:
+	""" Summarizes the oldest turns in the background once the context grows past a threshold """
+	def __init__(self, llm, scheduler, context, warmer, config: CompactorConfig):
+		self.llm = llm
+		self.scheduler = scheduler
+		self.context = context
+		self.warmer = warmer
+		self.config = config
+		self.hyperparameters = LLMHyperparameters(temperature=0.3, n_predict=config.summary_tokens)
+
+		self._task: asyncio.Task | None = None
+
+		self.runs = 0
+		self.tokens_saved = 0
+
+	def schedule(self, reason: str):
+		""" Compact once things have been quiet for idle_delay, a newer turn restarts the wait """
+		if not self.config.enabled or self.context.token_budget <= 0:
+			return
+
+		if self._task and not self._task.done():
+			self._task.cancel()
+		self._task = self.scheduler.track(asyncio.create_task(self._compact(reason)))
+
+	def _pick_range(self) -> tuple[int, int]:
+		""" [1, end) covering the oldest turns, ending right before a user message """
+		# The cut lands on a message, even when nothing is kept verbatim
+		end = min(len(self.context.messages) - self.config.keep_recent, len(self.context.messages) - 1)
+		if end <= 1:
+			return 1, 1
+		while end > 1 and self.context.messages[end].role != "user":
+			end -= 1
+		return 1, end
+
+	async def _compact(self, reason: str):
+		await asyncio.sleep(self.config.idle_delay)
+
+		total = await self.context.count_tokens(self.llm.tokenize)
+		if total < self.context.token_budget * self.config.threshold:
+			return
+
+		start, end = self._pick_range()
+		if end - start < self.config.min_messages:
+			return
+
+		# Only take a slot nobody else wants, a new turn preempts the summary
+		idle = self.scheduler.idle_slot(COMPACTION_GENERATION)
+		if idle is None or self.scheduler.waiting:
+			return
+
+		# The slot keeps its pin, the conversation's slot is warmed again right after a summary replaced its prefix
+		generation_id = f"compact-{uuid.uuid4().hex[:12]}"
+		ticket = await self.scheduler.acquire(generation_id, COMPACTION_GENERATION, key=idle.pinned)
+		if ticket is None:
+			return
+
+		started = time.time()
+		summarized = self.context.messages[start:end]
+		before = self.context.tokens_between(start, end)
+		try:
+			transcript = "\n".join(f"{message.role}: {message.content}" for message in summarized)
+			summary = await self.llm.complete([
+				{"role": "system", "content": SUMMARY_INSTRUCTIONS},
+				{"role": "user", "content": transcript}
+			], self.hyperparameters, id_slot=ticket.slot_id, key=ticket.route)
+		except asyncio.CancelledError:
+			print(f"[compaction] {ticket.cancel_reason or 'cancelled'}")
+			raise
+		except Exception as e:
+			print(f"[compaction] summary failed: {e}")
+			return
+		finally:
+			self.scheduler.release(ticket)
+
+		summary = summary.strip()
+		if not summary or not self.context.compact(start, end, self.config.summary_prefix + summary, summarized):
+			return
+
+		await self.context.count_tokens(self.llm.tokenize)
+		after = self.context.tokens_between(start, start + 1)
+		latency = (time.time() - started) * 1000
+
+		self.runs += 1
+		self.tokens_saved += before - after
+		print(f"[compaction] summarized {end - start} messages for {reason} in {latency:.0f}ms, {before} -> {after} tokens ({self.tokens_saved} saved in total)")
+
+		# Prefill the shortened prompt now so the next turn doesn't pay for it
+		self.warmer.warm("compaction")
@@ -1,35 +1,181 @@
-def _build_prompt(prompt: str, replacements: dict) -> str:
-	for key, value in replacements.items():
-		prompt = prompt.replace(key, value)
-	return prompt
+import asyncio
+import json
+import sys
+
+from dataclasses import dataclass
+
+from .PromptTemplate import PromptTemplate
+
+def _estimate_tokens(text: str) -> int:
+	# Rough fallback when the tokenizer can't be reached
+	return len(text) // 4 + 1
+
+# Encoded `{"role":...,"content":` heads, one per role
+_HEADS: dict[str, bytes] = {}
+
+@dataclass
+class ContextPolicyConfig:
+	enabled: bool = True
+	# Most recent assistant turns that are always sent exactly as generated
+	keep_turns: int = 4
+	# Older turns switch to their condensed form this many at a time, so the prompt prefix only changes once per step
+	step: int = 4
+	# Condensed function returns are cut to this many characters
+	function_return_chars: int = 120
+
+class ContextMessage:
+	""" One chat message with its token count and encoded JSON cached """
+	__slots__ = ("role", "_content", "tokens", "_json", "condensed")
+
+	def __init__(self, role: str, content: str, condensed: str | None = None):
+		# Roles repeat on every message, share one string per role
+		self.role = sys.intern(role)
+		self._content = content
+		# None until tokenized
+		self.tokens: int | None = None
+		self._json: bytes | None = None
+		# Shorter form sent once the message is old, None if there is nothing to leave out
+		self.condensed = ContextMessage(role, condensed) if condensed and condensed != content else None
+
+	@property
+	def content(self) -> str:
+		return self._content
+
+	@content.setter
+	def content(self, value: str):
+		self._content = value
+		self.tokens = None
+		self._json = None
+		self.condensed = None
+
+	@property
+	def json(self) -> bytes:
+		""" The message as compact JSON, encoded once """
+		if self._json is None:
+			head = _HEADS.get(self.role)
+			if head is None:
+				head = _HEADS[self.role] = b'{"role":' + json.dumps(self.role).encode("utf-8") + b',"content":'
+			self._json = head + json.dumps(self._content, ensure_ascii=False).encode("utf-8") + b"}"
+		return self._json
+
+	def to_dict(self) -> dict[str, str]:
+		return {"role": self.role, "content": self._content}
+
+	def __getitem__(self, key: str) -> str:
+		# Scripts written against the old dict messages still read them like one
+		if key == "role":
+			return self.role
+		if key == "content":
+			return self._content
+		raise KeyError(key)
+
+	def __repr__(self) -> str:
+		return f"ContextMessage({self.role!r}, {self._content!r})"
 
 class Context:
-	def __init__(self, system_prompt: str, replacements: dict[str, str] = {}):
+	def __init__(self, system_prompt: str, replacements: dict[str, str] = {}, token_budget: int = 0, trim_target: float = 0.75, message_overhead: int = 4, policy: ContextPolicyConfig | None = None):
 		self.raw_system_prompt = system_prompt
-		self.messages = []
+		self.template = PromptTemplate(system_prompt or "")
+		self.messages: list[ContextMessage] = []
+
+		# 0 disables trimming
+		self.token_budget = token_budget
+		# Trim down to this fraction of the budget so the trimmed prefix stays stable for many turns
+		self.trim_target = trim_target
+		# Chat template tokens wrapped around every message
+		self.message_overhead = message_overhead
+		self.policy = policy or ContextPolicyConfig()
+		# Trailing system message sent with the next generation but never kept in the history
+		self.ephemeral = ""
+		self._ephemeral_message: ContextMessage | None = None
+		# Every mutation is recorded here once attached
+		self.journal = None
 
 		if self.raw_system_prompt:
-			self.add_message("system", _build_prompt(self.raw_system_prompt, replacements))
+			self.template.update(replacements)
+			self.add_message("system", self.template.render())
 
-	def update_system_prompt_replacements(self, replacements: dict[str, str]):
+	def update_system_prompt_replacements(self, replacements: dict[str, str]) -> bool:
+		""" Re-render the system prompt, True if it changed """
 		# Ensure the system prompt exists, it's in context and the first message is a system prompt
-		if self.raw_system_prompt and len(self.messages) >= 1 and self.messages[0]["role"] == "system":
-			self.messages[0]["content"] = _build_prompt(self.raw_system_prompt, replacements)
+		if not (self.raw_system_prompt and len(self.messages) >= 1 and self.messages[0].role == "system"):
+			return False
+
+		# Recompile if the raw prompt itself was swapped out
+		if self.template.raw != self.raw_system_prompt:
+			self.template = PromptTemplate(self.raw_system_prompt)
+		self.template.update(replacements)
+		prompt = self.template.render()
+		# The template hands back the same string object until a placeholder changes
+		if prompt is self.messages[0].content or prompt == self.messages[0].content:
+			return False
 
-	def add_message(self, role: str, message: str):
-		self.messages.append({"role": role, "content": message})
+		self.messages[0].content = prompt
+		if self.journal:
+			self.journal.append({"op": "system", "content": prompt})
+			if self.journal.snapshot_due:
+				self._snapshot()
+		return True
+
+	def add_message(self, role: str, message: str, condensed: str | None = None):
+		self.messages.append(ContextMessage(role, message, condensed))
+		if self.journal:
+			record = {"op": "add", "role": role, "content": message}
+			if self.messages[-1].condensed:
+				record["condensed"] = condensed
+			self.journal.append(record)
+			if self.journal.snapshot_due:
+				self._snapshot()
 
 	def push_user(self, message: str):
 		self.add_message("user", message)
 
-	def push_assistant(self, message: str):
-		self.add_message("assistant", message)
+	def push_assistant(self, message: str, condensed: str | None = None):
+		""" condensed is the reply without its thinking trace and function blocks """
+		# A reply that was only a function call keeps it, an empty turn would tell the model even less
+		self.add_message("assistant", message, condensed.strip() if condensed else None)
 
 	def push_system(self, message: str):
 		self.add_message("system", message)
 
+	def push_function_return(self, message: str):
+		limit = self.policy.function_return_chars
+		self.add_message("system", message, message[:limit].rstrip() + "..." if len(message) > limit else None)
+
 	def prompt(self) -> list[dict]:
-		return self.messages
+		return [message.to_dict() for message in self._prompt_messages()]
+
+	def prompt_json(self) -> bytes:
+		""" The prompt's messages as a JSON array, only messages new since the last call are encoded """
+		return b"[" + b",".join([message.json for message in self._prompt_messages()]) + b"]"
+
+	def _prompt_messages(self) -> list[ContextMessage]:
+		messages = self._sent_messages()
+		if not self.ephemeral:
+			return messages
+		if self._ephemeral_message is None or self._ephemeral_message.content != self.ephemeral:
+			self._ephemeral_message = ContextMessage("system", self.ephemeral)
+		return messages + [self._ephemeral_message]
+
+	def _cutover(self) -> int:
+		""" Messages before this index are sent in their condensed form """
+		if not self.policy.enabled:
+			return 0
+
+		replies = [i for i, message in enumerate(self.messages) if message.role == "assistant"]
+		step = max(1, self.policy.step)
+		# Moving the cut-over a whole step at a time keeps the prefix byte-stable for the turns in between
+		condensed = max(0, len(replies) - self.policy.keep_turns) // step * step
+		if condensed == 0:
+			return 0
+		return replies[condensed] if condensed < len(replies) else len(self.messages)
+
+	def _sent_messages(self) -> list[ContextMessage]:
+		""" The history as it goes to the model, older turns condensed """
+		cut = self._cutover()
+		if cut == 0:
+			return self.messages
+		return [message.condensed or message for message in self.messages[:cut]] + self.messages[cut:]
 
 	def length(self) -> int:
 		# Includes system prompt
@@ -37,15 +183,106 @@ class Context:
 
 	def reset(self):
 		self.messages = [ self.messages[0] ]
+		self._snapshot()
+
+	def compact(self, start: int, end: int, summary: str, summarized: list[ContextMessage]) -> bool:
+		""" Swap messages[start:end] for one summary message, unless they changed since they were summarized """
+		current = self.messages[start:end]
+		if len(current) != len(summarized) or any(a is not b for a, b in zip(current, summarized)):
+			return False
+
+		self.messages[start:end] = [ContextMessage("system", summary)]
+		self._snapshot()
+		return True
+
+	def attach_journal(self, journal):
+		""" Pick up the conversation where the journal left off and record every change into it from here on """
+		messages = journal.restore()
+		if messages:
+			self.messages = [ContextMessage(message["role"], message["content"], message.get("condensed")) for message in messages]
+			print(f"[context] restored {len(messages)} messages from {journal.path}")
+
+		self.journal = journal
+		if not messages:
+			self._snapshot()
+
+	def _snapshot(self):
+		# Restoring starts from the newest snapshot, so anything that drops messages writes one, and so does every snapshot_every records
+		if self.journal:
+			condensed = [[i, message.condensed.content] for i, message in enumerate(self.messages) if message.condensed]
+			self.journal.append_snapshot(
+				b'{"op":"snapshot","messages":[' + b",".join([message.json for message in self.messages]) + b"]"
+				+ b',"condensed":' + json.dumps(condensed, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"}"
+			)
 
 	def get(self, index: int):
 		""" Get a specific message """
 		return self.messages[index]
 
-	def slice(start: int, end: int) -> list[dict[str, str]]:
+	def slice(self, start: int, end: int) -> list[ContextMessage]:
 		""" Slice a part of the prompt, while also preserving the system prompt """
 		if start <= 1:
 			start = 1
 		out = [ self.messages[0] ]
-		out.append(self.messages[start:end])
-		return out
\ No newline at end of file
+		out.extend(self.messages[start:end])
+		return out
+
+	async def count_tokens(self, tokenize) -> int:
+		""" Tokenize any messages without a cached count, returns the prompt's total token count """
+		pending = [(message, message.content) for message in self._sent_messages() if message.tokens is None]
+
+		if pending:
+			results = await asyncio.gather(*(tokenize(content) for _, content in pending), return_exceptions=True)
+
+			# The content may have changed while tokenizing, only cache counts that are still current
+			for (message, content), result in zip(pending, results):
+				if message.content is not content:
+					continue
+				if isinstance(result, BaseException):
+					print(f"[context] tokenize failed, estimating: {result}")
+					continue
+				message.tokens = len(result)
+
+		return self.token_total()
+
+	def token_total(self) -> int:
+		return sum(self._tokens(message) for message in self._sent_messages())
+
+	def tokens_between(self, start: int, end: int) -> int:
+		""" Tokens messages[start:end] take up in the prompt, condensed where they are sent condensed """
+		return sum(self._tokens(message) for message in self._sent_messages()[start:end])
+
+	async def fit_budget(self, tokenize) -> int:
+		""" Trim the oldest turns so the prompt fits the token budget, returns how many messages were dropped """
+		if self.token_budget <= 0:
+			return 0
+
+		total = await self.count_tokens(tokenize)
+		if total <= self.token_budget:
+			return 0
+
+		# Dropping well below the budget in one cut keeps the new prefix byte-stable for the following turns,
+		# trimming a message per turn would shift the prefix and defeat --cache-reuse every time
+		target = int(self.token_budget * self.trim_target)
+		sent = self._sent_messages()
+		cut = 1
+		last = len(self.messages) - 1
+		while cut < last and total > target:
+			total -= self._tokens(sent[cut])
+			cut += 1
+
+		# Only cut at the start of a user turn so replies and function results are never orphaned
+		while cut < last and self.messages[cut].role != "user":
+			cut += 1
+
+		if cut <= 1:
+			return 0
+
+		dropped = cut - 1
+		self.messages = [ self.messages[0] ] + self.messages[cut:]
+		self._snapshot()
+		print(f"[context] trimmed {dropped} messages, {self.token_total()} of {self.token_budget} tokens used")
+		return dropped
+
+	def _tokens(self, message: ContextMessage) -> int:
+		return (message.tokens if message.tokens is not None else _estimate_tokens(message.content)) + self.message_overhead
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import mmap
+import os
+import struct
+
+from pathlib import Path
+
+# Every record is framed by its length on both sides so the journal can be read backwards from the end
+_LENGTH = struct.Struct("<I")
+_FRAME = _LENGTH.size * 2
+
+# Record ops
+ADD = "add"
+SYSTEM = "system"
+SNAPSHOT = "snapshot"
+
+class ConversationJournal:
+	""" Append-only log of every context mutation, restored by replaying from the last snapshot """
+	def __init__(self, path: str | Path, flush_interval: float = 0.25, snapshot_every: int = 256, max_bytes: int = 16 * 1024 * 1024):
+		self.path = Path(path)
+		self.flush_interval = flush_interval
+		# Records replayed on restore are bounded by a snapshot every so many, the file by rewriting it from one
+		self.snapshot_every = snapshot_every
+		self.max_bytes = max_bytes
+		self.since_snapshot = 0
+
+		self._pending: list[bytes] = []
+		self._wakeup: asyncio.Event | None = None
+		self._task: asyncio.Task | None = None
+		# The write on its worker thread, cancelling the flush that started it doesn't stop it
+		self._writing: asyncio.Future | None = None
+		# The next flush starts a new file, everything before its snapshot is history
+		self._rewrite = False
+
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		self._file = open(self.path, "ab")
+		self._truncate_torn_tail()
+		self.size = self.path.stat().st_size
+
+	def append(self, record: dict):
+		self.append_raw(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+	def append_raw(self, payload: bytes):
+		""" Append a record that is already encoded JSON """
+		header = _LENGTH.pack(len(payload))
+		self._pending.append(header + payload + header)
+		self.size += len(payload) + _FRAME
+		self.since_snapshot += 1
+		if self._wakeup:
+			self._wakeup.set()
+
+	def append_snapshot(self, payload: bytes):
+		""" Append an encoded snapshot record, past max_bytes the journal is rewritten to start with it """
+		if self.size > self.max_bytes:
+			self._pending = []
+			self.size = 0
+			self._rewrite = True
+		self.append_raw(payload)
+		self.since_snapshot = 0
+
+	@property
+	def snapshot_due(self) -> bool:
+		return self.since_snapshot >= self.snapshot_every
+
+	def start(self):
+		""" Flush in the background from here on, records appended before are written with the first flush """
+		if self._task is None:
+			self._wakeup = asyncio.Event()
+			self._task = asyncio.create_task(self._flush_loop())
+
+	async def close(self):
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+		# The final flush must not interleave with a batch still being written
+		if self._writing:
+			try:
+				await self._writing
+			except OSError as e:
+				print(f"[journal] write failed: {e}")
+		await self.flush()
+		self._file.close()
+
+	async def flush(self):
+		if not self._pending:
+			return
+		data = b"".join(self._pending)
+		self._pending = []
+		rewrite, self._rewrite = self._rewrite, False
+		self._writing = asyncio.ensure_future(asyncio.to_thread(self._write, data, rewrite))
+		await asyncio.shield(self._writing)
+
+	def _write(self, data: bytes, rewrite: bool = False):
+		if rewrite:
+			# The old file stays whole until the new one, starting at a snapshot, replaces it
+			temporary = self.path.with_suffix(".tmp")
+			with open(temporary, "wb") as file:
+				file.write(data)
+				file.flush()
+				os.fsync(file.fileno())
+			os.replace(temporary, self.path)
+			self._file.close()
+			self._file = open(self.path, "ab")
+			return
+		self._file.write(data)
+		self._file.flush()
+		os.fsync(self._file.fileno())
+
+	async def _flush_loop(self):
+		while True:
+			await self._wakeup.wait()
+			self._wakeup.clear()
+			try:
+				await self.flush()
+			except OSError as e:
+				print(f"[journal] write failed: {e}")
+			# Batch whatever else arrives in the meantime into the next write
+			await asyncio.sleep(self.flush_interval)
+
+	def _truncate_torn_tail(self):
+		""" Drop a record cut short by a crash so new records don't land behind garbage """
+		size = self.path.stat().st_size
+		end = _valid_end(self.path, size)
+		if end < size:
+			print(f"[journal] dropping {size - end} bytes of a torn record from {self.path}")
+			self._file.truncate(end)
+
+	def restore(self) -> list[dict] | None:
+		""" The messages as of the last record, None for an empty journal """
+		size = self.path.stat().st_size
+		if size == 0:
+			return None
+
+		with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+			# Walk back to the newest snapshot, everything before it is history that no longer matters
+			records = []
+			end = size
+			while end > 0:
+				length = _LENGTH.unpack_from(view, end - _LENGTH.size)[0]
+				start = end - _FRAME - length
+				record = json.loads(view[start + _LENGTH.size:end - _LENGTH.size])
+				records.append(record)
+				end = start
+				if record["op"] == SNAPSHOT:
+					break
+
+		messages = []
+		for record in reversed(records):
+			op = record["op"]
+			if op == SNAPSHOT:
+				messages = record["messages"]
+				for index, condensed in record.get("condensed", []):
+					messages[index]["condensed"] = condensed
+			elif op == ADD:
+				messages.append({"role": record["role"], "content": record["content"], "condensed": record.get("condensed")})
+			elif op == SYSTEM and messages:
+				messages[0] = {"role": "system", "content": record["content"]}
+		return messages
+
+def _valid_end(path: Path, size: int) -> int:
+	""" Offset just past the last complete record """
+	if size == 0:
+		return 0
+
+	with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+		# The common case, the last record's two length fields agree
+		if size >= _FRAME:
+			length = _LENGTH.unpack_from(view, size - _LENGTH.size)[0]
+			start = size - _FRAME - length
+			if start >= 0 and _LENGTH.unpack_from(view, start)[0] == length:
+				return size
+
+		# Otherwise walk forward over the intact records
+		offset = 0
+		while offset + _FRAME <= size:
+			length = _LENGTH.unpack_from(view, offset)[0]
+			end = offset + _FRAME + length
+			if end > size or _LENGTH.unpack_from(view, end - _LENGTH.size)[0] != length:
+				break
+			offset = end
+		return offset
@@ -1,5 +1,7 @@
 import re
 import asyncio
+import time
+import traceback
 import uuid
 
 from typing import Literal
@@ -10,8 +12,9 @@ from pydantic import BaseModel, Field
 from .EventBus import Event
 from .Message import Message
 from .Metrics import Metrics, Unit
-from .LLM import LLMHyperparameters
+from .GenerationScheduler import USER_GENERATION, FUNCTION_GENERATION, SPONTANEOUS_GENERATION
 from .STT import STTHyperparameters
+from .StopSequences import StopSequences
 from .StreamOutputHandler import StreamOutputHandler
 from .StreamingDelimiterParser import DelimiterRule, StreamingDelimiterParser
 
@@ -21,6 +24,7 @@ DELIMITERS = [
 	DelimiterRule(FUNCTION_STATE, "`", "`"),
 	DelimiterRule(THINKING_STATE, "<thinking>", "<thinking>")
 ]
+RULES_BY_NAME = {rule.name: rule for rule in DELIMITERS}
 CONTROL_FLOW = "__NO_RETURN__"
 
 def normalise(text) -> str:
@@ -40,8 +44,12 @@ def preprocess_transcription(text: str) -> str:
 	text = re.sub(r'\[.*?\]|\(.*?\)|\*.*?\*', '', text)
 	return text.strip()
 
-def format_functions(funcs):
-	return f"\n - {'\n - '.join(funcs)}" if funcs else ""
+def partial_response(raw: str, text_marks: list[tuple[int, int]], delivered: int) -> str:
+	""" Cut the raw response where the delivered text ends, text_marks holds (text chars so far, raw end) per text chunk """
+	for text_chars, raw_end in text_marks:
+		if text_chars >= delivered:
+			return raw[:raw_end - (text_chars - delivered)]
+	return raw
 
 class Schema_BaseEvent(BaseModel):
 	event: str
@@ -64,6 +72,10 @@ class Schema_MessageEvent(Schema_BaseEvent):
 	tag: str | None
 	message: str | None
 
+class Schema_CancelEvent(Schema_BaseEvent):
+	event: Literal["cancel"]
+	generation_id: str | None = None
+
 class Schema_FunctionResultEvent(Schema_BaseEvent):
 	event: Literal["function"]
 	client_id: str
@@ -95,19 +107,46 @@ class ClientDisconnectEvent(Event):
 			user_data.function_registry.remove_client(client_name)
 			user_data.event_bus.push_event(RebuildPromptEvent())
 
-# Runs a rebuild prompt event, Includes compaction logic
+# Runs a rebuild prompt event, compaction of old turns is left to the Compactor
 class RebuildPromptEvent(Event):
+	def __init__(self, restore_snapshot: str | None = None):
+		# Why the snapshot is being restored, None skips it
+		self.restore_snapshot = restore_snapshot
+
+	async def process(self, user_data):
+		now = datetime.now()
+		user_data.system_prompt_replacements = user_data.prompt_layout.replacements(now, user_data.function_registry.functions_text())
+		changed = user_data.context.update_system_prompt_replacements(user_data.system_prompt_replacements)
+		user_data.context.ephemeral = user_data.prompt_layout.ephemeral(now)
+
+		# Loading a saved KV snapshot of the system prompt is much cheaper than prefilling it
+		if self.restore_snapshot:
+			await user_data.snapshots.restore(self.restore_snapshot)
+
+		# Prefill the rewritten system prompt now instead of on the next user turn
+		if changed or self.restore_snapshot:
+			user_data.warmer.warm("prompt rebuild")
+
+# Drop the conversation and start again from the system prompt
+class ResetContextEvent(Event):
 	def __init__(self):
 		pass
 
 	async def process(self, user_data):
-		now = datetime.now()
-		user_data.system_prompt_replacements = {
-			"<date>": now.strftime("%Y-%m-%d"),
-			"<time>": now.strftime("%I:%M %p"),
-			"<functions>": format_functions(user_data.function_registry.get_all_functions())
-		}
-		user_data.context.update_system_prompt_replacements(user_data.system_prompt_replacements)
+		await asyncio.gather(*user_data.scheduler.cancel_all("context reset"), return_exceptions=True)
+		user_data.context.reset()
+		user_data.event_bus.push_event(RebuildPromptEvent(restore_snapshot="reset"))
+
+# Runs on a client asking to stop a generation, all of them if no id is given
+class CancelGenerationEvent(Event):
+	def __init__(self, payload):
+		self.generation_id = payload.get("generation_id")
+
+	async def process(self, user_data):
+		if self.generation_id:
+			user_data.scheduler.cancel(self.generation_id, "client cancel")
+		else:
+			user_data.scheduler.cancel_all("client cancel")
 
 # A message injected by a client, only previleged clients can send system messages
 class MessageInjectEvent(Event):
@@ -134,8 +173,10 @@ class ClientMessageEvent(Event):
 
 		# Decode the message
 		if msg.input_type == "audio":
+			# The context up to this turn is already final, prefill it while the audio is transcribed
+			user_data.warmer.warm("transcription")
 			with metrics.time("decode", Unit.MILLISECONDS):
-				msg.message_str = user_data.stt.transcribe(STTHyperparameters(), msg.message)
+				msg.message_str = await asyncio.to_thread(user_data.stt.transcribe, STTHyperparameters(), msg.message)
 		else:
 			msg.message_str = msg.message or ""
 
@@ -148,6 +189,13 @@ class ClientMessageEvent(Event):
 		if not msg.message_str and msg.input_type != "none":
 			return
 
+		# Barge-in, stop talking over the user and let the cancelled generations commit what was said first
+		if msg.input_type in user_data.barge_in:
+			# A summary in progress isn't talking over anyone, a new turn preempts it if it needs the slot
+			cancelled = user_data.scheduler.cancel_all("barge-in", {USER_GENERATION, FUNCTION_GENERATION, SPONTANEOUS_GENERATION})
+			if cancelled:
+				await asyncio.gather(*cancelled, return_exceptions=True)
+
 		# Get the post processed form to send to context
 		post_processed = msg.post_process()
 		
@@ -157,7 +205,8 @@ class ClientMessageEvent(Event):
 		print(f"[{user_data.client_manager.get_client_name_from_id(msg.client_id)}] {post_processed if msg.input_type != 'none' else 'spontaneous generation'}")
 
 		if msg.output:
-			user_data.event_bus.push_event(GenerationEvent(metrics))
+			kind = USER_GENERATION if msg.input_type != "none" else SPONTANEOUS_GENERATION
+			user_data.event_bus.push_event(GenerationEvent(metrics, kind))
 		else:
 			user_data.context.push_assistant("<silence>")
 
@@ -176,13 +225,13 @@ class FunctionReturnEvent(Event):
 
 		if result is not None:
 			print(output)
-			user_data.context.push_system(output)
+			user_data.context.push_function_return(output)
 
 		resolved = user_data.barriers.resolve(function_id)
 
 		if resolved:
 			metrics = Metrics()
-			user_data.event_bus.push_event(GenerationEvent(metrics))
+			user_data.event_bus.push_event(GenerationEvent(metrics, FUNCTION_GENERATION))
 
 # Spontaneous generation events caused by wait timers
 class SpontaneousGenerationEvent(Event):
@@ -191,154 +240,257 @@ class SpontaneousGenerationEvent(Event):
 
 	async def process(self, user_data):
 		metrics = Metrics()
-		user_data.event_bus.push_event(GenerationEvent(metrics))
+		user_data.event_bus.push_event(GenerationEvent(metrics, SPONTANEOUS_GENERATION))
 
 # Start a generation with whatever context we have atm
 class GenerationEvent(Event):
-	def __init__(self, metrics):
+	def __init__(self, metrics, kind: str = USER_GENERATION):
 		# Piggy back off the old metrics
 		self.metrics = metrics
+		self.kind = kind
 
 	async def process(self, user_data):
-		print(f"{user_data.config['name']}: ", end="")
-
-		self.metrics.start_timer("ttft")
+		# Generations run beside the event bus so slots can stream concurrently
+		user_data.scheduler.track(asyncio.create_task(self._generate(user_data)))
 
+	async def _generate(self, user_data):
 		generation_id = f"gid-{uuid.uuid4().hex[:12]}"
 
-		handler = StreamOutputHandler(generation_id, user_data.ws, user_data.tts, user_data.client_manager.get_client_modalities())
+		# Time spent waiting for a slot counts towards ttft, it is just as much a delay to the listener
+		self.metrics.start_timer("ttft")
+		with self.metrics.time("queue"):
+			ticket = await user_data.scheduler.acquire(generation_id, self.kind)
+		if ticket is None:
+			self.metrics.discard_timer("ttft")
+			return
+
+		try:
+			await self._stream(user_data, generation_id, ticket)
+		except asyncio.CancelledError:
+			print(f"\n[{generation_id}] {ticket.cancel_reason or 'cancelled'}")
+			raise
+		except Exception as e:
+			print(f"Error while generating {generation_id}: {e}")
+			traceback.print_exc()
+		finally:
+			user_data.scheduler.release(ticket)
+
+	async def _stream(self, user_data, generation_id, ticket):
+		started = time.perf_counter()
+
+		handler = StreamOutputHandler(generation_id, user_data.ws, user_data.tts_worker, user_data.client_manager.get_client_modalities(), user_data.stream_output)
 		parser = StreamingDelimiterParser(DELIMITERS)
+		silence_token = user_data.config["chat"].get("silence_token", "<silence>")
+		stops = StopSequences([silence_token, *user_data.config["chat"].get("stop_sequences", [])])
+
+		user_data.context.ephemeral = user_data.prompt_layout.ephemeral(datetime.now())
+		await user_data.context.fit_budget(user_data.llm.tokenize)
+
+		# A single token decides whether this turn is worth a full generation
+		decision = None
+		if user_data.turn_gate.applies(self.kind):
+			decision = await user_data.turn_gate.check(user_data.context.prompt_json(), ticket)
+			if decision:
+				self.metrics.add_metrics("gate", decision.latency, Unit.MILLISECONDS)
+				if decision.silent and not decision.audited:
+					# No token is ever streamed, a ttft here would be meaningless
+					self.metrics.discard_timer("ttft")
+					user_data.context.push_assistant(silence_token)
+					self._record_metrics(user_data, generation_id, ticket, started, [], 0, {})
+					return
+
+		print(f"{user_data.config['name']}: ", end="")
 
-		response = user_data.llm.send_generation_request(user_data.context.prompt(),
-			LLMHyperparameters(
-				temperature=1.0,
-				min_p=0.05,
-				top_k=64,
-				presence_penalty=0.1,
-				repetition_penalty=1.1,
-				repeat_last_n=512,
-
-				# XTC
-				xtc_threshold=0.05,
-				xtc_probability=0.1,
-
-				# DRY sampling
-				dry_multiplier=3.0,
-				dry_base=1.75,
-				dry_allowed_length=3,
-				dry_penalty_last_n=-1,
-				dry_sequence_breakers=[ '\n', ':', '"', '*', '<', '>', "<silence>", "`" ],
-
-				# Misc
-				n_predict=512,
-				logit_bias=[
-					# Encourage shorter responses
-					[ 128009, 0.1 ],
-					# discourage semicolons but still allow for function calls
-					[ ":", -1.0 ],
-					# Discourage her from expressing so much and causing mood swings
-					[ "express", -1.0 ],
-					# Discourage excessive memorising
-					[ "memorise", -2.0 ],
-					# encourage recall 
-					[ "recall", 1.0 ],
-					# Encourage function calls
-					[ "`", 1.0 ]
-				],
-				samplers=[ "penalties", "top_k", "min_p", "xtc", "temperature" ]
-			)
-		)
+		preset = user_data.presets.for_kind(self.kind)
+		await user_data.presets.compile_preset(preset, user_data.llm)
+		response = await user_data.llm.send_preset_request(user_data.context.prompt_json(), preset, id_slot=ticket.slot_id, key=ticket.route)
 
 		function_ids = set()
 		has_control = False
 
+		# The response up to any stop sequence, what the parser has seen
 		accumulated_response = []
+		token_count = 0
+		# The reply without thinking or function blocks, what older turns are condensed to
+		text_response = []
 		function_buffer = []
 		thinking_buffer = []
 
-		for token in user_data.llm.get_streaming_response(response):
-			if token is None:
-				continue
-
-			accumulated_response.append(token)
-			segments = parser.feed(token)
-
-			for event, value, state in segments:
-				if event == "EXIT":
-					if value == FUNCTION_STATE:
-						function_calls = "".join(function_buffer)
-						function_buffer = []
-
-						parsed_calls = user_data.function_registry.parse_calls(function_calls)
-
-						for call in parsed_calls:
-							if not call["async"]:
-								function_ids.add(call["function_id"])
-
-							function_handle = user_data.function_registry.get_handler(f"{call["client"]}:{call["function"]}")
-
-							if function_handle:
-								if asyncio.iscoroutinefunction(function_handle):
-									result = await function_handle(**call["args"])
-								else:
-									result = function_handle(**call["args"])
-
-								if result is CONTROL_FLOW:
-									has_control = True
-									continue
-
-								user_data.event_bus.push_event(FunctionReturnEvent({
-									"client": call["client"],
-									"function": call["function"],
-									"function_id": call["function_id"],
-									"result": result
-								}))
-							elif user_data.client_manager.is_client_connected(call["client"]):
-								socket = user_data.client_manager.get_socket(call["client"])
-								if socket:
-									await socket.send_json({
-										"type": "function_call",
-										"function_id": call["function_id"],
+		# Where each streamed text chunk ends in the raw response, so a cancel can commit only what was delivered
+		raw_position = 0
+		text_chars = 0
+		text_marks = []
+
+		stream_info = {}
+		# Seconds between consecutive tokens as Orca received them
+		gaps = []
+		last_token = None
+		try:
+			async for token, text in stops.filter(user_data.llm.get_streaming_response(response, stream_info)):
+				if token is not None:
+					now = time.perf_counter()
+					if last_token is None:
+						self.metrics.stop_timer("ttft")
+					else:
+						gaps.append(now - last_token)
+					last_token = now
+					token_count += 1
+
+				if not text:
+					continue
+				accumulated_response.append(text)
+				segments = parser.feed(text)
+
+				for event, value, state in segments:
+					if event == "ENTER":
+						raw_position += len(RULES_BY_NAME[value].start)
+					elif event == "EXIT":
+						raw_position += len(RULES_BY_NAME[value].end)
+						if value == FUNCTION_STATE:
+							function_calls = "".join(function_buffer)
+							function_buffer = []
+
+							parsed_calls = user_data.function_registry.parse_calls(function_calls)
+
+							for call in parsed_calls:
+								if not call["async"]:
+									function_ids.add(call["function_id"])
+
+								function_handle = user_data.function_registry.get_handler(f"{call["client"]}:{call["function"]}")
+
+								if function_handle:
+									if asyncio.iscoroutinefunction(function_handle):
+										result = await function_handle(**call["args"])
+									else:
+										result = function_handle(**call["args"])
+
+									if result is CONTROL_FLOW:
+										has_control = True
+										continue
+
+									user_data.event_bus.push_event(FunctionReturnEvent({
 										"client": call["client"],
 										"function": call["function"],
-										"args": call["args"],
-									})
-									if not call["return"]:
-										user_data.event_bus.push_event(FunctionReturnEvent({
+										"function_id": call["function_id"],
+										"result": result
+									}))
+								elif user_data.client_manager.is_client_connected(call["client"]):
+									socket = user_data.client_manager.get_socket(call["client"])
+									if socket:
+										await socket.send_json({
+											"type": "function_call",
+											"function_id": call["function_id"],
 											"client": call["client"],
 											"function": call["function"],
-											"function_id": call["function_id"],
-											"result": None
-										}))
-							else:
-								user_data.event_bus.push_event(FunctionReturnEvent({
-									"client": call["client"],
-									"function": "error",
-									"function_id": call["function_id"],
-									"result": f"Invalid function call: {function_calls}",
-								}))
-					elif value == THINKING_STATE:
-						thinking_trace = "".join(thinking_buffer)
-						thinking_buffer = []
-				elif event == "CHUNK":
-					if state == "TEXT":
-						await handler.handle_token(value)
-					elif state == FUNCTION_STATE:
-						function_buffer.append(value)
-					elif state == THINKING_STATE:
-						thinking_buffer.append(value)
-			print(token, end='', flush=(len(accumulated_response) % 5 == 0))
-
-		if not has_control and len(function_ids) > 0:
-			user_data.barriers.create_barrier(generation_id, function_ids)
-			asyncio.create_task(self._timeout_generation(user_data, generation_id, 1.0))
-
-		# Finish the response
-		await handler.finalize()
-		await handler.send_finish_token()
+											"args": call["args"],
+										})
+										if not call["return"]:
+											user_data.event_bus.push_event(FunctionReturnEvent({
+												"client": call["client"],
+												"function": call["function"],
+												"function_id": call["function_id"],
+												"result": None
+											}))
+								else:
+									user_data.event_bus.push_event(FunctionReturnEvent({
+										"client": call["client"],
+										"function": "error",
+										"function_id": call["function_id"],
+										"result": f"Invalid function call: {function_calls}",
+									}))
+						elif value == THINKING_STATE:
+							thinking_trace = "".join(thinking_buffer)
+							thinking_buffer = []
+					elif event == "CHUNK":
+						raw_position += len(value)
+						if state == "TEXT":
+							text_chars += len(value)
+							text_marks.append((text_chars, raw_position))
+							text_response.append(value)
+							await handler.handle_token(value)
+						elif state == FUNCTION_STATE:
+							function_buffer.append(value)
+						elif state == THINKING_STATE:
+							thinking_buffer.append(value)
+				print(text, end='', flush=(token_count % 5 == 0))
+
+			if not has_control and len(function_ids) > 0:
+				user_data.barriers.create_barrier(generation_id, function_ids)
+				asyncio.create_task(self._timeout_generation(user_data, generation_id, 1.0))
+
+			# The model chose not to answer, nothing of it is spoken or sent
+			silent = stops.matched == silence_token and not "".join(accumulated_response).strip()
+
+			# Finish the response, barge-in mostly lands here while the speech is still being sent
+			if not silent:
+				await handler.finalize()
+				await handler.send_finish_token()
+			elif handler.sent_text_chars:
+				await handler.send_finish_token()
+		except asyncio.CancelledError:
+			await handler.cancel()
+			delivered = handler.delivered_chars(text_chars)
+			partial = partial_response("".join(accumulated_response), text_marks, delivered)
+			if partial.strip():
+				user_data.context.push_assistant(partial, "".join(text_response)[:delivered])
+			print("")
+			handler.add_metrics(self.metrics)
+			self._record_metrics(user_data, generation_id, ticket, started, gaps, token_count, stream_info)
+			raise
+
 		print("")
-		if len(accumulated_response) > 0:
-			user_data.context.push_assistant("".join(accumulated_response))
+		if stops.matched is not None:
+			print(f"[{generation_id}] stopped on {stops.matched!r}")
+
+		handler.add_metrics(self.metrics)
+		self._record_metrics(user_data, generation_id, ticket, started, gaps, token_count, stream_info)
+
+		user_data.turn_gate.record(decision, silent)
+		if silent:
+			user_data.context.push_assistant(silence_token)
+		elif len(accumulated_response) > 0:
+			# A function call followed by silence keeps both, the call may have opened a barrier
+			raw = "".join(accumulated_response) + (silence_token if stops.matched == silence_token else "")
+			user_data.context.push_assistant(raw, "".join(text_response))
+		user_data.compactor.schedule("turn")
+
+		# The continuation after the barrier resolves will extend this exact context
+		if user_data.barriers.get_outstanding(generation_id):
+			user_data.warmer.warm("function barrier", FUNCTION_GENERATION)
+
+	def _record_metrics(self, user_data, generation_id, ticket, started, gaps, tokens, stream_info):
+		""" Orca's view of the stream next to llama-server's timings, so slowness can be pinned on prefill, decode or the pipeline """
+		total = (time.perf_counter() - started) * 1000
+		self.metrics.add_metrics("total", total, Unit.MILLISECONDS)
+		self.metrics.set_count("tokens", tokens)
+		if gaps:
+			gaps = sorted(gaps)
+			self.metrics.add_metrics("gap_mean", sum(gaps) / len(gaps) * 1000, Unit.MILLISECONDS)
+			self.metrics.add_metrics("gap_p95", gaps[int(len(gaps) * 0.95)] * 1000, Unit.MILLISECONDS)
+			self.metrics.add_metrics("gap_max", gaps[-1] * 1000, Unit.MILLISECONDS)
+
+		timings = stream_info.get("timings") or {}
+		if "prompt_ms" in timings:
+			self.metrics.add_metrics("prefill", timings["prompt_ms"], Unit.MILLISECONDS)
+			self.metrics.add_metrics("prefill_rate", timings.get("prompt_per_second", 0), Unit.PER_SECOND)
+		if "predicted_ms" in timings:
+			self.metrics.add_metrics("decode", timings["predicted_ms"], Unit.MILLISECONDS)
+			self.metrics.add_metrics("decode_rate", timings.get("predicted_per_second", 0), Unit.PER_SECOND)
+			# Whatever the server can't account for was spent in Orca or on the wire
+			self.metrics.add_metrics("pipeline", total - timings.get("prompt_ms", 0) - timings["predicted_ms"], Unit.MILLISECONDS)
+
+		# How much of the prompt llama-server found in its cache instead of prefilling
+		cached, prefilled = timings.get("cache_n"), timings.get("prompt_n")
+		if cached is not None and prefilled is not None:
+			self.metrics.set_count("prompt_n", prefilled)
+			self.metrics.set_count("cache_n", cached)
+			if cached + prefilled > 0:
+				self.metrics.add_metrics("prefix_cache", cached / (cached + prefilled) * 100, Unit.PERCENT)
+			# The slot now holds the whole prompt plus the reply
+			user_data.scheduler.record_tokens(ticket, cached + prefilled + timings.get("predicted_n", 0))
+
+		user_data.generation_metrics.record(generation_id, self.kind, self.metrics)
+		self.metrics.print(label=generation_id)
 
 	async def _timeout_generation(self, user_data, gid, timeout):
 		await asyncio.sleep(timeout)
@@ -353,4 +505,4 @@ class GenerationEvent(Event):
 
 		user_data.barriers.clear_barrier(gid)
 
-		user_data.event_bus.push_event(GenerationEvent(Metrics()))
\ No newline at end of file
+		user_data.event_bus.push_event(GenerationEvent(Metrics(), FUNCTION_GENERATION))
\ No newline at end of file
@@ -9,6 +9,9 @@ class FunctionRegistry:
 		self._registry: dict[str, dict] = {}
 		self._docs_by_client: dict[str, list[str]] = {}
 		self._handlers: dict[str, callable] = {}
+		# Each client's rendered block of the <functions> listing, joined lazily
+		self._listing_by_client: dict[str, str] = {}
+		self._listing: str | None = ""
 
 	def register_client(self, client_name: str, func_docs: list[str]) -> None:
 		# Drop any old entries for this client
@@ -19,6 +22,8 @@ class FunctionRegistry:
 
 		namespaced_docs = self._namespace_functions(client_name, func_docs)
 		self._docs_by_client[client_name] = namespaced_docs
+		self._listing_by_client[client_name] = "".join(f"\n - {doc}" for doc in namespaced_docs)
+		self._listing = None
 
 		for doc in namespaced_docs:
 			text = doc.strip()
@@ -42,17 +47,26 @@ class FunctionRegistry:
 
 	def remove_client(self, client_name: str) -> None:
 		self._docs_by_client.pop(client_name, None)
+		if self._listing_by_client.pop(client_name, None) is not None:
+			self._listing = None
 
 		to_del = [k for k, meta in self._registry.items() if meta.get("client") == client_name]
 		for k in to_del:
 			self._registry.pop(k, None)
 
 	def get_all_functions(self) -> list[str]:
+		# Ordered by client name rather than connection order so reconnects don't reshuffle the prompt
 		out: list[str] = []
-		for docs in self._docs_by_client.values():
-			out.extend(docs)
+		for client_name in sorted(self._docs_by_client):
+			out.extend(self._docs_by_client[client_name])
 		return out
 
+	def functions_text(self) -> str:
+		""" The <functions> listing, only rebuilt from the per-client blocks after a client changed """
+		if self._listing is None:
+			self._listing = "".join(self._listing_by_client[name] for name in sorted(self._listing_by_client))
+		return self._listing
+
 	def parse_calls(self, raw_call: str) -> list[dict]:
 		text = raw_call.strip()
 		text = text.strip("`")
@@ -0,0 +1,341 @@
+import asyncio
+import itertools
+import time
+
+from dataclasses import dataclass, field
+from typing import Callable
+
+USER_GENERATION = "user"
+FUNCTION_GENERATION = "function"
+SPONTANEOUS_GENERATION = "spontaneous"
+# Background summaries of old turns, only ever run on an otherwise idle slot
+COMPACTION_GENERATION = "compaction"
+# Prefills ahead of a generation, always give way to anything else
+WARM_GENERATION = "warm"
+
+@dataclass
+class GenerationSchedulerConfig:
+	# Must match llama-server's --parallel
+	slots: int = 1
+
+	# Higher priorities are dispatched first and may preempt lower ones
+	priorities: dict[str, int] = field(default_factory=lambda: {
+		USER_GENERATION: 2,
+		FUNCTION_GENERATION: 1,
+		SPONTANEOUS_GENERATION: 0,
+		COMPACTION_GENERATION: -1,
+		WARM_GENERATION: -2
+	})
+	preempt: bool = True
+
+	# How many generations of a kind may wait for a slot, -1 is unbounded and 0 only admits if a slot is free
+	max_queued: dict[str, int] = field(default_factory=lambda: {
+		USER_GENERATION: -1,
+		FUNCTION_GENERATION: -1,
+		SPONTANEOUS_GENERATION: 0,
+		COMPACTION_GENERATION: 0,
+		WARM_GENERATION: 0
+	})
+
+	# Kinds sharing a pin group prefer the same slot, so the conversation's KV cache stays warm
+	pins: dict[str, str] = field(default_factory=lambda: {
+		USER_GENERATION: "conversation",
+		FUNCTION_GENERATION: "conversation",
+		SPONTANEOUS_GENERATION: "spontaneous",
+		COMPACTION_GENERATION: "spontaneous"
+	})
+
+class Slot:
+	def __init__(self, slot_id: int, backend: str | None = None, server_id: int | None = None):
+		self.slot_id = slot_id
+		# The LLM backend this slot lives on and its id there, None routes by pin group instead
+		self.backend = backend
+		self.server_id = slot_id if server_id is None else server_id
+		self.pinned: str | None = None
+		self.active: "GenerationTicket | None" = None
+
+		self.generations = 0
+		self.busy_time = 0.0
+		self.last_used = 0.0
+
+		# Tokens in the slot's KV cache after its last generation
+		self.n_tokens: int | None = None
+
+class GenerationTicket:
+	def __init__(self, generation_id: str, kind: str, key: str, priority: int, seq: int):
+		self.generation_id = generation_id
+		self.kind = kind
+		self.key = key
+		self.priority = priority
+		self.seq = seq
+
+		self.slot: Slot | None = None
+		self.task: asyncio.Task | None = None
+		# Set when the generation is cancelled, e.g. "preempted" or "barge-in"
+		self.cancel_reason: str | None = None
+		self.granted = asyncio.get_running_loop().create_future()
+		self.started = 0.0
+
+	@property
+	def slot_id(self) -> int:
+		""" The id llama-server knows the slot by """
+		return self.slot.server_id if self.slot else -1
+
+	@property
+	def route(self) -> str:
+		""" Routing key for the LLM pool, the slot's own backend when it has one """
+		return self.slot.backend if self.slot and self.slot.backend else self.key
+
+class GenerationScheduler:
+	def __init__(self, config: GenerationSchedulerConfig):
+		self.config = config
+		self.slots = [Slot(i) for i in range(max(1, config.slots))]
+		self.waiting: list[GenerationTicket] = []
+		self._seq = itertools.count()
+		self._created = time.time()
+		self._tasks = set()
+		self._available: Callable[[str], bool] | None = None
+		self._retry: asyncio.TimerHandle | None = None
+		# Called with the slot and the kind of whatever just took it over
+		self._used_callbacks: list[Callable[[Slot, str], None]] = []
+
+	def set_backends(self, backends: dict[str, int], available: Callable[[str], bool]):
+		""" Give every backend its own slots, capacity is the sum of them """
+		self.slots = []
+		for name, count in backends.items():
+			for server_id in range(max(1, count)):
+				self.slots.append(Slot(len(self.slots), name, server_id))
+		self._available = available
+
+	def track(self, task: asyncio.Task) -> asyncio.Task:
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+		return task
+
+	def on_slot_used(self, callback: Callable[[Slot, str], None]):
+		self._used_callbacks.append(callback)
+
+	def slot_used(self, slot: Slot, kind: str):
+		""" Tell listeners the slot's KV cache now holds something else """
+		for callback in self._used_callbacks:
+			callback(slot, kind)
+
+	def idle_slot(self, kind: str) -> Slot | None:
+		""" The slot a generation of this kind would be given right now, None if none is free """
+		return self._pick(self.config.pins.get(kind, kind))
+
+	def _usable(self, slot: Slot) -> bool:
+		return slot.backend is None or self._available is None or self._available(slot.backend)
+
+	def active(self) -> list[GenerationTicket]:
+		return [slot.active for slot in self.slots if slot.active]
+
+	def cancel(self, generation_id: str, reason: str = "cancelled") -> bool:
+		for ticket in self.active() + self.waiting:
+			if ticket.generation_id == generation_id:
+				self._cancel_ticket(ticket, reason)
+				return True
+		return False
+
+	def cancel_all(self, reason: str = "cancelled", kinds: set[str] | None = None) -> list[asyncio.Task]:
+		""" Cancel every matching generation, returns their tasks so callers can wait for them to unwind """
+		tickets = [t for t in self.active() + self.waiting if kinds is None or t.kind in kinds]
+		for ticket in tickets:
+			self._cancel_ticket(ticket, reason)
+		return [t.task for t in tickets if t.task and t.task is not asyncio.current_task()]
+
+	def _cancel_ticket(self, ticket: GenerationTicket, reason: str):
+		if ticket.cancel_reason:
+			return
+		ticket.cancel_reason = reason
+		if ticket.task and not ticket.task.done():
+			ticket.task.cancel()
+
+	async def acquire(self, generation_id: str, kind: str, key: str | None = None) -> GenerationTicket | None:
+		""" Wait for a slot, returns None if the generation was not admitted """
+		ticket = GenerationTicket(
+			generation_id,
+			kind,
+			key or self.config.pins.get(kind, kind),
+			self.config.priorities.get(kind, 0),
+			next(self._seq)
+		)
+		ticket.task = asyncio.current_task()
+
+		if not self._admit(ticket):
+			print(f"[scheduler] rejected {kind} generation {generation_id}")
+			return None
+
+		self.waiting.append(ticket)
+		self._dispatch()
+
+		if not ticket.granted.done():
+			self._maybe_preempt(ticket)
+
+		try:
+			await ticket.granted
+		except asyncio.CancelledError:
+			if ticket in self.waiting:
+				self.waiting.remove(ticket)
+			elif ticket.slot:
+				self.release(ticket)
+			raise
+
+		return ticket
+
+	def release(self, ticket: GenerationTicket):
+		slot = ticket.slot
+		if not slot or slot.active is not ticket:
+			return
+
+		now = time.time()
+		slot.busy_time += now - ticket.started
+		slot.last_used = now
+		slot.active = None
+		ticket.slot = None
+
+		self._dispatch()
+
+	def record_tokens(self, ticket: GenerationTicket, n_tokens: int):
+		if ticket.slot:
+			ticket.slot.n_tokens = n_tokens
+
+	def _admit(self, ticket: GenerationTicket) -> bool:
+		limit = self.config.max_queued.get(ticket.kind, -1)
+		if limit < 0:
+			return True
+
+		queued = sum(1 for waiting in self.waiting if waiting.kind == ticket.kind)
+		if queued < limit:
+			return True
+
+		# A free slot admits the generation even when it isn't allowed to queue, so does one a warm would give up
+		return queued == 0 and (self._free_slot(ticket) is not None or self._warm_slot(ticket) is not None)
+
+	def _free_slot(self, ticket: GenerationTicket) -> Slot | None:
+		return self._pick(ticket.key)
+
+	def _warm_slot(self, ticket: GenerationTicket) -> Slot | None:
+		""" A slot held by a warm that gives way to this ticket, its own pin group's first """
+		if ticket.kind == WARM_GENERATION:
+			return None
+		held = [slot for slot in self.slots if slot.active and slot.active.kind == WARM_GENERATION and self._usable(slot)]
+		for slot in held:
+			if slot.pinned == ticket.key:
+				return slot
+		return held[0] if held else None
+
+	def _pick(self, key: str) -> Slot | None:
+		free = [slot for slot in self.slots if slot.active is None and self._usable(slot)]
+		if not free:
+			return None
+
+		# The group's own slot first, its prompt cache is there
+		for slot in free:
+			if slot.pinned == key:
+				return slot
+
+		# Otherwise the backend with the fewest generations in flight, an unclaimed slot there, then the longest idle
+		outstanding = {}
+		for slot in self.slots:
+			if slot.active:
+				outstanding[slot.backend] = outstanding.get(slot.backend, 0) + 1
+		return min(free, key=lambda slot: (outstanding.get(slot.backend, 0), slot.pinned is not None, slot.last_used))
+
+	def _dispatch(self):
+		self.waiting.sort(key=lambda t: (-t.priority, t.seq))
+
+		for ticket in list(self.waiting):
+			# A warm in the group's own slot gives way, waiting for it beats starting in a cold slot
+			warm = self._warm_slot(ticket)
+			slot = None if warm and warm.pinned == ticket.key else self._free_slot(ticket)
+			if slot is None:
+				if warm:
+					self._cancel_ticket(warm.active, "preempted")
+				break
+
+			self.waiting.remove(ticket)
+			if ticket.granted.done():
+				continue
+
+			# Only move a pin when the slot's own group isn't waiting on it
+			if slot.pinned != ticket.key and not any(t.key == slot.pinned for t in self.waiting):
+				slot.pinned = ticket.key
+
+			slot.active = ticket
+			slot.generations += 1
+			ticket.slot = slot
+			ticket.started = time.time()
+			ticket.granted.set_result(slot)
+			self.slot_used(slot, ticket.kind)
+
+		# Slots of a failed backend come back without a release to notice it
+		if self.waiting and self._retry is None and any(slot.active is None and not self._usable(slot) for slot in self.slots):
+			self._retry = asyncio.get_running_loop().call_later(1.0, self._retry_dispatch)
+
+	def _retry_dispatch(self):
+		self._retry = None
+		self._dispatch()
+
+	def _maybe_preempt(self, ticket: GenerationTicket):
+		# A warm is only ever worth keeping while nothing else wants its slot
+		candidates = [
+			active for active in self.active()
+			if active.priority < ticket.priority and not active.cancel_reason and (self.config.preempt or active.kind == WARM_GENERATION)
+		]
+		# A slot is already on its way back
+		if not candidates or any(slot.active.cancel_reason for slot in self.slots if slot.active and self._usable(slot)):
+			return
+
+		victim = min(candidates, key=lambda t: (t.priority, -t.seq))
+		print(f"[scheduler] {ticket.kind} generation {ticket.generation_id} preempts {victim.kind} generation {victim.generation_id}")
+		self._cancel_ticket(victim, "preempted")
+
+	def usage(self) -> list[dict]:
+		elapsed = max(1e-9, time.time() - self._created)
+		now = time.time()
+		out = []
+		for slot in self.slots:
+			busy = slot.busy_time + (now - slot.active.started if slot.active else 0.0)
+			out.append({
+				"slot": slot.slot_id,
+				"backend": slot.backend,
+				"server_slot": slot.server_id,
+				"pinned": slot.pinned,
+				"active": slot.active.kind if slot.active else None,
+				"generation_id": slot.active.generation_id if slot.active else None,
+				"generations": slot.generations,
+				"busy_ratio": busy / elapsed,
+				"n_tokens": slot.n_tokens
+			})
+		return out
+
+	async def report(self, llm) -> list[dict]:
+		""" Scheduler view of every slot, merged with llama-server's own /slots view when available """
+		usage = self.usage()
+		server_slots = {}
+		for backend in {entry["backend"] for entry in usage}:
+			# A drained or failed backend would be answered by another one
+			if backend and not llm.is_available(backend):
+				continue
+			try:
+				for server in await llm.get_slots(backend) if backend else await llm.get_slots():
+					server_slots[(backend, server.get("id"))] = server
+			except Exception as e:
+				print(f"[scheduler] could not read server slots{f' of {backend}' if backend else ''}: {e}")
+
+		for entry in usage:
+			server = server_slots.get((entry["backend"], entry["server_slot"]), {})
+			entry["n_ctx"] = server.get("n_ctx")
+			entry["is_processing"] = server.get("is_processing")
+			# Older llama-servers report how far the slot got themselves
+			if server.get("n_past") is not None:
+				entry["n_tokens"] = server["n_past"]
+			if entry["n_ctx"] and entry["n_tokens"] is not None:
+				entry["fill"] = entry["n_tokens"] / entry["n_ctx"]
+
+		for entry in usage:
+			fill = f"{entry['fill'] * 100:.0f}%" if "fill" in entry else "?"
+			print(f"[scheduler] slot {entry['slot']} backend={entry['backend']} pinned={entry['pinned']} active={entry['active']} generations={entry['generations']} busy={entry['busy_ratio'] * 100:.0f}% fill={fill}")
+		print(f"[scheduler] {len(self.waiting)} waiting")
+		return usage
@@ -1,11 +1,15 @@
-import requests
+import aiohttp
+import asyncio
 import json
+import math
 from pathlib import Path
 
 from dataclasses import dataclass, field
-from typing import Iterator
+from typing import AsyncIterator
 
 from .start_subprocess import start_subprocess
+from .MockLLM import LLMRecorder
+from .SSEParser import SSEParser
 
 @dataclass
 class LLMHyperparameters:
@@ -78,6 +82,11 @@ class LLMHyperparameters:
 			"dry_sequence_breakers": self.dry_sequence_breakers,
 		}
 
+def _messages_json(messages: list[dict] | bytes) -> bytes:
+	if isinstance(messages, bytes):
+		return messages
+	return json.dumps(messages, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
 @dataclass
 class LLMClientConfig:
 	# Executable location
@@ -92,63 +101,253 @@ class LLMClientConfig:
 	model: str = "UnnamedLLM.gguf"
 	alias: str = "UnnamedLLM"
 	context_length: int = 4096
+	# Number of server slots, each can run one generation concurrently
+	parallel: int = 1
+
+	# HTTP client, timeouts are in seconds
+	connect_timeout: float = 5.0
+	read_timeout: float = 60.0
+	pool_size: int = 8
+	keepalive_timeout: float = 60.0
+
+	# Connect to an already running server (e.g. the mock) instead of launching llama-server
+	spawn_server: bool = True
+	# Capture every exchange with per-chunk timing for replay by the mock server
+	record_path: str | None = None
+	# Directory llama-server saves and restores slot KV snapshots in, None disables it
+	slot_save_path: str | None = None
 
 	log_dir: str = "./"
 
 class LLMClient:
 	def __init__(self, config: LLMClientConfig):
-		self.endpoint = f"http://{config.host}:{config.port}{config.endpoint}"
+		self.base_url = f"http://{config.host}:{config.port}"
+		self.endpoint = f"{self.base_url}{config.endpoint}"
 		self.model_name = config.alias
-		self.session = requests.Session()
+		self.model_path = str(config.model)
+		self.slot_save_path = Path(config.slot_save_path) if config.slot_save_path else None
 		self.log_dir = Path(config.log_dir)
 
+		# Created lazily as aiohttp sessions must be bound to the running loop
+		self.session: aiohttp.ClientSession | None = None
+		self.pool_size = config.pool_size
+		self.keepalive_timeout = config.keepalive_timeout
+		# No total deadline as generations can stream for a long time, only bound the connect and the gap between chunks
+		self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=config.connect_timeout, sock_read=config.read_timeout)
+
+		self.recorder = LLMRecorder(config.record_path) if config.record_path else None
+		self._exchanges = {}
+
+		self.process = None
+		if not config.spawn_server:
+			print(f"LLM server expected at: {self.endpoint}")
+			return
+
+		# One HTTP thread per streaming slot plus headroom for tokenize, health and slot requests
+		parallel = max(1, config.parallel)
 		cmd = [
 			f"{config.backend_location}\\llama-server",
 			# Optimisations
 			"-b", "2048", "-ub", "512", "-ngl", "255", "-sm", "none", "-fa", "1", "--cache-ram", "0", "-kvu", "-nocb",
-			"-ctk", "q8_0", "-ctv", "q8_0", "--no-mmap", "--threads-http", "1", "--parallel", "1", "--cache-reuse", "128",
+			"-ctk", "q8_0", "-ctv", "q8_0", "--no-mmap", "--threads-http", str(parallel + 2), "--parallel", str(parallel), "--cache-reuse", "128",
 			# Connectivity
 			"--host", config.host, "--port", str(config.port),
 			"-m", config.model, "-c", str(config.context_length), "--alias", config.alias,
 			"--no-prefill-assistant", "--verbose-prompt", "--fit", "off"
 		]
+		if self.slot_save_path:
+			self.slot_save_path.mkdir(parents=True, exist_ok=True)
+			cmd += ["--slot-save-path", str(self.slot_save_path.resolve())]
 		# TODO does python have destructors?
 		self.process = start_subprocess(cmd, config.log_dir)
 		print(f"LLM server running at: {self.endpoint}")
 
-	def close(self):
-		# pass
-		self.process.terminate()
-		self.process.wait()
+	def _get_session(self) -> aiohttp.ClientSession:
+		if self.session is None or self.session.closed:
+			self.session = aiohttp.ClientSession(
+				connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout),
+				timeout=self.timeout
+			)
+		return self.session
+
+	async def close(self):
+		if self.session and not self.session.closed:
+			await self.session.close()
+		self.session = None
+
+		if self.process:
+			self.process.terminate()
+			await asyncio.to_thread(self.process.wait)
 
-	def send_generation_request(self, messages: list[dict], hyperparameters: LLMHyperparameters) -> requests.Response:
+	async def send_generation_request(self, messages: list[dict], hyperparameters: LLMHyperparameters, id_slot: int = -1) -> aiohttp.ClientResponse:
 		payload = hyperparameters.to_payload(messages, self.model_name)
+		if id_slot >= 0:
+			payload["id_slot"] = id_slot
 
+		return await self._post_generation(json.dumps(payload, ensure_ascii=False).encode("utf-8"), payload)
+
+	async def send_preset_request(self, messages: list[dict] | bytes, preset, id_slot: int = -1) -> aiohttp.ClientResponse:
+		""" Like send_generation_request but with a compiled SamplerPreset, messages may already be encoded (Context.prompt_json) """
+		body = preset.build(self.model_name, _messages_json(messages), {"id_slot": id_slot} if id_slot >= 0 else None)
+		return await self._post_generation(body)
+
+	def _dump_payload(self, body: bytes):
 		try:
 			self.log_dir.mkdir(parents=True, exist_ok=True)
-			(self.log_dir / "last_llm_payload.json").write_text(
-				json.dumps(payload, indent=2, ensure_ascii=False),
-				encoding="utf-8"
-			)
+			(self.log_dir / "last_llm_payload.json").write_bytes(body)
 		except Exception as e:
 			print(f"[llm payload dump failed] {e}")
 
-		response = self.session.post(self.endpoint, json=payload, stream=True)
+	async def _post_generation(self, body: bytes, payload: dict | None = None) -> aiohttp.ClientResponse:
+		# The dump is only for debugging, keep the disk write off the request path
+		asyncio.get_running_loop().run_in_executor(None, self._dump_payload, body)
+
+		exchange = self.recorder.begin(payload if payload is not None else json.loads(body)) if self.recorder else None
+		response = await self._get_session().post(self.endpoint, data=body, headers={"Content-Type": "application/json"})
+		if exchange:
+			self._exchanges[response] = exchange
 		return response
 
-	def get_streaming_response(self, response: requests.Response) -> Iterator[str]:
-		response.raise_for_status()
-		for line in response.iter_lines():
-			if not line:
-				continue
-			if line == b"data: [DONE]" or line == b"[DONE]":
-				break
-			line = line.removeprefix(b"data:").lstrip()
-			# Convert to string
-			line = line.decode("utf-8", errors="ignore").strip()
-			# Parse JSON
-			try:
-				chunk = json.loads(line)
-				yield chunk.get("choices", [{}])[0].get("delta", {}).get("content", "")
-			except Exception:
-				continue
\ No newline at end of file
+	async def complete(self, messages: list[dict], hyperparameters: LLMHyperparameters, id_slot: int = -1) -> str:
+		""" A whole non-streamed reply, for internal requests nobody listens to token by token """
+		payload = hyperparameters.to_payload(messages, self.model_name)
+		payload["stream"] = False
+		if id_slot >= 0:
+			payload["id_slot"] = id_slot
+
+		async with self._get_session().post(self.endpoint, json=payload) as response:
+			response.raise_for_status()
+			result = await response.json()
+		return result["choices"][0]["message"]["content"]
+
+	async def prefill(self, messages: list[dict] | bytes, id_slot: int = -1) -> dict:
+		""" Process the prompt into the slot's KV cache without generating any tokens """
+		payload = {
+			"model": self.model_name,
+			"n_predict": 0,
+			"max_tokens": 0,
+			"cache_prompt": True,
+			"stream": False
+		}
+		if id_slot >= 0:
+			payload["id_slot"] = id_slot
+		messages = _messages_json(messages)
+		if prefill:
+			# llama-server continues a trailing assistant message instead of answering it
+			messages = messages[:-1] + b"," + _messages_json([{"role": "assistant", "content": prefill}])[1:]
+		body = b'{"messages":' + messages + b"," + json.dumps(payload, separators=(",", ":")).encode("utf-8")[1:]
+
+		async with self._get_session().post(self.endpoint, data=body, headers={"Content-Type": "application/json"}) as response:
+			response.raise_for_status()
+			return await response.json()
+
+	async def next_token_probs(self, messages: list[dict] | bytes, top_n: int = 10, id_slot: int = -1, prefill: str = "") -> dict[int, float]:
+		""" The most likely first token ids of the reply and their probabilities, from a single greedy token """
+		payload = {
+			"model": self.model_name,
+			"max_tokens": 1,
+			"n_predict": 1,
+			"temperature": 0,
+			"logprobs": True,
+			"top_logprobs": top_n,
+			"cache_prompt": True,
+			"stream": False
+		}
+		if id_slot >= 0:
+			payload["id_slot"] = id_slot
+		messages = _messages_json(messages)
+		if prefill:
+			# llama-server continues a trailing assistant message instead of answering it
+			messages = messages[:-1] + b"," + _messages_json([{"role": "assistant", "content": prefill}])[1:]
+		body = b'{"messages":' + messages + b"," + json.dumps(payload, separators=(",", ":")).encode("utf-8")[1:]
+
+		async with self._get_session().post(self.endpoint, data=body, headers={"Content-Type": "application/json"}) as response:
+			response.raise_for_status()
+			result = await response.json()
+
+		probs = {}
+		for entry in result["choices"][0]["logprobs"]["content"][0]["top_logprobs"]:
+			probs[entry["id"]] = probs.get(entry["id"], 0.0) + math.exp(entry["logprob"])
+		return probs
+
+	async def tokenize(self, text: str) -> list[int]:
+		async with self._get_session().post(f"{self.base_url}/tokenize", json={"content": text, "add_special": False}) as response:
+			response.raise_for_status()
+			return (await response.json()).get("tokens", [])
+
+	async def count_tokens(self, text: str) -> int:
+		return len(await self.tokenize(text))
+
+	async def save_slot(self, id_slot: int, filename: str) -> dict:
+		""" Write the slot's KV cache to filename inside the server's slot save path """
+		async with self._get_session().post(f"{self.base_url}/slots/{id_slot}?action=save", json={"filename": filename}) as response:
+			response.raise_for_status()
+			return await response.json()
+
+	async def restore_slot(self, id_slot: int, filename: str) -> dict:
+		async with self._get_session().post(f"{self.base_url}/slots/{id_slot}?action=restore", json={"filename": filename}) as response:
+			response.raise_for_status()
+			return await response.json()
+
+	async def health(self) -> bool:
+		""" True once the server has loaded its model and answers requests """
+		if self.process and self.process.poll() is not None:
+			return False
+		try:
+			async with self._get_session().get(f"{self.base_url}/health") as response:
+				return response.status == 200
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			return False
+
+	async def get_slots(self) -> list[dict]:
+		async with self._get_session().get(f"{self.base_url}/slots") as response:
+			response.raise_for_status()
+			return await response.json()
+
+	async def get_streaming_response(self, response: aiohttp.ClientResponse, stream_info: dict | None = None) -> AsyncIterator[str]:
+		""" Yields content tokens, the finish reason and server timings are written into stream_info when given """
+		exchange = self._exchanges.pop(response, None)
+		parser = SSEParser()
+
+		def _handle(event) -> bool:
+			""" Record the event and note its finish reason and timings, True once the stream is done """
+			if exchange:
+				exchange.add_chunk(event.data.decode("utf-8", errors="ignore"))
+			if event.done:
+				return True
+			if stream_info is not None:
+				if event.finish_reason:
+					stream_info["finish_reason"] = event.finish_reason
+				if event.timings:
+					stream_info["timings"] = event.timings
+			return False
+
+		try:
+			response.raise_for_status()
+			done = False
+			async for chunk in response.content.iter_any():
+				for event in parser.feed(chunk):
+					done = _handle(event)
+					if done:
+						break
+					if event.content:
+						yield event.content
+				if done:
+					# Drain the chunked terminator so the connection can be reused
+					await response.content.read()
+					break
+			else:
+				# The server closed the stream, its last event may still be waiting for a blank line
+				for event in parser.finalize():
+					if _handle(event):
+						break
+					if event.content:
+						yield event.content
+		finally:
+			if exchange:
+				self.recorder.commit(exchange)
+			# Hand the keep-alive connection back to the pool, an abandoned stream has to drop the connection instead
+			if response.content.at_eof():
+				response.release()
+			else:
+				response.close()
@@ -0,0 +1,246 @@
+import aiohttp
+import asyncio
+
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+from .LLM import LLMClient, LLMClientConfig
+from .Readiness import wait_until_ready
+
+@dataclass
+class LLMPoolConfig:
+	# Seconds between /health checks of every backend
+	health_interval: float = 5.0
+	# Consecutive failed checks before a backend stops receiving requests
+	unhealthy_after: int = 2
+	# How long drain waits for in-flight requests before removing a backend anyway
+	drain_timeout: float = 60.0
+
+class LLMBackend:
+	def __init__(self, name: str, client: LLMClient):
+		self.name = name
+		self.client = client
+
+		# Assume healthy until a check says otherwise, spawned servers may still be loading
+		self.healthy = True
+		self.draining = False
+		self.outstanding = 0
+		self.requests = 0
+		self.failures = 0
+
+		self._idle = asyncio.Event()
+		self._idle.set()
+
+	@property
+	def available(self) -> bool:
+		return self.healthy and not self.draining
+
+	def begin(self):
+		self.outstanding += 1
+		self.requests += 1
+		self._idle.clear()
+
+	def end(self):
+		self.outstanding -= 1
+		if self.outstanding == 0:
+			self._idle.set()
+
+class LLMPool:
+	""" Several llama-server endpoints behind the LLMClient interface, conversations stick to one backend for cache affinity """
+	def __init__(self, config: LLMPoolConfig):
+		self.config = config
+		self.backends: dict[str, LLMBackend] = {}
+		# Routing key (a scheduler pin group) -> backend name
+		self.sticky: dict[str, str] = {}
+		# In-flight streaming responses -> the backend serving them
+		self._responses: dict[aiohttp.ClientResponse, LLMBackend] = {}
+		self._health_task: asyncio.Task | None = None
+
+	@property
+	def model_name(self) -> str:
+		# Every backend serves the same model under the same alias, ask one that is still around
+		backends = list(self.backends.values())
+		if not backends:
+			raise RuntimeError("No LLM backend left")
+		return next((b for b in backends if b.available), backends[0]).client.model_name
+
+	def is_available(self, name: str) -> bool:
+		backend = self.backends.get(name)
+		return backend is not None and backend.available
+
+	def add(self, name: str, config: LLMClientConfig) -> LLMBackend:
+		if name in self.backends:
+			raise ValueError(f"LLM backend '{name}' already exists")
+		backend = LLMBackend(name, LLMClient(config))
+		self.backends[name] = backend
+		return backend
+
+	def start(self):
+		if self._health_task is None:
+			self._health_task = asyncio.create_task(self._health_loop())
+
+	async def close(self):
+		if self._health_task:
+			self._health_task.cancel()
+			self._health_task = None
+		for backend in self.backends.values():
+			await backend.client.close()
+
+	async def wait_ready(self, timeout: float) -> bool:
+		""" Wait for every backend to load its model, True if at least one did """
+		async def _wait(backend: LLMBackend):
+			backend.healthy = await wait_until_ready(f"LLM backend {backend.name}", backend.client.health, timeout)
+		await asyncio.gather(*(_wait(b) for b in self.backends.values()))
+		return any(b.healthy for b in self.backends.values())
+
+	async def drain(self, name: str):
+		""" Stop routing to a backend, wait for its in-flight requests, then remove it """
+		backend = self.backends[name]
+		# Nothing could serve the model afterwards
+		if not any(other is not backend and not other.draining for other in self.backends.values()):
+			raise ValueError(f"LLM backend '{name}' is the last one left, it can't be drained")
+		backend.draining = True
+		self._unstick(backend)
+
+		try:
+			await asyncio.wait_for(backend._idle.wait(), self.config.drain_timeout)
+		except asyncio.TimeoutError:
+			print(f"[llm pool] {name} still had {backend.outstanding} requests after {self.config.drain_timeout}s, removing anyway")
+
+		del self.backends[name]
+		await backend.client.close()
+		print(f"[llm pool] drained and removed {name}")
+
+	def route(self, key: str | None = None) -> LLMBackend:
+		""" The backend key names or sticks to if it's still usable, otherwise the one with the fewest outstanding requests """
+		if key is not None:
+			# Scheduler slots belong to a backend and route by its name
+			backend = self.backends.get(key) or self.backends.get(self.sticky.get(key))
+			if backend and backend.available:
+				return backend
+
+		candidates = [b for b in self.backends.values() if b.available]
+		if not candidates:
+			raise RuntimeError("No healthy LLM backend available")
+		backend = min(candidates, key=lambda b: b.outstanding)
+
+		if key is not None and key not in self.backends:
+			self.sticky[key] = backend.name
+		return backend
+
+	def _unstick(self, backend: LLMBackend):
+		self.sticky = {k: name for k, name in self.sticky.items() if name != backend.name}
+
+	def _mark_failed(self, backend: LLMBackend, error: Exception):
+		if backend.healthy:
+			print(f"[llm pool] {backend.name} failed, routing around it: {error}")
+		backend.healthy = False
+		backend.failures = self.config.unhealthy_after
+		self._unstick(backend)
+
+	async def _call(self, key: str | None, fn, *args, **kwargs):
+		# Connection failures move on to the next backend, other errors belong to the caller
+		for _ in range(len(self.backends)):
+			backend = self.route(key)
+			backend.begin()
+			try:
+				return await fn(backend.client, *args, **kwargs)
+			except aiohttp.ClientConnectionError as e:
+				self._mark_failed(backend, e)
+			finally:
+				backend.end()
+		raise RuntimeError("No healthy LLM backend available")
+
+	async def send_generation_request(self, messages: list[dict], hyperparameters, id_slot: int = -1, key: str | None = None) -> aiohttp.ClientResponse:
+		return await self._send(key, LLMClient.send_generation_request, messages, hyperparameters, id_slot)
+
+	async def send_preset_request(self, messages: list[dict] | bytes, preset, id_slot: int = -1, key: str | None = None) -> aiohttp.ClientResponse:
+		return await self._send(key, LLMClient.send_preset_request, messages, preset, id_slot)
+
+	async def _send(self, key: str | None, fn, *args) -> aiohttp.ClientResponse:
+		for _ in range(len(self.backends)):
+			backend = self.route(key)
+			try:
+				response = await fn(backend.client, *args)
+			except aiohttp.ClientConnectionError as e:
+				self._mark_failed(backend, e)
+				continue
+			# The request stays outstanding until its stream has been consumed
+			backend.begin()
+			self._responses[response] = backend
+			return response
+		raise RuntimeError("No healthy LLM backend available")
+
+	async def get_streaming_response(self, response: aiohttp.ClientResponse, stream_info: dict | None = None) -> AsyncIterator[str]:
+		backend = self._responses.pop(response)
+		stream = backend.client.get_streaming_response(response, stream_info)
+		try:
+			async for token in stream:
+				yield token
+		except aiohttp.ClientConnectionError as e:
+			self._mark_failed(backend, e)
+			raise
+		finally:
+			# Closing early has to reach the client's stream too so it drops the connection now
+			await stream.aclose()
+			backend.end()
+
+	async def complete(self, messages: list[dict], hyperparameters, id_slot: int = -1, key: str | None = None) -> str:
+		return await self._call(key, LLMClient.complete, messages, hyperparameters, id_slot)
+
+	async def prefill(self, messages: list[dict] | bytes, id_slot: int = -1, key: str | None = None) -> dict:
+		return await self._call(key, LLMClient.prefill, messages, id_slot)
+
+	async def next_token_probs(self, messages: list[dict] | bytes, top_n: int = 10, id_slot: int = -1, prefill: str = "", key: str | None = None) -> dict[int, float]:
+		return await self._call(key, LLMClient.next_token_probs, messages, top_n, id_slot, prefill)
+
+	async def save_slot(self, id_slot: int, filename: str, key: str | None = None) -> dict:
+		return await self._call(key, LLMClient.save_slot, id_slot, filename)
+
+	async def restore_slot(self, id_slot: int, filename: str, key: str | None = None) -> dict:
+		return await self._call(key, LLMClient.restore_slot, id_slot, filename)
+
+	async def tokenize(self, text: str) -> list[int]:
+		return await self._call(None, LLMClient.tokenize, text)
+
+	async def count_tokens(self, text: str) -> int:
+		return len(await self.tokenize(text))
+
+	async def get_slots(self, key: str | None = "conversation") -> list[dict]:
+		return await self._call(key, LLMClient.get_slots)
+
+	async def health(self) -> bool:
+		return any(b.available for b in self.backends.values())
+
+	async def _health_loop(self):
+		while True:
+			await asyncio.gather(*(self._check(b) for b in list(self.backends.values())))
+			await asyncio.sleep(self.config.health_interval)
+
+	async def _check(self, backend: LLMBackend):
+		if await backend.client.health():
+			if not backend.healthy:
+				print(f"[llm pool] {backend.name} is healthy again")
+			backend.healthy = True
+			backend.failures = 0
+			return
+
+		backend.failures += 1
+		if backend.healthy and backend.failures >= self.config.unhealthy_after:
+			print(f"[llm pool] {backend.name} failed {backend.failures} health checks")
+			backend.healthy = False
+			self._unstick(backend)
+
+	def report(self) -> list[dict]:
+		return [
+			{
+				"name": b.name,
+				"url": b.client.base_url,
+				"healthy": b.healthy,
+				"draining": b.draining,
+				"outstanding": b.outstanding,
+				"requests": b.requests,
+				"sticky": sorted(k for k, name in self.sticky.items() if name == b.name)
+			}
+			for b in self.backends.values()
+		]
@@ -1,4 +1,5 @@
 import time
+from collections import OrderedDict
 from enum import Enum
 from contextlib import contextmanager
 
@@ -6,6 +7,7 @@ class Unit(Enum):
 	SECONDS = 0
 	MILLISECONDS = 1
 	PER_SECOND = 2
+	PERCENT = 3
 
 class Metrics:
 	def __init__(self):
@@ -56,6 +58,9 @@ class Metrics:
 		self.add_to_metric(name, duration, unit)
 		del self.start_times[name]
 
+	def discard_timer(self, name):
+		self.start_times.pop(name, None)
+
 	@contextmanager
 	def time(self, name, unit=Unit.MILLISECONDS):
 		start = time.time()
@@ -66,7 +71,12 @@ class Metrics:
 			duration *= 1000
 		self.add_metrics(name, duration, unit)
 
-	def print(self, include_total=False, total_unit=Unit.MILLISECONDS):
+	def to_dict(self) -> dict:
+		out = {name: round(value, 2) for name, (value, unit) in self.metrics.items()}
+		out.update(self.counts)
+		return out
+
+	def print(self, include_total=False, total_unit=Unit.MILLISECONDS, label: str | None = None):
 		parts = []
 		total_seconds = 0.0
 
@@ -79,10 +89,14 @@ class Metrics:
 				parts.append(f"{name} = {value:.2f}s")
 			elif unit == Unit.PER_SECOND:
 				parts.append(f"{name} = {value:.0f}/s")
+			elif unit == Unit.PERCENT:
+				parts.append(f"{name} = {value:.0f}%")
 			else:
 				parts.append(f"{name} = {value}")
+		for name, count in self.counts.items():
+			parts.append(f"{name} = {count}")
 			
-		print("[metrics]", " | ".join(parts))
+		print(f"[metrics {label}]" if label else "[metrics]", " | ".join(parts))
 
 	def __enter__(self):
 		self._start = time.time()
@@ -94,4 +108,21 @@ class Metrics:
 		self.print()
 
 	def now(self) -> float:
-		return time.time() - self._created
\ No newline at end of file
+		return time.time() - self._created
+
+class GenerationMetrics:
+	""" The metrics of the most recent generations, keyed by generation id """
+	def __init__(self, keep: int = 200):
+		self.keep = keep
+		self._generations: OrderedDict[str, dict] = OrderedDict()
+
+	def record(self, generation_id: str, kind: str, metrics: Metrics):
+		self._generations[generation_id] = {"generation_id": generation_id, "kind": kind, **metrics.to_dict()}
+		while len(self._generations) > self.keep:
+			self._generations.popitem(last=False)
+
+	def get(self, generation_id: str) -> dict | None:
+		return self._generations.get(generation_id)
+
+	def report(self) -> list[dict]:
+		return list(self._generations.values())
\ No newline at end of file
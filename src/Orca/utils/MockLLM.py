@@ -0,0 +1,287 @@
+import aiohttp.web
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import math
+import re
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+
+from .AIOApp import AIOApp, AIOAppConfig
+
+def messages_key(messages: list[dict]) -> str:
+	""" Stable hash of a conversation, used to pair a request with its recorded exchange """
+	encoded = json.dumps(messages, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+	return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+class RecordedExchange:
+	def __init__(self, payload: dict):
+		self.payload = payload
+		self.started = time.perf_counter()
+		# (seconds since the request was sent, raw `data:` value)
+		self.chunks: list[tuple[float, str]] = []
+
+	def add_chunk(self, data: str):
+		self.chunks.append((time.perf_counter() - self.started, data))
+
+	def to_dict(self) -> dict:
+		return {
+			"key": messages_key(self.payload.get("messages", [])),
+			"request": self.payload,
+			"chunks": [[round(t, 6), data] for t, data in self.chunks]
+		}
+
+class LLMRecorder:
+	""" Captures real request/response exchanges, one JSON object per line """
+	def __init__(self, path: str | Path):
+		self.path = Path(path)
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+
+	def begin(self, payload: dict) -> RecordedExchange:
+		return RecordedExchange(payload)
+
+	def commit(self, exchange: RecordedExchange):
+		try:
+			with open(self.path, "a", encoding="utf-8") as file:
+				file.write(json.dumps(exchange.to_dict(), ensure_ascii=False) + "\n")
+		except Exception as e:
+			print(f"[llm recorder] failed to write exchange: {e}")
+
+def load_recording(path: str | Path) -> list[dict]:
+	exchanges = []
+	with open(path, "r", encoding="utf-8") as file:
+		for line in file:
+			line = line.strip()
+			if line:
+				exchanges.append(json.loads(line))
+	return exchanges
+
+@dataclass
+class MockLLMServerConfig:
+	host: str = "127.0.0.1"
+	port: int = 8000
+
+	# Recorded exchanges to replay, synthetic replies are used when empty
+	replay: str | None = None
+	# "original" replays recorded inter-token timing, "synthetic" uses ttft/tokens_per_second
+	timing: str = "original"
+
+	# Synthetic timing, in seconds and tokens per second
+	ttft: float = 0.2
+	tokens_per_second: float = 40.0
+
+	# Synthetic reply, split into one token per word
+	reply: str = "This is a mock reply from Orca's stand-in llama server."
+
+	# Context size reported per slot
+	n_ctx: int = 4096
+
+def _fake_tokens(text: str) -> list[int]:
+	# Not a real tokenizer, only stable ids with a plausible token count
+	pieces = re.findall(r"\s*\w+|\s*[^\w\s]", text)
+	return [int.from_bytes(hashlib.blake2b(piece.encode("utf-8"), digest_size=2).digest(), "little") for piece in pieces]
+
+class MockLLMServer:
+	""" A CPU-only stand-in for llama-server that speaks /v1/chat/completions SSE """
+	def __init__(self, config: MockLLMServerConfig):
+		self.config = config
+		self.exchanges = load_recording(config.replay) if config.replay else []
+		self.by_key = {exchange["key"]: exchange for exchange in self.exchanges if "key" in exchange}
+		self._round_robin = itertools.cycle(self.exchanges) if self.exchanges else None
+		# Slot snapshots only live in memory, filename -> token count
+		self.snapshots: dict[str, int] = {}
+		# The prompt tokens each slot last processed, to report prefix cache hits like llama-server
+		self.slot_prompts: dict[int, list[int]] = {}
+
+		self.http = AIOApp(AIOAppConfig(
+			host=config.host,
+			port=config.port,
+			post_endpoints={
+				"/v1/chat/completions": self._chat_completions,
+				"/tokenize": self._tokenize,
+				"/slots/{id_slot}": self._slot_action
+			},
+			get_endpoints={
+				"/health": self._health,
+				"/slots": self._slots
+			}
+		))
+
+	async def start(self):
+		await self.http.start()
+
+	async def stop(self):
+		await self.http.stop()
+
+	def _pick_exchange(self, payload: dict) -> dict | None:
+		if not self.exchanges:
+			return None
+		exchange = self.by_key.get(messages_key(payload.get("messages", [])))
+		return exchange if exchange else next(self._round_robin)
+
+	def _prompt_cache(self, payload: dict) -> tuple[int, int]:
+		""" (cache_n, prompt_n) for this request against what its slot already holds """
+		tokens = []
+		for message in payload.get("messages", []):
+			tokens.extend(_fake_tokens(f"<|{message.get('role')}|>{message.get('content')}"))
+
+		slot = payload.get("id_slot", 0)
+		previous = self.slot_prompts.get(slot, [])
+		cached = 0
+		for a, b in zip(previous, tokens):
+			if a != b:
+				break
+			cached += 1
+		self.slot_prompts[slot] = tokens
+		return cached, len(tokens) - cached
+
+	def _synthetic_chunks(self, payload: dict) -> list[tuple[float | None, str]]:
+		cache_n, prompt_n = self._prompt_cache(payload)
+		tokens = re.findall(r"\s*\S+", self.config.reply)
+		finish_reason = "stop"
+		max_tokens = payload.get("max_tokens")
+		if max_tokens is not None and 0 <= max_tokens < len(tokens):
+			tokens = tokens[:max_tokens]
+			finish_reason = "length"
+
+		# Same compact layout and key order as llama-server
+		compact = (",", ":")
+		chunks = []
+		for token in tokens:
+			chunks.append((None, json.dumps({"choices": [{"finish_reason": None, "index": 0, "delta": {"content": token}}], "object": "chat.completion.chunk"}, separators=compact, ensure_ascii=False)))
+		chunks.append((None, json.dumps({
+			"choices": [{"finish_reason": finish_reason, "index": 0, "delta": {}}],
+			"object": "chat.completion.chunk",
+			"timings": {
+				"prompt_n": prompt_n,
+				"cache_n": cache_n,
+				"prompt_ms": self.config.ttft * 1000,
+				"prompt_per_second": prompt_n / self.config.ttft if self.config.ttft > 0 else 0,
+				"predicted_n": len(tokens),
+				"predicted_ms": len(tokens) / self.config.tokens_per_second * 1000 if self.config.tokens_per_second > 0 else 0,
+				"predicted_per_second": self.config.tokens_per_second
+			}
+		}, separators=compact)))
+		return chunks
+
+	def _schedule(self, chunks: list[tuple[float | None, str]]) -> list[tuple[float, str]]:
+		""" Assign each chunk a send time relative to the request arriving """
+		if self.config.timing == "original" and all(t is not None for t, _ in chunks):
+			return chunks
+
+		interval = 1.0 / self.config.tokens_per_second if self.config.tokens_per_second > 0 else 0.0
+		return [(self.config.ttft + i * interval, data) for i, (_, data) in enumerate(chunks)]
+
+	async def _chat_completions(self, request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+		started = time.perf_counter()
+		payload = await request.json()
+
+		exchange = self._pick_exchange(payload)
+		if exchange:
+			chunks = [(t, data) for t, data in exchange["chunks"] if data != "[DONE]"]
+		else:
+			chunks = self._synthetic_chunks(payload)
+		schedule = self._schedule(chunks)
+
+		if not payload.get("stream", False):
+			content = []
+			for _, data in schedule:
+				delta = json.loads(data).get("choices", [{}])[0].get("delta", {})
+				content.append(delta.get("content") or "")
+			if schedule:
+				await asyncio.sleep(max(0.0, schedule[-1][0] - (time.perf_counter() - started)))
+			choice = {"index": 0, "message": {"role": "assistant", "content": "".join(content)}, "finish_reason": "stop"}
+			if payload.get("logprobs") and content:
+				# The reply's first token is certain enough, the rest of the probability goes to a filler
+				messages = payload.get("messages", [])
+				# A trailing assistant message is continued, so the first token comes after it
+				prefill = messages[-1].get("content", "") if messages and messages[-1].get("role") == "assistant" else ""
+				reply = "".join(content)
+				first = _fake_tokens(reply[len(prefill):] if reply.startswith(prefill) else reply)[:1] or [0]
+				choice["logprobs"] = {"content": [{"id": first[0], "token": content[0], "logprob": math.log(0.9), "top_logprobs": [
+					{"id": first[0], "token": content[0], "logprob": math.log(0.9)},
+					{"id": _fake_tokens(" um")[0], "token": " um", "logprob": math.log(0.1)}
+				]}]}
+			return aiohttp.web.json_response({"model": payload.get("model"), "choices": [choice]})
+
+		response = aiohttp.web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+		await response.prepare(request)
+
+		try:
+			for send_at, data in schedule:
+				delay = send_at - (time.perf_counter() - started)
+				if delay > 0:
+					await asyncio.sleep(delay)
+				await response.write(f"data: {data}\n\n".encode("utf-8"))
+
+			await response.write(b"data: [DONE]\n\n")
+			await response.write_eof()
+		except ConnectionResetError:
+			# The client abandoned the stream, like llama-server the generation just stops
+			pass
+		return response
+
+	async def _tokenize(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+		payload = await request.json()
+		return aiohttp.web.json_response({"tokens": _fake_tokens(payload.get("content", ""))})
+
+	async def _slot_action(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+		action = request.query.get("action")
+		filename = (await request.json()).get("filename", "")
+		id_slot = int(request.match_info["id_slot"])
+
+		if action == "save":
+			self.snapshots[filename] = 1
+			return aiohttp.web.json_response({"id_slot": id_slot, "filename": filename, "n_saved": 1})
+		if action == "restore":
+			if filename not in self.snapshots:
+				return aiohttp.web.json_response({"error": {"code": 400, "message": "failed to restore slot"}}, status=400)
+			return aiohttp.web.json_response({"id_slot": id_slot, "filename": filename, "n_restored": self.snapshots[filename]})
+		return aiohttp.web.json_response({"error": {"code": 400, "message": "invalid action"}}, status=400)
+
+	async def _health(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+		return aiohttp.web.json_response({"status": "ok"})
+
+	async def _slots(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+		slots = sorted(set(self.slot_prompts) | {0})
+		return aiohttp.web.json_response([{ "id": slot, "n_ctx": self.config.n_ctx, "is_processing": False } for slot in slots])
+
+def main():
+	parser = argparse.ArgumentParser(description="Mock llama-server for CPU-only end-to-end tests")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8000)
+	parser.add_argument("--replay", help="Recorded exchanges (JSONL) to replay")
+	parser.add_argument("--timing", choices=["original", "synthetic"], default="original")
+	parser.add_argument("--ttft", type=float, default=0.2, help="Synthetic time to first token in seconds")
+	parser.add_argument("--tokens-per-second", type=float, default=40.0)
+	parser.add_argument("--reply", default=MockLLMServerConfig.reply)
+	args = parser.parse_args()
+
+	server = MockLLMServer(MockLLMServerConfig(
+		host=args.host,
+		port=args.port,
+		replay=args.replay,
+		timing=args.timing,
+		ttft=args.ttft,
+		tokens_per_second=args.tokens_per_second,
+		reply=args.reply
+	))
+
+	async def _run():
+		await server.start()
+		try:
+			await asyncio.Event().wait()
+		finally:
+			await server.stop()
+
+	try:
+		asyncio.run(_run())
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == "__main__":
+	main()
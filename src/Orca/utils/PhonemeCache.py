@@ -0,0 +1,174 @@
+import json
+import os
+import re
+import threading
+import time
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+from .AudioCache import normalize_clause
+
+# Words with their apostrophes, and single punctuation marks, the way Kokoro joins phonemes back up
+WORD_PATTERN = re.compile(r"\w+(?:'\w+)*|[^\w\s]")
+# Kokoro's limit for a single inference
+MAX_PHONEMES = 510
+
+@dataclass
+class PhonemeCacheConfig:
+	enabled: bool = False
+	# Entries kept in each LRU
+	clauses: int = 20000
+	words: int = 50000
+	# Context can change how a word is said, a word is only reused after it came out the same this many times
+	min_count: int = 2
+	# JSON file that keeps the phonemes across restarts, None keeps them in memory only
+	path: str | None = None
+	# New clauses between saves
+	save_every: int = 64
+
+class PhonemeCache:
+	""" Clause and word level phonemes in front of Kokoro's G2P, known text goes straight to the model """
+	def __init__(self, config: PhonemeCacheConfig, pipeline):
+		self.config = config
+		self.pipeline = pipeline
+		self.clauses: OrderedDict[str, list[str]] = OrderedDict()
+		# Phonemes and how often they came out the same, None once a word was seen said two ways
+		self.words: OrderedDict[str, tuple[str | None, int]] = OrderedDict()
+		# The pool saves from its worker, the thread worker from wherever it is closed
+		self.lock = threading.Lock()
+		# Periodic saves run on their own thread, the disk is never touched on the synthesis path
+		self._save_lock = threading.Lock()
+		self._saving: threading.Thread | None = None
+
+		self.clause_hits = 0
+		self.word_hits = 0
+		self.misses = 0
+		# Milliseconds spent in the real G2P
+		self.g2p_ms = 0.0
+
+		self.path = Path(config.path) if config.path else None
+		self.unsaved = 0
+		if self.path and self.path.exists():
+			self._load()
+
+	def phonemize(self, clause: str) -> list[str]:
+		""" Phoneme strings for clause, one per Kokoro inference """
+		text = normalize_clause(clause)
+		with self.lock:
+			chunks = self.clauses.get(text)
+			if chunks is not None:
+				self.clauses.move_to_end(text)
+				self.clause_hits += 1
+				return chunks
+
+			chunks = self._from_words(text)
+			if chunks is not None:
+				self.word_hits += 1
+			else:
+				started = time.perf_counter()
+				_, tokens = self.pipeline.g2p(text)
+				chunks = [phonemes for _, phonemes, _ in self.pipeline.en_tokenize(tokens) if phonemes]
+				self.g2p_ms += (time.perf_counter() - started) * 1000
+				self.misses += 1
+				self._learn(tokens)
+
+			self._remember(self.clauses, text, chunks, self.config.clauses)
+			self.unsaved += 1
+			save = self.path and self.unsaved >= self.config.save_every and not (self._saving and self._saving.is_alive())
+			if save:
+				self._saving = threading.Thread(target=self.save, name="g2p-save", daemon=True)
+				self._saving.start()
+		return chunks
+
+	def _from_words(self, text: str) -> list[str] | None:
+		parts = []
+		matches = list(WORD_PATTERN.finditer(text))
+		for match in matches:
+			phonemes, count = self.words.get(match.group(), (None, 0))
+			if phonemes is None or count < self.config.min_count:
+				return None
+			# Same joining as KPipeline.tokens_to_ps
+			parts.append(phonemes + (" " if text[match.end():match.end() + 1].isspace() else ""))
+
+		joined = "".join(parts).strip()
+		if not joined or len(joined) > MAX_PHONEMES:
+			return None
+		for match in matches:
+			self.words.move_to_end(match.group())
+		return [joined]
+
+	def _learn(self, tokens):
+		for token in tokens:
+			if not token.phonemes or not WORD_PATTERN.fullmatch(token.text):
+				continue
+			phonemes, count = self.words.get(token.text, (token.phonemes, 0))
+			if phonemes is not None and phonemes != token.phonemes:
+				phonemes = None
+			self._remember(self.words, token.text, (phonemes, count + 1), self.config.words)
+
+	def _remember(self, lru: OrderedDict, key: str, value, limit: int):
+		lru[key] = value
+		lru.move_to_end(key)
+		while len(lru) > limit:
+			lru.popitem(last=False)
+
+	def _read(self) -> dict:
+		try:
+			with open(self.path, "r", encoding="utf-8") as f:
+				data = json.load(f)
+		except (OSError, ValueError) as e:
+			print(f"[g2p cache] couldn't read {self.path}: {e}")
+			return {}
+		# Phonemes from another language's G2P are no use
+		if data.get("lang") != self.pipeline.lang_code:
+			return {}
+		return data
+
+	def _load(self):
+		data = self._read()
+		for text, chunks in data.get("clauses", {}).items():
+			self._remember(self.clauses, text, chunks, self.config.clauses)
+		for word, (phonemes, count) in data.get("words", {}).items():
+			self._remember(self.words, word, (phonemes, count), self.config.words)
+		print(f"[g2p cache] loaded {len(self.clauses)} clauses and {len(self.words)} words")
+
+	def save(self):
+		""" Merge into the file on disk, pool workers share it and each only adds what it learned """
+		if not self.path:
+			return
+		# Only the copy holds up phonemize, reading and writing the file happen outside the lock
+		with self.lock:
+			learned_clauses = list(self.clauses.items())
+			learned_words = list(self.words.items())
+			self.unsaved = 0
+
+		with self._save_lock:
+			data = self._read() if self.path.exists() else {}
+			clauses = OrderedDict(data.get("clauses", {}))
+			words = OrderedDict(data.get("words", {}))
+			for text, chunks in learned_clauses:
+				self._remember(clauses, text, chunks, self.config.clauses)
+			for word, entry in learned_words:
+				self._remember(words, word, list(entry), self.config.words)
+
+			self.path.parent.mkdir(parents=True, exist_ok=True)
+			temporary = self.path.with_suffix(f".{os.getpid()}.tmp")
+			try:
+				with open(temporary, "w", encoding="utf-8") as f:
+					json.dump({ "lang": self.pipeline.lang_code, "clauses": clauses, "words": words }, f, ensure_ascii=False)
+				os.replace(temporary, self.path)
+			except OSError as e:
+				print(f"[g2p cache] couldn't save {self.path}: {e}")
+				temporary.unlink(missing_ok=True)
+
+	def report(self) -> dict:
+		return {
+			"g2p_clause_hits": self.clause_hits,
+			"g2p_word_hits": self.word_hits,
+			"g2p_misses": self.misses,
+			"g2p_ms": self.g2p_ms,
+			"g2p_clauses": len(self.clauses),
+			"g2p_words": len(self.words)
+		}
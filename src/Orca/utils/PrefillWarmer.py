@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+
+from .GenerationScheduler import USER_GENERATION, WARM_GENERATION
+
+def prefix_hash(messages: list[dict] | bytes) -> str:
+	if not isinstance(messages, bytes):
+		messages = json.dumps(messages, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+	return hashlib.sha1(messages).hexdigest()
+
+class PrefillWarmer:
+	""" Prefills the stable context prefix into a slot's KV cache while Orca would otherwise sit idle """
+	def __init__(self, llm, scheduler, context, enabled: bool = True):
+		self.llm = llm
+		self.scheduler = scheduler
+		self.context = context
+		self.enabled = enabled
+
+		self._task: asyncio.Task | None = None
+		# Scheduler slot -> hash of the last prefix warmed into it, forgotten once anything else uses the slot
+		self._warmed: dict[int, str] = {}
+		scheduler.on_slot_used(self._forget)
+
+	def _forget(self, slot, kind: str):
+		if kind != WARM_GENERATION:
+			self._warmed.pop(slot.slot_id, None)
+
+	def warm(self, reason: str, kind: str = USER_GENERATION):
+		if not self.enabled:
+			return
+
+		# A newer prefix supersedes whatever is still being warmed
+		if self._task and not self._task.done():
+			self._task.cancel()
+		self._task = self.scheduler.track(asyncio.create_task(self._warm(reason, kind)))
+
+	async def _warm(self, reason: str, kind: str):
+		# Trim first so the warmed prefix is the one the next generation will actually send
+		await self.context.fit_budget(self.llm.tokenize)
+
+		pin = self.scheduler.config.pins.get(kind, kind)
+		idle = self.scheduler.idle_slot(kind)
+		if idle is None:
+			return
+		slot = idle.server_id
+
+		# Warm the backend the generation will be routed to
+		key = idle.backend or pin
+		try:
+			backend = self.llm.route(key).name
+		except RuntimeError as e:
+			print(f"[prefill] warming for {reason} skipped: {e}")
+			return
+
+		count = len(self.context.messages)
+		messages = self.context.prompt_json()
+		digest = prefix_hash(messages)
+		if self._warmed.get(idle.slot_id) == digest:
+			return
+
+		# Holds the slot like a generation would, any generation that needs it preempts the warm
+		ticket = await self.scheduler.acquire(f"warm-{uuid.uuid4().hex[:12]}", WARM_GENERATION, key=pin)
+		if ticket is None:
+			return
+
+		used = ticket.slot
+		start = time.time()
+		try:
+			await self.llm.prefill(messages, id_slot=ticket.slot_id, key=ticket.route)
+		except asyncio.CancelledError:
+			if ticket.cancel_reason:
+				print(f"[prefill] warming for {reason} {ticket.cancel_reason}")
+			raise
+		except Exception as e:
+			print(f"[prefill] warming for {reason} failed: {e}")
+			return
+		finally:
+			self.scheduler.release(ticket)
+
+		self._warmed[used.slot_id] = digest
+		print(f"[prefill] warmed {count} messages into {backend} slot {slot} for {reason} in {(time.time() - start) * 1000:.1f}ms")
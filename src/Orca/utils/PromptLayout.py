@@ -0,0 +1,44 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+# Volatile values are rendered straight into the system prompt
+INLINE_LAYOUT = "inline"
+# The system prompt stays byte-stable, volatile values ride in a trailing ephemeral message
+STABLE_LAYOUT = "stable"
+
+@dataclass
+class PromptLayoutConfig:
+	layout: str = INLINE_LAYOUT
+	# Minutes <time> is rounded down to inside the stable system prompt
+	time_bucket: int = 60
+	# Appended after the conversation in the stable layout, never stored in the context
+	ephemeral: str = "Current date and time: <date> <time>"
+
+class PromptLayout:
+	def __init__(self, config: PromptLayoutConfig):
+		if config.layout not in (INLINE_LAYOUT, STABLE_LAYOUT):
+			raise ValueError(f"Unknown prompt layout '{config.layout}', expected '{INLINE_LAYOUT}' or '{STABLE_LAYOUT}'")
+		self.config = config
+
+	@property
+	def stable(self) -> bool:
+		return self.config.layout == STABLE_LAYOUT
+
+	def replacements(self, now: datetime, functions: str = "") -> dict[str, str]:
+		""" Values substituted into the system prompt """
+		if self.stable and self.config.time_bucket > 0:
+			minutes = now.hour * 60 + now.minute
+			minutes -= minutes % self.config.time_bucket
+			now = now.replace(hour=minutes // 60, minute=minutes % 60)
+
+		return {
+			"<date>": now.strftime("%Y-%m-%d"),
+			"<time>": now.strftime("%I:%M %p"),
+			"<functions>": functions
+		}
+
+	def ephemeral(self, now: datetime) -> str:
+		""" The trailing system message for this generation, empty in the inline layout """
+		if not self.stable or not self.config.ephemeral:
+			return ""
+		return self.config.ephemeral.replace("<date>", now.strftime("%Y-%m-%d")).replace("<time>", now.strftime("%I:%M %p"))
@@ -0,0 +1,74 @@
+import aiohttp
+import hashlib
+import time
+
+from .GenerationScheduler import USER_GENERATION
+from .PrefillWarmer import prefix_hash
+
+class PromptSnapshots:
+	""" Saves the KV state of the system prompt with llama-server's slot save and restores it instead of prefilling again """
+	def __init__(self, llm, scheduler, context, enabled: bool = True, keep: int = 4):
+		self.llm = llm
+		self.scheduler = scheduler
+		self.context = context
+		self.enabled = enabled
+		# Snapshots kept per backend, older ones are removed
+		self.keep = keep
+
+	def snapshot_name(self, backend) -> str:
+		# The KV state is only valid for the same model and the exact same prefix
+		prefix = prefix_hash(b"[" + self.context.messages[0].json + b"]")
+		digest = hashlib.sha1(f"{backend.client.model_path}\n{prefix}".encode("utf-8")).hexdigest()
+		return f"{self.llm.model_name}-{digest[:16]}.bin"
+
+	async def restore(self, reason: str) -> bool:
+		""" Load the snapshot of the current system prompt into the conversation slot, saving one first if there is none """
+		if not self.enabled or not self.context.messages:
+			return False
+
+		idle = self.scheduler.idle_slot(USER_GENERATION)
+		if idle is None:
+			return False
+		slot = idle.server_id
+
+		key = idle.backend or self.scheduler.config.pins.get(USER_GENERATION, USER_GENERATION)
+		try:
+			backend = self.llm.route(key)
+		except RuntimeError as e:
+			print(f"[snapshot] skipped for {reason}: {e}")
+			return False
+
+		filename = self.snapshot_name(backend)
+		directory = backend.client.slot_save_path
+
+		# Whatever was warmed into the slot is replaced either way
+		self.scheduler.slot_used(idle, "snapshot")
+		start = time.time()
+		# External servers keep their snapshots out of sight, just try restoring there
+		if directory is None or (directory / filename).exists():
+			try:
+				result = await self.llm.restore_slot(slot, filename, key=key)
+				print(f"[snapshot] restored {result.get('n_restored', '?')} tokens into {backend.name} slot {slot} for {reason} in {(time.time() - start) * 1000:.1f}ms")
+				return True
+			except aiohttp.ClientResponseError as e:
+				if e.status not in (400, 404):
+					print(f"[snapshot] restore for {reason} failed: {e}")
+					return False
+
+		try:
+			await self.llm.prefill(b"[" + self.context.messages[0].json + b"]", id_slot=slot, key=key)
+			result = await self.llm.save_slot(slot, filename, key=key)
+		except (aiohttp.ClientError, RuntimeError) as e:
+			print(f"[snapshot] save for {reason} failed: {e}")
+			return False
+
+		print(f"[snapshot] saved {result.get('n_saved', '?')} tokens from {backend.name} slot {slot} for {reason} in {(time.time() - start) * 1000:.1f}ms")
+		if directory is not None:
+			self._prune(directory, filename)
+		return False
+
+	def _prune(self, directory, current: str):
+		snapshots = sorted(directory.glob(f"{self.llm.model_name}-*.bin"), key=lambda p: p.stat().st_mtime, reverse=True)
+		for path in snapshots[self.keep:]:
+			if path.name != current:
+				path.unlink(missing_ok=True)
@@ -0,0 +1,58 @@
+import re
+
+class PromptTemplate:
+	""" A prompt compiled once into literal and placeholder segments, re-rendered only when a placeholder's value changes """
+	def __init__(self, raw: str):
+		self.raw = raw
+		self.values: dict[str, str] = {}
+
+		self._names: frozenset[str] = frozenset()
+		self._segments: list[str] = [raw]
+		# Indices into _segments filled by each placeholder
+		self._slots: dict[str, list[int]] = {}
+		self._rendered: str | None = raw
+
+	def _compile(self, names: frozenset[str]):
+		self._names = names
+		self._slots = {}
+		if not names:
+			self._segments = [self.raw]
+			return
+
+		# Longest first so a placeholder that prefixes another can't steal its match
+		pattern = re.compile("|".join(re.escape(name) for name in sorted(names, key=len, reverse=True)))
+		self._segments = []
+		position = 0
+		for match in pattern.finditer(self.raw):
+			self._segments.append(self.raw[position:match.start()])
+			self._slots.setdefault(match.group(0), []).append(len(self._segments))
+			self._segments.append(self.values.get(match.group(0), match.group(0)))
+			position = match.end()
+		self._segments.append(self.raw[position:])
+
+	def update(self, values: dict[str, str]) -> bool:
+		""" Set placeholder values, True if the rendered prompt changed """
+		names = frozenset(values) | self._names
+		if names != self._names:
+			previous = self.render()
+			self.values.update(values)
+			self._compile(names)
+			self._rendered = None
+			return self.render() != previous
+
+		changed = False
+		for name, value in values.items():
+			if self.values.get(name) == value:
+				continue
+			self.values[name] = value
+			for index in self._slots.get(name, ()):
+				self._segments[index] = value
+				changed = True
+		if changed:
+			self._rendered = None
+		return changed
+
+	def render(self) -> str:
+		if self._rendered is None:
+			self._rendered = "".join(self._segments)
+		return self._rendered
@@ -0,0 +1,20 @@
+import asyncio
+import time
+
+from collections.abc import Awaitable, Callable
+
+async def wait_until_ready(name: str, probe: Callable[[], Awaitable[bool]], timeout: float, interval: float = 0.25) -> bool:
+	""" Poll probe until it reports ready, False if timeout passes first """
+	start = time.time()
+	while True:
+		try:
+			if await probe():
+				print(f"{name} ready after {time.time() - start:.1f}s")
+				return True
+		except Exception:
+			pass
+
+		if time.time() - start >= timeout:
+			print(f"{name} not ready after {timeout:.0f}s")
+			return False
+		await asyncio.sleep(interval)
@@ -0,0 +1,149 @@
+import json
+import re
+
+_DATA = b"data:"
+_DONE = b"[DONE]"
+_CONTENT_KEY = b'"content":'
+_FINISH_KEY = b'"finish_reason":'
+# llama-server writes compact JSON in a fixed key order, so a plain token chunk starts exactly like this
+_TOKEN_CHUNK = re.compile(rb'data: ?\{"choices":\[\{"finish_reason":null,"index":0,"delta":\{"content":"([^"\\]*)"\}\}\]')
+_TIMINGS_KEY = b'"timings"'
+
+class SSEEvent:
+	__slots__ = ("content", "finish_reason", "timings", "done", "data")
+
+	def __init__(self, content: str = "", finish_reason: str | None = None, timings: dict | None = None, done: bool = False, data: bytes = b""):
+		self.content = content
+		self.finish_reason = finish_reason
+		self.timings = timings
+		self.done = done
+		# The raw `data:` payload, kept for recording
+		self.data = data
+
+def _string_end(data: bytes, start: int) -> int:
+	""" Index of the closing quote of the JSON string whose body starts at start, -1 if it isn't complete """
+	i = start
+	while True:
+		i = data.find(b'"', i)
+		if i == -1:
+			return -1
+		# An odd run of backslashes escapes the quote
+		backslashes = 0
+		j = i - 1
+		while j >= start and data[j] == 0x5C:
+			backslashes += 1
+			j -= 1
+		if backslashes % 2 == 0:
+			return i
+		i += 1
+
+def _field_value(data: bytes, key: bytes) -> tuple[bool, str | None]:
+	""" Pull a string (or null) value out of a compact JSON object without parsing it, (found, value) """
+	idx = data.find(key)
+	# Don't match keys that merely end with this one, e.g. "reasoning_content"
+	while idx > 0 and data[idx - 1] not in b"{,":
+		idx = data.find(key, idx + 1)
+	if idx == -1:
+		return False, None
+
+	start = idx + len(key)
+	quote = data[start:start + 1]
+	if quote != b'"':
+		return (True, None) if data.startswith(b"null", start) else (False, None)
+
+	start += 1
+	end = data.find(b'"', start)
+	if end == -1:
+		return False, None
+
+	raw = data[start:end]
+	if b"\\" not in raw:
+		return True, raw.decode("utf-8", errors="ignore")
+
+	# Escapes (quotes, newlines, \uXXXX surrogates) are rare enough to hand to the JSON decoder
+	end = _string_end(data, start)
+	if end == -1:
+		return False, None
+	return True, json.loads(data[start - 1:end + 1])
+
+def parse_event(data: bytes) -> SSEEvent:
+	if data == _DONE:
+		return SSEEvent(done=True, data=data)
+
+	# The final chunk carries timings, it's only sent once so parse it fully
+	if _TIMINGS_KEY in data:
+		try:
+			chunk = json.loads(data)
+		except ValueError:
+			return SSEEvent(data=data)
+		choice = (chunk.get("choices") or [{}])[0]
+		return SSEEvent(
+			content=(choice.get("delta") or {}).get("content") or "",
+			finish_reason=choice.get("finish_reason"),
+			timings=chunk.get("timings"),
+			data=data
+		)
+
+	found, content = _field_value(data, _CONTENT_KEY)
+	if not found and _CONTENT_KEY in data:
+		# Unusual formatting, fall back to a full parse
+		try:
+			chunk = json.loads(data)
+		except ValueError:
+			return SSEEvent(data=data)
+		choice = (chunk.get("choices") or [{}])[0]
+		return SSEEvent(
+			content=(choice.get("delta") or {}).get("content") or "",
+			finish_reason=choice.get("finish_reason"),
+			data=data
+		)
+
+	_, finish_reason = _field_value(data, _FINISH_KEY)
+	return SSEEvent(content=content or "", finish_reason=finish_reason, data=data)
+
+class SSEParser:
+	""" Incremental server-sent events parser over raw network chunks """
+	def __init__(self):
+		self._buffer = b""
+
+	def feed(self, chunk: bytes) -> list[SSEEvent]:
+		buffer = self._buffer + chunk
+		if b"\r" in buffer:
+			buffer = buffer.replace(b"\r\n", b"\n")
+
+		# Events end with a blank line, whatever follows the last one is still incomplete
+		blocks = buffer.split(b"\n\n")
+		self._buffer = blocks.pop()
+
+		events = []
+		match = _TOKEN_CHUNK.match
+		for block in blocks:
+			# Fast path, a plain token is pulled out without decoding the rest of the object
+			token = match(block)
+			if token is not None and b"\n" not in block:
+				events.append(SSEEvent(token.group(1).decode("utf-8", errors="ignore"), None, None, False, block[6:] if block[5] == 0x20 else block[5:]))
+				continue
+			data = self._event_data(block)
+			if data is not None:
+				events.append(parse_event(data))
+		return events
+
+	def finalize(self) -> list[SSEEvent]:
+		""" Dispatch whatever is left when the stream ends without a trailing blank line """
+		block = self._buffer.strip(b"\n")
+		self._buffer = b""
+		data = self._event_data(block) if block else None
+		return [parse_event(data)] if data is not None else []
+
+	def _event_data(self, block: bytes) -> bytes | None:
+		# The common case, a single `data: ` line
+		if block.startswith(b"data: ") and b"\n" not in block:
+			return block[6:]
+
+		lines = []
+		for line in block.split(b"\n"):
+			if line.startswith(_DATA):
+				value = line[5:]
+				lines.append(value[1:] if value.startswith(b" ") else value)
+			# Comments, event, id and retry fields carry nothing Orca uses
+		return b"\n".join(lines) if lines else None
@@ -48,7 +48,8 @@ class STTClientConfig:
 
 class STTClient:
 	def __init__(self, config: STTClientConfig):
-		self.endpoint = f"http://{config.host}:{config.port}{config.endpoint}"
+		self.base_url = f"http://{config.host}:{config.port}"
+		self.endpoint = f"{self.base_url}{config.endpoint}"
 		self.session = requests.Session()
 
 		self.sample_rate = 16000
@@ -68,6 +69,17 @@ class STTClient:
 		self.process.terminate()
 		self.process.wait()
 
+	def health(self) -> bool:
+		""" True once whisper-server answers, it only starts listening after the model has loaded """
+		if self.process.poll() is not None:
+			return False
+		try:
+			response = self.session.get(f"{self.base_url}/health", timeout=1.0)
+		except requests.RequestException:
+			return False
+		# Builds without /health still answer with a 404 once they are up
+		return response.status_code in (200, 404)
+
 	def transcribe(self, hyperparameters: STTHyperparameters, audio_b64: str) -> str:
 		response = self.session.post(self.endpoint, json = hyperparameters.to_payload(audio_b64))
 		response.raise_for_status()
@@ -0,0 +1,142 @@
+import json
+
+from dataclasses import fields
+
+from .LLM import LLMHyperparameters
+
+COMPACT = (",", ":")
+
+# What GenerationEvent has always sampled with, used when the config defines no presets
+DEFAULT_PRESETS = {
+	"default": {
+		"temperature": 1.0,
+		"min_p": 0.05,
+		"top_k": 64,
+		"presence_penalty": 0.1,
+		"repetition_penalty": 1.1,
+		"repeat_last_n": 512,
+
+		# XTC
+		"xtc_threshold": 0.05,
+		"xtc_probability": 0.1,
+
+		# DRY sampling
+		"dry_multiplier": 3.0,
+		"dry_base": 1.75,
+		"dry_allowed_length": 3,
+		"dry_penalty_last_n": -1,
+		"dry_sequence_breakers": [ '\n', ':', '"', '*', '<', '>', "<silence>", "`" ],
+
+		# Misc
+		"n_predict": 512,
+		"logit_bias": [
+			# Encourage shorter responses
+			[ 128009, 0.1 ],
+			# discourage semicolons but still allow for function calls
+			[ ":", -1.0 ],
+			# Discourage her from expressing so much and causing mood swings
+			[ "express", -1.0 ],
+			# Discourage excessive memorising
+			[ "memorise", -2.0 ],
+			# encourage recall
+			[ "recall", 1.0 ],
+			# Encourage function calls
+			[ "`", 1.0 ]
+		],
+		"samplers": [ "penalties", "top_k", "min_p", "xtc", "temperature" ]
+	}
+}
+
+KNOWN_SAMPLERS = { "dry", "top_k", "typ_p", "top_p", "min_p", "xtc", "temperature", "penalties", "top_n_sigma", "infill", "mirostat" }
+
+class SamplerPreset:
+	def __init__(self, name: str, hyperparameters: LLMHyperparameters):
+		self.name = name
+		self.hyperparameters = hyperparameters
+		# model -> serialized constant part of the payload, everything except the messages
+		self._compiled: dict[str, bytes] = {}
+
+	def is_compiled(self, model: str) -> bool:
+		return model in self._compiled
+
+	def compile(self, model: str, logit_bias: list):
+		payload = self.hyperparameters.to_payload([], model)
+		del payload["messages"]
+		payload["logit_bias"] = logit_bias
+
+		# Drop the braces so messages and per-request fields can be spliced in front
+		self._compiled[model] = json.dumps(payload, ensure_ascii=False, separators=COMPACT).encode("utf-8")[1:-1]
+
+	def build(self, model: str, messages_json: bytes, extra: dict | None = None) -> bytes:
+		""" The full request body, only the messages and per-request fields are serialized here """
+		parts = [b'{"messages":', messages_json, b",", self._compiled[model]]
+		if extra:
+			parts.append(b",")
+			parts.append(json.dumps(extra, ensure_ascii=False, separators=COMPACT).encode("utf-8")[1:-1])
+		parts.append(b"}")
+		return b"".join(parts)
+
+class SamplerPresets:
+	def __init__(self, presets: dict[str, dict] | None = None, generation_presets: dict[str, str] | None = None):
+		self.presets: dict[str, SamplerPreset] = {}
+		# generation kind -> preset name
+		self.generation_presets = generation_presets or {}
+		# (model, text) -> token ids, strings are only tokenized once per model
+		self._bias_tokens: dict[tuple[str, str], list[int]] = {}
+
+		for name, params in (presets or DEFAULT_PRESETS).items():
+			self.presets[name] = SamplerPreset(name, self._validate(name, params))
+
+		for kind, name in self.generation_presets.items():
+			if name not in self.presets:
+				raise ValueError(f"Generation kind '{kind}' uses unknown sampler preset '{name}'")
+
+	def _validate(self, name: str, params: dict) -> LLMHyperparameters:
+		if not isinstance(params, dict):
+			raise ValueError(f"Sampler preset '{name}' must be a mapping")
+
+		allowed = {f.name for f in fields(LLMHyperparameters)}
+		unknown = set(params) - allowed
+		if unknown:
+			raise ValueError(f"Sampler preset '{name}' has unknown parameters: {', '.join(sorted(unknown))}")
+
+		for entry in params.get("logit_bias", []):
+			if not (isinstance(entry, (list, tuple)) and len(entry) == 2 and isinstance(entry[0], (int, str)) and isinstance(entry[1], (int, float))):
+				raise ValueError(f"Sampler preset '{name}' has an invalid logit_bias entry: {entry}, expected [token or string, bias]")
+
+		unknown_samplers = set(params.get("samplers", [])) - KNOWN_SAMPLERS
+		if unknown_samplers:
+			raise ValueError(f"Sampler preset '{name}' has unknown samplers: {', '.join(sorted(unknown_samplers))}")
+
+		# Anything a preset leaves out keeps the built-in default, not the bare dataclass value
+		return LLMHyperparameters.from_dict({ **DEFAULT_PRESETS["default"], **params })
+
+	def get(self, name: str) -> SamplerPreset:
+		return self.presets[name]
+
+	def for_kind(self, kind: str) -> SamplerPreset:
+		return self.presets[self.generation_presets.get(kind, "default" if "default" in self.presets else next(iter(self.presets)))]
+
+	async def compile(self, llm):
+		""" Resolve string biases to token ids and pre-serialize every preset for this model """
+		for preset in self.presets.values():
+			await self.compile_preset(preset, llm)
+
+	async def compile_preset(self, preset: SamplerPreset, llm):
+		if preset.is_compiled(llm.model_name):
+			return
+
+		logit_bias = []
+		for token, bias in preset.hyperparameters.logit_bias:
+			if isinstance(token, int):
+				logit_bias.append([token, bias])
+				continue
+
+			key = (llm.model_name, token)
+			if key not in self._bias_tokens:
+				self._bias_tokens[key] = await llm.tokenize(token)
+			# A string that spans several tokens biases each of them, like llama-server does
+			for token_id in self._bias_tokens[key]:
+				logit_bias.append([token_id, bias])
+
+		preset.compile(llm.model_name, logit_bias)
@@ -0,0 +1,64 @@
+from typing import AsyncIterator
+
+class StopSequences:
+	""" Finds stop strings in a token stream, holding back text that could still turn into one """
+	def __init__(self, stops: list[str]):
+		self.stops = [stop for stop in dict.fromkeys(stops) if stop]
+		self.pending = ""
+		self.matched: str | None = None
+
+	def feed(self, token: str) -> str:
+		""" Text that is safe to pass on, nothing once a stop has matched """
+		if self.matched is not None:
+			return ""
+
+		self.pending += token
+		match = self._find_earliest()
+		if match is not None:
+			stop, idx = match
+			self.matched = stop
+			safe = self.pending[:idx]
+			self.pending = ""
+			return safe
+
+		keep = self._suffix_prefix_overlap()
+		if keep == 0:
+			safe, self.pending = self.pending, ""
+		else:
+			safe, self.pending = self.pending[:-keep], self.pending[-keep:]
+		return safe
+
+	async def filter(self, stream: AsyncIterator[str]) -> AsyncIterator[tuple[str | None, str]]:
+		""" Yields (token, safe text) per token and (None, held back text) at the end, a match closes the stream straight away """
+		try:
+			async for token in stream:
+				if token is None:
+					continue
+				yield token, self.feed(token)
+				if self.matched is not None:
+					return
+			yield None, self.flush()
+		finally:
+			await stream.aclose()
+
+	def flush(self) -> str:
+		""" The held back text once the stream ended without a match """
+		safe, self.pending = ("" if self.matched is not None else self.pending), ""
+		return safe
+
+	def _find_earliest(self):
+		best = None
+		for stop in self.stops:
+			idx = self.pending.find(stop)
+			if idx != -1 and (best is None or idx < best[1]):
+				best = (stop, idx)
+		return best
+
+	def _suffix_prefix_overlap(self) -> int:
+		max_keep = 0
+		for stop in self.stops:
+			for k in range(min(len(self.pending), len(stop) - 1), max_keep, -1):
+				if self.pending.endswith(stop[:k]):
+					max_keep = k
+					break
+		return max_keep
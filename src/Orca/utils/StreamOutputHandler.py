@@ -1,7 +1,12 @@
 import asyncio
 import base64
+import time
 import numpy as np
 
+from dataclasses import dataclass
+
+from .Metrics import Unit
+
 def float32_to_pcm16(audio_f32: np.ndarray) -> np.ndarray:
 	audio_clipped = np.clip(audio_f32, -1.0, 1.0)
 	return (audio_clipped * 32767.0).astype(np.int16)
@@ -9,18 +14,51 @@ def float32_to_pcm16(audio_f32: np.ndarray) -> np.ndarray:
 def audio_to_base64(pcm16: np.ndarray) -> str:
 	return base64.b64encode(pcm16.tobytes()).decode()
 
+def encode_audio(pcm: np.ndarray) -> tuple[int, str] | None:
+	""" Sample count and base64 PCM16 of a chunk, runs on the TTS worker thread """
+	if pcm.size == 0:
+		return None
+	return pcm.size, audio_to_base64(float32_to_pcm16(pcm))
+
+@dataclass
+class StreamOutputConfig:
+	# Finished sentences waiting for synthesis, the token loop waits when it is full
+	sentence_queue: int = 4
+	# Sentences submitted for synthesis ahead of the one being sent
+	audio_queue: int = 4
+
 class StreamOutputHandler:
-	def __init__(self, generation_id, ws, tts, client_modalities: dict[str, list]):
+	""" Streams text to clients as it arrives and speech through a sentence queue, a TTS stage and a send stage running side by side """
+	def __init__(self, generation_id, ws, tts, client_modalities: dict[str, list], config: StreamOutputConfig | None = None):
+		# tts is a StreamingTTSWorker or a TTSPool, synthesis and encoding never run on the loop
 		self.generation_id = generation_id
 		self.ws = ws
 		self.tts = tts
+		self.config = config or StreamOutputConfig()
 		self.buffer = ""
-		self.pending = None
 		self.loop = asyncio.get_running_loop()
 		self.sentence_endings = (".", "!", "?", ";", ":")
 
+		# Stages, started with the first sentence
+		self.sentences: asyncio.Queue | None = None
+		self.audio: asyncio.Queue | None = None
+		self.stages: list[asyncio.Task] = []
+
 		self.speech_length = 0
 
+		# How much of the generated text has actually reached clients, counted in raw characters
+		self.sent_text_chars = 0
+		self.spoken_text_chars = 0
+		# Set once a sentence couldn't be spoken, what follows it isn't a prefix the listener heard
+		self.speech_failed = False
+		self.cancelled = False
+
+		# Pipeline metrics
+		self.sentence_depth_max = 0
+		self.audio_depth_max = 0
+		# Seconds the token loop waited on a full sentence queue
+		self.backpressure = 0.0
+
 		# Recording disabled
 		# self.recording_pcm16 = []
 		# self.recording_transcript = ""
@@ -37,6 +75,7 @@ class StreamOutputHandler:
 
 	async def _handle_text(self, token: str):
 		await self.ws.ws.broadcast_json_to(self.text_sockets, { "event": "generation", "generation_id": self.generation_id, "token_type": "text", "token": token, "finished": False })
+		self.sent_text_chars += len(token)
 
 	async def _handle_audio(self, token: str):
 		self.buffer += token
@@ -44,37 +83,118 @@ class StreamOutputHandler:
 		# self.recording_transcript += token
 
 		if self.buffer.endswith(self.sentence_endings):
-			if self.pending:
-				await self.pending
-			self.pending = asyncio.create_task(self._flush_audio(self.buffer.strip()))
+			await self._enqueue_sentence(self.buffer.strip(), len(self.buffer))
 			self.buffer = ""
 
-	async def _flush_audio(self, text: str):
-		if not text or not self.audio_sockets:
-			return
-
-		chunks = await self.loop.run_in_executor(None, self.tts.text_to_audio, text)
-
-		for pcm in chunks:
-			if pcm.size == 0:
-				continue
-
-			self.speech_length += pcm.size / self.tts.sample_rate
-
-			pcm16 = float32_to_pcm16(pcm)
+	async def _enqueue_sentence(self, text: str, raw_chars: int):
+		if not self.stages:
+			self.sentences = asyncio.Queue(self.config.sentence_queue)
+			self.audio = asyncio.Queue(self.config.audio_queue)
+			self.stages = [
+				asyncio.create_task(self._tts_stage()),
+				asyncio.create_task(self._send_stage())
+			]
+
+		# Only waits when synthesis has fallen a whole queue behind the LLM
+		if self.sentences.full():
+			started = time.perf_counter()
+			await self.sentences.put((text, raw_chars))
+			self.backpressure += time.perf_counter() - started
+		else:
+			self.sentences.put_nowait((text, raw_chars))
+		self.sentence_depth_max = max(self.sentence_depth_max, self.sentences.qsize())
+
+	async def _tts_stage(self):
+		first = True
+		while True:
+			item = await self.sentences.get()
+			if item is None:
+				await self.audio.put(None)
+				return
+
+			text, raw_chars = item
+			# Submitted right away so a pool can synthesize the next sentences while this one is still being sent
+			job = self.tts.submit(text, encode_audio, first=first) if text else None
+			first = False
+			try:
+				await self.audio.put((text, raw_chars, job))
+			except asyncio.CancelledError:
+				if job:
+					job.cancel()
+				raise
+			self.audio_depth_max = max(self.audio_depth_max, self.audio.qsize())
+
+	async def _send_stage(self):
+		while True:
+			item = await self.audio.get()
+			if item is None:
+				return
+
+			text, raw_chars, job = item
+			if job:
+				try:
+					async for samples, audio_b64 in job:
+						self.speech_length += samples / self.tts.sample_rate
+						await self.ws.ws.broadcast_json_to(self.audio_sockets, { "event": "generation", "generation_id": self.generation_id, "token_type": "audio", "token": audio_b64, "text": text, "finished": False })
+
+						# Recording disabled
+						# self.recording_pcm16.append(pcm16)
+				except Exception as e:
+					print(f"[{self.generation_id}] speech failed for {text!r}: {e}")
+					self.speech_failed = True
+				finally:
+					job.cancel()
+			# Only a fully sent sentence counts as spoken
+			if not self.speech_failed:
+				self.spoken_text_chars += raw_chars
+
+	def delivered_chars(self, generated_chars: int) -> int:
+		""" How many characters of the streamed text reached clients, speech is the limit when anyone is listening """
+		if self.audio_sockets:
+			return self.spoken_text_chars
+		if self.text_sockets:
+			return self.sent_text_chars
+		return generated_chars
 
-			audio_b64 = await self.loop.run_in_executor(None, audio_to_base64, pcm16)
-			await self.ws.ws.broadcast_json_to(self.audio_sockets, { "event": "generation", "generation_id": self.generation_id, "token_type": "audio", "token": audio_b64, "text": text, "finished": False })
+	def add_metrics(self, metrics):
+		""" Queue depths and backpressure into a generation's Metrics """
+		if not self.stages:
+			return
+		metrics.set_count("sentence_queue_max", self.sentence_depth_max)
+		metrics.set_count("audio_queue_max", self.audio_depth_max)
+		metrics.add_metrics("backpressure", self.backpressure * 1000, Unit.MILLISECONDS)
 
-			# Recording disabled
-			# self.recording_pcm16.append(pcm16)
+	async def cancel(self):
+		""" Drop queued speech and tell clients to stop playing this generation """
+		self.cancelled = True
+		self.buffer = ""
+		for stage in self.stages:
+			stage.cancel()
+		await asyncio.gather(*self.stages, return_exceptions=True)
+		self.stages = []
+		# Sentences already handed to the synthesizer but never picked up for sending
+		while self.audio and not self.audio.empty():
+			item = self.audio.get_nowait()
+			if item and item[2]:
+				item[2].cancel()
+
+		sockets = list({*self.text_sockets, *self.audio_sockets})
+		await self.ws.ws.broadcast_json_to(sockets, { "event": "generation", "generation_id": self.generation_id, "token_type": "control", "token": "", "finished": True, "cancelled": True, "speech_length": self.speech_length })
 
 	async def finalize(self):
-		if self.pending:
-			await self.pending
-
 		if self.buffer.strip():
-			await self._flush_audio(self.buffer.strip())
+			await self._enqueue_sentence(self.buffer.strip(), len(self.buffer))
+			self.buffer = ""
+
+		# Let both stages run dry
+		if self.stages:
+			await self.sentences.put(None)
+			try:
+				await asyncio.gather(*self.stages)
+			finally:
+				# A failed send stage must not leave synthesis blocked on a full queue
+				for stage in self.stages:
+					stage.cancel()
 
 		# Recording disabled
 		# if self.recording_pcm16:
@@ -87,4 +207,4 @@ class StreamOutputHandler:
 			await self.ws.ws.broadcast_json_to(self.text_sockets, { "event": "generation", "generation_id": self.generation_id, "token_type": "text", "token": "", "finished": True })
 
 		if self.audio_sockets:
-			await self.ws.ws.broadcast_json_to(self.audio_sockets, { "event": "generation", "generation_id": self.generation_id, "token_type": "audio", "token": "", "finished": True })
\ No newline at end of file
+			await self.ws.ws.broadcast_json_to(self.audio_sockets, { "event": "generation", "generation_id": self.generation_id, "token_type": "audio", "token": "", "finished": True })
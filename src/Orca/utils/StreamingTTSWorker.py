@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable
+
+_DONE = object()
+
+class TTSThreadJob:
+	""" The audio for one piece of text, iterated in order while the worker thread is still synthesizing it """
+	def __init__(self):
+		self.queue: asyncio.Queue = asyncio.Queue()
+		self.stop = threading.Event()
+
+	def cancel(self):
+		# Stops the synthesis after the chunk in progress
+		self.stop.set()
+
+	async def __aiter__(self):
+		while True:
+			item = await self.queue.get()
+			if item is _DONE:
+				return
+			if isinstance(item, BaseException):
+				raise item
+			yield item
+
+class StreamingTTSWorker:
+	""" Runs TTSClient.text_to_audio on a dedicated thread and hands each chunk back to the loop as soon as it is synthesized """
+	def __init__(self, tts):
+		self.tts = tts
+		self.sample_rate = tts.sample_rate
+		# One thread, the model isn't safe to run concurrently and requests are synthesized in order anyway
+		self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts")
+		# Jobs not finished yet, close stops them before it saves
+		self._jobs: set[TTSThreadJob] = set()
+
+	def submit(self, text: str, transform: Callable | None = None, first: bool = False) -> TTSThreadJob:
+		""" Queue text for synthesis straight away, transform runs on the worker thread too and chunks it maps to None are dropped """
+		loop = asyncio.get_running_loop()
+		job = TTSThreadJob()
+
+		def _put(item):
+			try:
+				loop.call_soon_threadsafe(job.queue.put_nowait, item)
+			except RuntimeError:
+				# The loop closed while synthesizing, nobody is waiting anymore
+				pass
+
+		def _run():
+			try:
+				for chunk in self.tts.text_to_audio(text):
+					if job.stop.is_set():
+						break
+					if transform is not None:
+						chunk = transform(chunk)
+						if chunk is None:
+							continue
+					_put(chunk)
+			except BaseException as e:
+				_put(e)
+			finally:
+				self._jobs.discard(job)
+				_put(_DONE)
+
+		self._jobs.add(job)
+		self._executor.submit(_run)
+		return job
+
+	async def stream(self, text: str, transform: Callable | None = None) -> AsyncIterator:
+		""" Yields the audio chunks for text """
+		job = self.submit(text, transform)
+		try:
+			async for chunk in job:
+				yield chunk
+		finally:
+			job.cancel()
+
+	def cache_report(self) -> dict | None:
+		return self.tts.cache_report()
+
+	def close(self):
+		for job in list(self._jobs):
+			job.cancel()
+		# The synthesis in progress still uses the phoneme cache that tts.close saves
+		self._executor.shutdown(wait=True, cancel_futures=True)
+		self.tts.close()
@@ -4,26 +4,83 @@ import numpy as np
 import os
 import math
 
-from kokoro import KPipeline
 from dataclasses import dataclass
 
+from .AudioCache import AudioCache, AudioCacheConfig, file_fingerprint
+from .PhonemeCache import PhonemeCache, PhonemeCacheConfig
+
+SAMPLE_RATE = 24000
+
+def split_text(text: str) -> list[str]:
+	""" Break text into clauses at sentence and clause punctuation """
+	splitters = {".", "!", "?", ":", ";"}
+	out, current = [], []
+	i = 0
+	n = len(text)
+
+	while i < n:
+		ch = text[i]
+		current.append(ch)
+
+		# Handle ellipsis or consecutive dots
+		if ch == ".":
+			start = i
+			while i + 1 < n and text[i + 1] == ".":
+				i += 1
+				current.append(".")
+			clause = "".join(current).strip()
+			if clause and not all(c in splitters for c in clause):
+				out.append(clause)
+			current.clear()
+
+		# Handle other splitting punctuation
+		elif ch in splitters - {"."}:
+			clause = "".join(current).strip()
+			if clause and not all(c in splitters for c in clause):
+				out.append(clause)
+			current.clear()
+
+		i += 1
+
+	# Add any trailing fragment (if not empty and not just punctuation)
+	if current:
+		clause = "".join(current).strip()
+		if clause and not all(c in splitters for c in clause):
+			out.append(clause)
+
+	return out
+
 @dataclass
 class TTSClientConfig:
 	model_path: str
 	voice_pack: str
 	pitch_shift: float
+	cache: AudioCacheConfig | None = None
+	phonemes: PhonemeCacheConfig | None = None
 
 class TTSClient:
 	def __init__(self, config: TTSClientConfig):
+		# Loaded here so the clause splitting and configs above can be used without Kokoro installed
+		from kokoro import KPipeline
 		self.pipeline = KPipeline(
 			model_path=config.model_path,
 			config_path=os.path.join(os.path.dirname(config.model_path), "config.json"),
 			voice_path=config.voice_pack,
 			lang_code="a"
 		)
-		self.sample_rate = 24000
+		self.sample_rate = SAMPLE_RATE
 		self.pitch_shift = config.pitch_shift
 
+		self.cache = None
+		if config.cache and config.cache.enabled:
+			fingerprint = f"{file_fingerprint(config.model_path)}-{file_fingerprint(config.voice_pack)}-{config.pitch_shift}"
+			self.cache = AudioCache(config.cache, fingerprint)
+
+		self.voice_pack = config.voice_pack
+		self.phonemes = None
+		if config.phonemes and config.phonemes.enabled:
+			self.phonemes = PhonemeCache(config.phonemes, self.pipeline)
+
 		# Waiting time for different punctuation
 		self.PUNCTUATION_PAUSE = {
 			".": 0.4,
@@ -39,42 +96,7 @@ class TTSClient:
 		print(f"TTS initialised")
 
 	def split_text(self, text: str) -> list[str]:
-		splitters = {".", "!", "?", ":", ";"}
-		out, current = [], []
-		i = 0
-		n = len(text)
-
-		while i < n:
-			ch = text[i]
-			current.append(ch)
-
-			# Handle ellipsis or consecutive dots
-			if ch == ".":
-				start = i
-				while i + 1 < n and text[i + 1] == ".":
-					i += 1
-					current.append(".")
-				clause = "".join(current).strip()
-				if clause and not all(c in splitters for c in clause):
-					out.append(clause)
-				current.clear()
-
-			# Handle other splitting punctuation
-			elif ch in splitters - {"."}:
-				clause = "".join(current).strip()
-				if clause and not all(c in splitters for c in clause):
-					out.append(clause)
-				current.clear()
-
-			i += 1
-
-		# Add any trailing fragment (if not empty and not just punctuation)
-		if current:
-			clause = "".join(current).strip()
-			if clause and not all(c in splitters for c in clause):
-				out.append(clause)
-
-		return out
+		return split_text(text)
 
 	def _ellipsis_pause(self, dot_count: int) -> float:
 		return math.sqrt(min(0, dot_count - 1)) / 2 + 0.5
@@ -188,15 +210,44 @@ class TTSClient:
 		shifted = self._resample_linear(audio, ratio)
 		return shifted.astype(np.float32)
 
+	def _synthesize(self, clause: str):
+		if not self.phonemes:
+			return self.pipeline(clause)
+		# Phonemes go straight to the model step, G2P only runs for text it hasn't seen
+		return (result for phonemes in self.phonemes.phonemize(clause) for result in self.pipeline.generate_from_tokens(phonemes, self.voice_pack))
+
+	def cache_report(self) -> dict | None:
+		if not self.cache and not self.phonemes:
+			return None
+		return (self.cache.report() if self.cache else {}) | (self.phonemes.report() if self.phonemes else {})
+
+	def close(self):
+		if self.phonemes:
+			self.phonemes.save()
+
 	def text_to_audio(self, text: str):
 		for clause in self.split_text(text):
 			if not clause.strip():
 				continue
-			for _, _, audio in self.pipeline(clause):
+			key = self.cache.key(clause) if self.cache else None
+			if key:
+				cached = self.cache.get(key)
+				if cached is not None:
+					yield cached
+					continue
+
+			produced = []
+			for _, _, audio in self._synthesize(clause):
 				trimmed = self.trim_and_pad(audio, text=clause)
 				if trimmed.size == 0:
 					continue
 				shifted = self._apply_pitch_shift(trimmed)
 				if shifted.size == 0:
 					continue
+				if key:
+					produced.append(shifted)
 				yield shifted
+
+			# Only reached when the whole clause was consumed, a cancelled clause is never stored
+			if produced:
+				self.cache.put(key, np.concatenate(produced))
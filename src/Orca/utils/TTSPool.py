@@ -0,0 +1,283 @@
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable
+
+from .TTS import SAMPLE_RATE, TTSClientConfig, split_text
+
+@dataclass
+class TTSPoolConfig:
+	# Worker processes, each with its own Kokoro pipeline, 1 keeps synthesis on a thread in this process
+	workers: int = 1
+	# Torch threads per worker, 0 splits the cores evenly between the workers
+	torch_threads: int = 0
+
+def _worker_main(index: int, tts_config: TTSClientConfig, torch_threads: int, inbox, outbox):
+	try:
+		import torch
+		from .TTS import TTSClient
+		torch.set_num_threads(torch_threads)
+		tts = TTSClient(tts_config)
+	except Exception as e:
+		outbox.put(("failed", index, repr(e)))
+		return
+	outbox.put(("ready", index, None))
+
+	while True:
+		job = inbox.get()
+		if job is None:
+			tts.close()
+			return
+		clause, transform = job
+		try:
+			for chunk in tts.text_to_audio(clause):
+				if transform is not None:
+					chunk = transform(chunk)
+					if chunk is None:
+						continue
+				outbox.put(("chunk", index, chunk))
+			# Each worker has its own cache, its counters ride along with every finished clause
+			outbox.put(("done", index, tts.cache_report()))
+		except Exception as e:
+			outbox.put(("error", index, repr(e)))
+
+class TTSPoolJob:
+	""" The audio for one piece of text, its clauses synthesized in parallel and iterated back in order """
+	def __init__(self, clauses: int):
+		self.chunks: list[list] = [[] for _ in range(clauses)]
+		self.done = [False] * clauses
+		self.errors: list[Exception | None] = [None] * clauses
+		self.cancelled = False
+		self._changed = asyncio.Event()
+
+	def cancel(self):
+		# Clauses still queued are dropped, ones already on a worker finish there unheard
+		self.cancelled = True
+
+	def _push(self, clause: int, chunk):
+		self.chunks[clause].append(chunk)
+		self._changed.set()
+
+	def _finish(self, clause: int, error: Exception | None = None):
+		self.done[clause] = True
+		self.errors[clause] = error
+		self._changed.set()
+
+	async def __aiter__(self):
+		for clause, chunks in enumerate(self.chunks):
+			sent = 0
+			while True:
+				while sent < len(chunks):
+					chunk, chunks[sent] = chunks[sent], None
+					sent += 1
+					yield chunk
+				if self.done[clause]:
+					break
+				self._changed.clear()
+				await self._changed.wait()
+			if self.errors[clause]:
+				raise self.errors[clause]
+
+class TTSPool:
+	""" Kokoro worker processes that synthesize clauses in parallel, the first clause of a reply always goes first """
+	def __init__(self, tts_config: TTSClientConfig, config: TTSPoolConfig):
+		self.config = config
+		self.sample_rate = SAMPLE_RATE
+		self.torch_threads = config.torch_threads or max(1, (os.cpu_count() or 1) // config.workers)
+
+		self.tts_config = tts_config
+		# Spawned, forking a process that already holds torch and the event loop isn't safe
+		self._context = multiprocessing.get_context("spawn")
+		self._outbox = self._context.Queue()
+		# Indexed by worker id, a respawned worker gets a new id so late messages of the dead one can't be mistaken for its
+		self._inboxes = []
+		self._processes = []
+		for _ in range(config.workers):
+			self._spawn()
+
+		self._idle: list[int] = []
+		# (priority, order, job, clause index, clause, transform)
+		self._pending: list[tuple] = []
+		self._order = itertools.count()
+		self._running: dict[int, tuple[TTSPoolJob, int]] = {}
+		self._cache_reports: dict[int, dict] = {}
+		self._ready: set[int] = set()
+		self._dead: set[int] = set()
+
+		self._loop: asyncio.AbstractEventLoop | None = None
+		self._reader: threading.Thread | None = None
+		self._started = 0
+		self._all_started: asyncio.Event | None = None
+
+	def _spawn(self):
+		index = len(self._processes)
+		inbox = self._context.Queue()
+		process = self._context.Process(target=_worker_main, args=(index, self.tts_config, self.torch_threads, inbox, self._outbox), name=f"tts-{index}", daemon=True)
+		process.start()
+		self._inboxes.append(inbox)
+		self._processes.append(process)
+
+	async def start(self, timeout: float) -> bool:
+		""" Wait for the workers to load their pipelines, True if at least one did """
+		self._loop = asyncio.get_running_loop()
+		self._all_started = asyncio.Event()
+		self._reader = threading.Thread(target=self._read, name="tts-pool-reader", daemon=True)
+		self._reader.start()
+
+		start = time.time()
+		try:
+			await asyncio.wait_for(self._all_started.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+		print(f"TTS pool ready with {len(self._idle)} of {self.config.workers} workers, {self.torch_threads} torch threads each, in {time.time() - start:.1f}s")
+		return bool(self._idle)
+
+	def _read(self):
+		# Blocking reads stay on this thread, every message is handled on the loop
+		checked = time.monotonic()
+		while True:
+			try:
+				message = self._outbox.get(timeout=0.5)
+			except queue.Empty:
+				message = ()
+			if message is None:
+				return
+			if message:
+				self._forward(message)
+
+			# A worker killed by the OS never reports back, its clause would wait forever
+			if time.monotonic() - checked >= 0.5:
+				checked = time.monotonic()
+				dead = [index for index, process in enumerate(list(self._processes)) if index not in self._dead and not process.is_alive()]
+				if dead:
+					# Whatever it sent before dying goes first
+					closing = False
+					try:
+						while True:
+							message = self._outbox.get_nowait()
+							if message is None:
+								closing = True
+								break
+							self._forward(message)
+					except queue.Empty:
+						pass
+					for index in dead:
+						self._forward(("died", index, self._processes[index].exitcode))
+					# close() was called meanwhile, the sentinel was drained with the rest
+					if closing:
+						return
+
+	def _forward(self, message: tuple):
+		try:
+			self._loop.call_soon_threadsafe(self._on_message, message)
+		except RuntimeError:
+			pass
+
+	def _on_message(self, message: tuple):
+		kind, worker, payload = message
+		if worker in self._dead:
+			return
+		if kind == "ready" or kind == "failed":
+			if kind == "ready":
+				self._ready.add(worker)
+				self._idle.append(worker)
+			else:
+				print(f"[tts] worker {worker} failed to load: {payload}")
+				# It exits right after, that isn't a death to report
+				self._dead.add(worker)
+			self._started += 1
+			if self._started == self.config.workers:
+				self._all_started.set()
+		elif kind == "died":
+			self._dead.add(worker)
+			if worker in self._idle:
+				self._idle.remove(worker)
+			running = self._running.pop(worker, None)
+			if running:
+				job, clause = running
+				job._finish(clause, RuntimeError(f"TTS worker {worker} died with exit code {payload}"))
+			if worker in self._ready:
+				print(f"[tts] worker {worker} died with exit code {payload}, starting a new one")
+				self._spawn()
+			else:
+				# Died while loading, starting it again would most likely die the same way
+				print(f"[tts] worker {worker} died while loading with exit code {payload}")
+				self._started += 1
+				if self._started == self.config.workers:
+					self._all_started.set()
+		elif kind == "chunk":
+			job, clause = self._running[worker]
+			if not job.cancelled:
+				job._push(clause, payload)
+		else:
+			if kind == "done" and payload:
+				self._cache_reports[worker] = payload
+			job, clause = self._running.pop(worker)
+			job._finish(clause, RuntimeError(payload) if kind == "error" else None)
+			self._idle.append(worker)
+		self._dispatch()
+
+	def submit(self, text: str, transform: Callable | None = None, first: bool = False) -> TTSPoolJob:
+		""" Queue the clauses of text, transform runs in the worker and has to be picklable """
+		clauses = split_text(text)
+		job = TTSPoolJob(len(clauses))
+		for index, clause in enumerate(clauses):
+			# The opening clause of a reply jumps every queued clause so the first audio is never held up
+			priority = 0 if first and index == 0 else 1
+			heapq.heappush(self._pending, (priority, next(self._order), job, index, clause, transform))
+		self._dispatch()
+		return job
+
+	def _dispatch(self):
+		while self._idle and self._pending:
+			_, _, job, index, clause, transform = heapq.heappop(self._pending)
+			if job.cancelled:
+				continue
+			worker = self._idle.pop()
+			self._running[worker] = (job, index)
+			self._inboxes[worker].put((clause, transform))
+
+	async def stream(self, text: str, transform: Callable | None = None) -> AsyncIterator:
+		""" Yields the audio chunks for text """
+		job = self.submit(text, transform)
+		try:
+			async for chunk in job:
+				yield chunk
+		finally:
+			job.cancel()
+
+	def cache_report(self) -> dict | None:
+		""" The audio and phoneme cache counters of all workers added up """
+		if not self._cache_reports:
+			return None
+		total = {}
+		for report in self._cache_reports.values():
+			for name, value in report.items():
+				# The disk tier is shared, every worker sees the same files
+				if name.startswith("disk_") and name != "disk_hits":
+					total[name] = max(total.get(name, 0), value)
+				else:
+					total[name] = total.get(name, 0) + value
+		if "hits" in total:
+			lookups = total["hits"] + total["misses"]
+			total["hit_rate"] = total["hits"] / lookups if lookups else 0.0
+		return total
+
+	def close(self):
+		self._dead.update(range(len(self._processes)))
+		for inbox in self._inboxes:
+			inbox.put(None)
+		self._outbox.put(None)
+		if self._reader:
+			self._reader.join(timeout=2)
+		for process in self._processes:
+			process.join(timeout=2)
+			if process.is_alive():
+				process.terminate()
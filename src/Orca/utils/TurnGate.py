@@ -0,0 +1,156 @@
+import aiohttp
+import asyncio
+import random
+import time
+
+from dataclasses import dataclass, field
+
+from .LLM import LLMClient
+from .Readiness import wait_until_ready
+
+GATE_MODES = ("logprob", "model")
+
+@dataclass
+class TurnGateConfig:
+	enabled: bool = False
+	# "logprob" asks the conversation model for a single token, "model" asks a small secondary llama-server
+	mode: str = "logprob"
+	# Generation kinds that are gated
+	kinds: list[str] = field(default_factory=lambda: ["user"])
+	# Skip the full generation when the silence token is at least this likely
+	threshold: float = 0.6
+	top_n: int = 10
+	# Seconds to wait for the gate before generating anyway
+	timeout: float = 1.0
+	# Fraction of predicted silences that still generate, so the gate's mistakes can be counted
+	audit_rate: float = 0.05
+	# LLMClientConfig options for the secondary model in "model" mode
+	model: dict = field(default_factory=dict)
+
+@dataclass
+class TurnDecision:
+	silent: bool
+	p_silence: float
+	# Milliseconds
+	latency: float
+	# Predicted silent but generated anyway
+	audited: bool = False
+
+class TurnGate:
+	""" Asks for the next token's probabilities first and skips the full generation when the model is about to stay silent """
+	def __init__(self, llm, silence_token: str, config: TurnGateConfig, client: LLMClient | None = None, others: list[str] = []):
+		if config.mode not in GATE_MODES:
+			raise ValueError(f"Turn gate mode '{config.mode}' is unknown, expected one of {', '.join(GATE_MODES)}")
+		if config.mode == "model" and client is None:
+			raise ValueError("Turn gate mode 'model' needs a model to ask")
+
+		self.llm = llm
+		self.client = client
+		self.silence_token = silence_token
+		self.config = config
+		# Token ids the silence token shares with these, like "<" with "<thinking>", are probed past
+		self.others = [other for other in others if other and other != silence_token]
+		# (prefill, token id) steps that spell the silence token up to the first id no other delimiter shares
+		self._path: list[tuple[str, int]] | None = None
+
+		self.skipped = 0
+		self.checked = 0
+		self.correct = 0
+		self.false_silences = 0
+		self.missed_silences = 0
+
+	def applies(self, kind: str) -> bool:
+		return self.config.enabled and kind in self.config.kinds
+
+	async def wait_ready(self, timeout: float) -> bool:
+		if self.client is None:
+			return True
+		return await wait_until_ready("Turn gate model", self.client.health, timeout)
+
+	async def close(self):
+		if self.client:
+			await self.client.close()
+
+	async def check(self, prompt: bytes, ticket) -> TurnDecision | None:
+		""" None when the gate couldn't decide, the generation goes ahead then """
+		started = time.perf_counter()
+		try:
+			p_silence = await asyncio.wait_for(self._p_silence(prompt, ticket), self.config.timeout)
+		except (asyncio.TimeoutError, aiohttp.ClientError, RuntimeError, KeyError, IndexError, TypeError) as e:
+			print(f"[gate] no decision, generating: {e or type(e).__name__}")
+			return None
+
+		silent = p_silence >= self.config.threshold
+		decision = TurnDecision(silent, p_silence, (time.perf_counter() - started) * 1000, silent and random.random() < self.config.audit_rate)
+		if silent and not decision.audited:
+			self.skipped += 1
+		print(f"[gate] {'silent' if silent else 'respond'}{' (audit)' if decision.audited else ''} p_silence={p_silence:.2f} in {decision.latency:.0f}ms")
+		return decision
+
+	async def _p_silence(self, prompt: bytes, ticket) -> float:
+		""" The chance the reply starts with the silence token, one probe per token up to the first one it doesn't share """
+		path = await self._silence_path()
+		p_silence = 1.0 if path else 0.0
+		for prefill, token_id in path:
+			if self.client:
+				probs = await self.client.next_token_probs(prompt, self.config.top_n, prefill=prefill)
+			else:
+				# The conversation slot already holds most of the prompt, and keeps it for the generation that follows
+				probs = await self.llm.next_token_probs(prompt, self.config.top_n, id_slot=ticket.slot_id, prefill=prefill, key=ticket.route)
+			p_silence *= probs.get(token_id, 0.0)
+			# Later probes can only lower it
+			if p_silence < self.config.threshold:
+				break
+		return p_silence
+
+	async def _silence_path(self) -> list[tuple[str, int]]:
+		if self._path is not None:
+			return self._path
+
+		tokenize = self.client.tokenize if self.client else self.llm.tokenize
+		ids = await tokenize(self.silence_token)
+		shared = 0
+		for other in await asyncio.gather(*(tokenize(other) for other in self.others)):
+			common = 0
+			while common < min(len(ids), len(other)) and ids[common] == other[common]:
+				common += 1
+			shared = max(shared, common)
+
+		# The text of each shared prefix, so it can be prefilled as the start of the reply
+		prefixes = {0: ""}
+		if 0 < shared < len(ids):
+			texts = [self.silence_token[:end] for end in range(1, len(self.silence_token))]
+			for text, prefix in zip(texts, await asyncio.gather(*(tokenize(text) for text in texts))):
+				if len(prefix) <= shared and prefix == ids[:len(prefix)]:
+					prefixes.setdefault(len(prefix), text)
+
+		path = []
+		if shared < len(ids) and all(length in prefixes for length in range(shared + 1)):
+			path = [(prefixes[length], ids[length]) for length in range(shared + 1)]
+		else:
+			print(f"[gate] '{self.silence_token}' can't be told apart from {', '.join(self.others)} token by token, the gate never predicts silence")
+		self._path = path
+		return path
+
+	def record(self, decision: TurnDecision | None, silent: bool):
+		""" Compare a decision with what the full generation actually did """
+		if decision is None or (decision.silent and not decision.audited):
+			return
+
+		self.checked += 1
+		if decision.silent == silent:
+			self.correct += 1
+		elif decision.silent:
+			self.false_silences += 1
+		else:
+			self.missed_silences += 1
+		print(f"[gate] {self.correct / self.checked * 100:.0f}% correct over {self.checked} checked turns, {self.false_silences} false silences, {self.missed_silences} missed silences, {self.skipped} generations skipped")
+
+	def report(self) -> dict:
+		return {
+			"skipped": self.skipped,
+			"checked": self.checked,
+			"correct": self.correct,
+			"false_silences": self.false_silences,
+			"missed_silences": self.missed_silences
+		}
@@ -0,0 +1,56 @@
+import numpy as np
+
+from Orca.utils.AudioCache import AudioCache, AudioCacheConfig
+
+def audio(samples: int, value: float = 0.5) -> np.ndarray:
+	return np.full(samples, value, dtype=np.float32)
+
+def test_keys_ignore_spacing_and_skip_long_clauses():
+	cache = AudioCache(AudioCacheConfig(enabled=True, max_chars=10), "model")
+	assert cache.key("Hi  there") == cache.key(" Hi there ")
+	assert cache.key("Hi there") != AudioCache(AudioCacheConfig(enabled=True), "other voice").key("Hi there")
+	assert cache.key("far too long a clause") is None
+	assert cache.key("   ") is None
+
+def test_memory_lru_evicts_the_least_recently_used():
+	# Room for two 1000 sample clips
+	cache = AudioCache(AudioCacheConfig(enabled=True, memory_mb=8000 / 1024 / 1024), "model")
+	cache.put("a", audio(1000))
+	cache.put("b", audio(1000))
+	assert cache.get("a") is not None
+	cache.put("c", audio(1000))
+
+	assert cache.get("b") is None
+	assert cache.get("a") is not None
+	assert cache.get("c") is not None
+	assert cache.memory_bytes == 8000
+	assert cache.report()["hits"] == 3
+
+def test_cached_audio_is_read_only():
+	cache = AudioCache(AudioCacheConfig(enabled=True), "model")
+	cache.put("a", audio(10))
+	assert not cache.get("a").flags.writeable
+
+def test_disk_tier_survives_a_restart(tmp_path):
+	config = AudioCacheConfig(enabled=True, path=str(tmp_path))
+	first = AudioCache(config, "model")
+	first.put("a", audio(100, 0.25))
+
+	second = AudioCache(config, "model")
+	restored = second.get("a")
+	np.testing.assert_array_equal(restored, audio(100, 0.25))
+	assert second.disk_hits == 1
+
+def test_disk_tier_evicts_the_oldest_files(tmp_path):
+	# Room for two 100 sample files on disk
+	cache = AudioCache(AudioCacheConfig(enabled=True, path=str(tmp_path), disk_mb=800 / 1024 / 1024), "model")
+	for key in ["a", "b", "c"]:
+		cache.put(key, audio(100))
+
+	assert sorted(path.name for path in tmp_path.iterdir()) == ["b.f32", "c.f32"]
+	assert cache.disk_bytes == 800
+
+def test_empty_audio_is_not_stored():
+	cache = AudioCache(AudioCacheConfig(enabled=True), "model")
+	cache.put("a", audio(0))
+	assert cache.get("a") is None
@@ -0,0 +1,32 @@
+from Orca.utils.Compactor import Compactor, CompactorConfig
+from Orca.utils.Context import Context
+
+def conversation(turns: int) -> Context:
+	context = Context("You are Emma.")
+	for i in range(turns):
+		context.push_user(f"question {i}")
+		context.push_assistant(f"answer {i}")
+	return context
+
+def compactor(context: Context, keep_recent: int) -> Compactor:
+	return Compactor(None, None, context, None, CompactorConfig(keep_recent=keep_recent))
+
+def test_range_ends_before_a_user_message():
+	context = conversation(4)
+	start, end = compactor(context, 3)._pick_range()
+	assert (start, end) == (1, 5)
+	assert context.messages[end].role == "user"
+
+def test_keeping_nothing_verbatim_stays_in_bounds():
+	context = conversation(3)
+	start, end = compactor(context, 0)._pick_range()
+	assert (start, end) == (1, 5)
+
+def test_too_short_a_conversation_has_nothing_to_summarize():
+	assert compactor(conversation(1), 8)._pick_range() == (1, 1)
+
+def test_tokens_between_adds_up_the_range():
+	context = conversation(2)
+	total = context.tokens_between(0, len(context.messages))
+	assert total == context.token_total()
+	assert context.tokens_between(1, 3) == total - context.tokens_between(0, 1) - context.tokens_between(3, 5)
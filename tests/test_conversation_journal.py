@@ -0,0 +1,33 @@
+import asyncio
+
+from Orca.utils.Context import Context
+from Orca.utils.ConversationJournal import ConversationJournal
+
+def record(journal: ConversationJournal, count: int) -> Context:
+	async def run():
+		context = Context("You are Emma.")
+		context.attach_journal(journal)
+		for i in range(count):
+			context.push_user(f"message {i}")
+		await journal.close()
+		return context
+
+	return asyncio.run(run())
+
+def test_restore_returns_every_message(tmp_path):
+	context = record(ConversationJournal(tmp_path / "emma.journal", snapshot_every=4), 10)
+	restored = ConversationJournal(tmp_path / "emma.journal").restore()
+	assert [message["content"] for message in restored] == [message.content for message in context.messages]
+
+def test_a_snapshot_is_written_every_snapshot_every_records(tmp_path):
+	journal = ConversationJournal(tmp_path / "emma.journal", snapshot_every=4)
+	record(journal, 10)
+	# The initial snapshot, then one after every 4 added messages
+	assert journal.since_snapshot == 2
+
+def test_the_file_is_rewritten_from_a_snapshot_past_max_bytes(tmp_path):
+	path = tmp_path / "emma.journal"
+	context = record(ConversationJournal(path, snapshot_every=8, max_bytes=512), 200)
+	# Bounded by a snapshot of the whole conversation plus the records after it
+	assert path.stat().st_size < 2 * sum(len(message.json) for message in context.messages) + 2048
+	assert len(ConversationJournal(path).restore()) == 201
@@ -0,0 +1,150 @@
+import asyncio
+
+from Orca.utils.GenerationScheduler import (
+	FUNCTION_GENERATION,
+	SPONTANEOUS_GENERATION,
+	USER_GENERATION,
+	WARM_GENERATION,
+	GenerationScheduler,
+	GenerationSchedulerConfig
+)
+
+async def hold(scheduler: GenerationScheduler, generation_id: str, kind: str, key: str | None = None, held: list | None = None):
+	""" Acquire a slot and keep it until cancelled """
+	ticket = await scheduler.acquire(generation_id, kind, key)
+	if ticket is None:
+		return None
+	if held is not None:
+		held.append(generation_id)
+	try:
+		await asyncio.Event().wait()
+	finally:
+		scheduler.release(ticket)
+
+async def settle():
+	for _ in range(5):
+		await asyncio.sleep(0)
+
+def test_a_kind_that_cannot_queue_is_rejected_while_busy():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig(slots=1))
+		user = asyncio.create_task(hold(scheduler, "u", USER_GENERATION))
+		await settle()
+		rejected = await scheduler.acquire("s", SPONTANEOUS_GENERATION)
+		user.cancel()
+		await asyncio.gather(user, return_exceptions=True)
+		admitted = await scheduler.acquire("s", SPONTANEOUS_GENERATION)
+		return rejected, admitted
+
+	rejected, admitted = asyncio.run(run())
+	assert rejected is None
+	assert admitted is not None
+
+def test_higher_priority_is_dispatched_first():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig(slots=1, preempt=False))
+		held = []
+		first = asyncio.create_task(hold(scheduler, "first", USER_GENERATION, held=held))
+		await settle()
+		function = asyncio.create_task(hold(scheduler, "function", FUNCTION_GENERATION, held=held))
+		user = asyncio.create_task(hold(scheduler, "user", USER_GENERATION, held=held))
+		await settle()
+		first.cancel()
+		await settle()
+		order = list(held)
+		for task in (function, user):
+			task.cancel()
+		await asyncio.gather(first, function, user, return_exceptions=True)
+		return order
+
+	assert asyncio.run(run()) == ["first", "user"]
+
+def test_pin_groups_come_back_to_their_slot():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig(slots=2))
+		user = await scheduler.acquire("u", USER_GENERATION)
+		spontaneous = await scheduler.acquire("s", SPONTANEOUS_GENERATION)
+		slots = (user.slot, spontaneous.slot)
+		scheduler.release(user)
+		scheduler.release(spontaneous)
+
+		again = await scheduler.acquire("s2", SPONTANEOUS_GENERATION)
+		return slots, again.slot
+
+	(user_slot, spontaneous_slot), again = asyncio.run(run())
+	assert user_slot is not spontaneous_slot
+	assert again is spontaneous_slot
+
+def test_a_warm_gives_way_to_a_kind_that_cannot_queue():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig(slots=1))
+		user = await scheduler.acquire("u", USER_GENERATION)
+		scheduler.release(user)
+		warm = asyncio.create_task(hold(scheduler, "w", WARM_GENERATION, "conversation"))
+		await settle()
+		ticket = await asyncio.wait_for(scheduler.acquire("s", SPONTANEOUS_GENERATION), 1)
+		return ticket, warm
+
+	ticket, warm = asyncio.run(run())
+	assert ticket is not None
+	assert warm.cancelled()
+
+def test_a_generation_waits_for_the_warm_in_its_own_slot():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig(slots=2, preempt=False))
+		user = await scheduler.acquire("u", USER_GENERATION)
+		warmed = user.slot
+		scheduler.release(user)
+		warm = asyncio.create_task(hold(scheduler, "w", WARM_GENERATION, "conversation"))
+		await settle()
+		ticket = await asyncio.wait_for(scheduler.acquire("u2", USER_GENERATION), 1)
+		return ticket.slot is warmed, warm
+
+	same_slot, warm = asyncio.run(run())
+	assert same_slot
+	assert warm.cancelled()
+
+def test_warms_are_not_admitted_while_busy():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig(slots=1))
+		user = await scheduler.acquire("u", USER_GENERATION)
+		return await scheduler.acquire("w", WARM_GENERATION, "conversation"), user
+
+	warm, user = asyncio.run(run())
+	assert warm is None
+	assert user.slot is not None
+
+def test_slot_use_is_reported():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig(slots=1))
+		used = []
+		scheduler.on_slot_used(lambda slot, kind: used.append((slot.slot_id, kind)))
+		scheduler.release(await scheduler.acquire("u", USER_GENERATION))
+		scheduler.release(await scheduler.acquire("w", WARM_GENERATION, "conversation"))
+		return used
+
+	assert asyncio.run(run()) == [(0, USER_GENERATION), (0, WARM_GENERATION)]
+
+def test_unpinned_generations_go_to_the_least_busy_backend():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig())
+		scheduler.set_backends({ "a": 2, "b": 2 }, lambda name: True)
+		first = await scheduler.acquire("u", USER_GENERATION)
+		second = await scheduler.acquire("s", SPONTANEOUS_GENERATION)
+		third = await scheduler.acquire("f", FUNCTION_GENERATION, "other")
+		return first.slot.backend, second.slot.backend, third.slot.backend
+
+	first, second, third = asyncio.run(run())
+	assert first != second
+	assert third in ("a", "b")
+
+def test_slots_of_unavailable_backends_are_skipped():
+	async def run():
+		scheduler = GenerationScheduler(GenerationSchedulerConfig())
+		scheduler.set_backends({ "a": 1, "b": 1 }, lambda name: name == "b")
+		ticket = await scheduler.acquire("u", USER_GENERATION)
+		return ticket.slot.backend, ticket.route, await scheduler.acquire("s", SPONTANEOUS_GENERATION)
+
+	backend, route, rejected = asyncio.run(run())
+	assert backend == route == "b"
+	assert rejected is None
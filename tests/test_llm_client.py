@@ -0,0 +1,41 @@
+import asyncio
+
+from Orca.utils.LLM import LLMClient, LLMClientConfig
+
+class FakeContent:
+	def __init__(self, chunks: list[bytes]):
+		self.chunks = chunks
+
+	async def iter_any(self):
+		for chunk in self.chunks:
+			yield chunk
+
+	def at_eof(self) -> bool:
+		return True
+
+class FakeResponse:
+	def __init__(self, chunks: list[bytes]):
+		self.content = FakeContent(chunks)
+
+	def raise_for_status(self):
+		pass
+
+	def release(self):
+		pass
+
+def stream(chunks: list[bytes]) -> tuple[list[str], dict]:
+	async def run():
+		client = LLMClient(LLMClientConfig(spawn_server=False))
+		info = {}
+		tokens = [token async for token in client.get_streaming_response(FakeResponse(chunks), info)]
+		return tokens, info
+
+	return asyncio.run(run())
+
+def test_a_last_event_without_its_blank_line_is_not_lost():
+	tokens, info = stream([
+		b'data: {"choices":[{"finish_reason":null,"index":0,"delta":{"content":"Hi"}}]}\n\n',
+		b'data: {"choices":[{"finish_reason":"stop","index":0,"delta":{}}],"timings":{"predicted_n":1}}'
+	])
+	assert tokens == ["Hi"]
+	assert info == { "finish_reason": "stop", "timings": { "predicted_n": 1 } }
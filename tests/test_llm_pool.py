@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+from Orca.utils.LLM import LLMClientConfig
+from Orca.utils.LLMPool import LLMPool, LLMPoolConfig
+
+def pool(tmp_path, *names: str) -> LLMPool:
+	llm = LLMPool(LLMPoolConfig(drain_timeout=1))
+	for port, name in enumerate(names, 18990):
+		llm.add(name, LLMClientConfig(port=port, spawn_server=False, log_dir=str(tmp_path)))
+	return llm
+
+def test_the_last_backend_cannot_be_drained(tmp_path):
+	llm = pool(tmp_path, "a")
+	with pytest.raises(ValueError):
+		asyncio.run(llm.drain("a"))
+	assert llm.model_name
+
+def test_draining_leaves_the_other_backend(tmp_path):
+	llm = pool(tmp_path, "a", "b")
+	asyncio.run(llm.drain("a"))
+	assert list(llm.backends) == ["b"]
+	assert llm.route("conversation").name == "b"
+
+def test_routing_picks_the_backend_with_the_fewest_outstanding_requests(tmp_path):
+	llm = pool(tmp_path, "a", "b")
+	llm.backends["a"].outstanding = 2
+	assert llm.route("conversation").name == "b"
+	# Sticky from here on
+	llm.backends["a"].outstanding = 0
+	assert llm.route("conversation").name == "b"
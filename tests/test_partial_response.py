@@ -0,0 +1,21 @@
+from Orca.utils.Events import partial_response
+
+# "Hi `fn()` there." streamed as text, a function block, then text again
+RAW = "Hi `fn()` there."
+# (text chars so far, raw end) after each text chunk
+MARKS = [(3, 3), (10, 16)]
+
+def test_cuts_inside_the_last_delivered_chunk():
+	assert partial_response(RAW, MARKS, 2) == "Hi"
+
+def test_keeps_function_blocks_before_the_cut():
+	assert partial_response(RAW, MARKS, 4) == "Hi `fn()` "
+
+def test_everything_delivered_keeps_the_whole_response():
+	assert partial_response(RAW, MARKS, 10) == RAW
+
+def test_nothing_delivered_is_empty():
+	assert partial_response("Hello", [(5, 5)], 0) == ""
+
+def test_without_text_keeps_the_raw_response():
+	assert partial_response("`fn()`", [], 0) == "`fn()`"
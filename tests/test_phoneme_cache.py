@@ -0,0 +1,113 @@
+import json
+import threading
+
+from types import SimpleNamespace
+
+from Orca.utils.PhonemeCache import WORD_PATTERN, PhonemeCache, PhonemeCacheConfig
+
+class FakePipeline:
+	""" G2P that upper-cases words, joined back up the way Kokoro does """
+	lang_code = "a"
+
+	def __init__(self):
+		self.calls = 0
+
+	def g2p(self, text: str):
+		self.calls += 1
+		tokens = []
+		for match in WORD_PATTERN.finditer(text):
+			whitespace = " " if text[match.end():match.end() + 1].isspace() else ""
+			tokens.append(SimpleNamespace(text=match.group(), phonemes=match.group().upper(), whitespace=whitespace))
+		return text, tokens
+
+	def en_tokenize(self, tokens):
+		yield "", "".join(token.phonemes + token.whitespace for token in tokens).strip(), None
+
+def test_clause_hits_skip_g2p():
+	pipeline = FakePipeline()
+	cache = PhonemeCache(PhonemeCacheConfig(enabled=True), pipeline)
+	assert cache.phonemize("Hi there.") == ["HI THERE."]
+	assert cache.phonemize(" Hi  there. ") == ["HI THERE."]
+	assert pipeline.calls == 1
+	assert cache.clause_hits == 1
+
+def test_words_are_reused_after_min_count():
+	pipeline = FakePipeline()
+	cache = PhonemeCache(PhonemeCacheConfig(enabled=True, min_count=2), pipeline)
+	cache.phonemize("hello world")
+	assert cache._from_words("world hello") is None
+	cache.phonemize("hello there world")
+
+	assert cache.phonemize("world hello") == ["WORLD HELLO"]
+	assert cache.word_hits == 1
+	assert pipeline.calls == 2
+
+def test_words_said_two_ways_are_never_reused():
+	cache = PhonemeCache(PhonemeCacheConfig(enabled=True, min_count=1), FakePipeline())
+	cache._learn([SimpleNamespace(text="read", phonemes="RED")])
+	cache._learn([SimpleNamespace(text="read", phonemes="REED")])
+	assert cache.words["read"] == (None, 2)
+	assert cache._from_words("read") is None
+
+def test_lrus_evict_the_least_recently_used():
+	cache = PhonemeCache(PhonemeCacheConfig(enabled=True, clauses=2), FakePipeline())
+	cache.phonemize("a")
+	cache.phonemize("b")
+	cache.phonemize("a")
+	cache.phonemize("c")
+	assert list(cache.clauses) == ["a", "c"]
+
+def test_saved_phonemes_load_after_a_restart(tmp_path):
+	path = tmp_path / "phonemes.json"
+	config = PhonemeCacheConfig(enabled=True, path=str(path))
+	first = PhonemeCache(config, FakePipeline())
+	first.phonemize("Hi there.")
+	first.save()
+
+	pipeline = FakePipeline()
+	second = PhonemeCache(config, pipeline)
+	assert second.phonemize("Hi there.") == ["HI THERE."]
+	assert pipeline.calls == 0
+
+def test_saves_merge_with_other_workers(tmp_path):
+	config = PhonemeCacheConfig(enabled=True, path=str(tmp_path / "phonemes.json"))
+	first = PhonemeCache(config, FakePipeline())
+	second = PhonemeCache(config, FakePipeline())
+	first.phonemize("one")
+	second.phonemize("two")
+	first.save()
+	second.save()
+
+	saved = json.loads((tmp_path / "phonemes.json").read_text(encoding="utf-8"))
+	assert sorted(saved["clauses"]) == ["one", "two"]
+
+def test_another_languages_file_is_ignored(tmp_path):
+	path = tmp_path / "phonemes.json"
+	path.write_text(json.dumps({ "lang": "b", "clauses": { "hi": ["HAI"] }, "words": {} }), encoding="utf-8")
+	cache = PhonemeCache(PhonemeCacheConfig(enabled=True, path=str(path)), FakePipeline())
+	assert not cache.clauses
+
+def test_periodic_saves_do_not_block_phonemize(tmp_path):
+	config = PhonemeCacheConfig(enabled=True, path=str(tmp_path / "phonemes.json"), save_every=1)
+	cache = PhonemeCache(config, FakePipeline())
+	cache.save()
+	writing = threading.Event()
+	release = threading.Event()
+	read = cache._read
+
+	def slow_read():
+		writing.set()
+		release.wait(5)
+		return read()
+
+	cache._read = slow_read
+	cache.phonemize("one")
+	assert writing.wait(5)
+	# The save is stuck on the disk, phonemize carries on
+	assert cache.phonemize("two") == ["TWO"]
+	release.set()
+	cache._saving.join(5)
+	cache.save()
+
+	saved = json.loads((tmp_path / "phonemes.json").read_text(encoding="utf-8"))
+	assert sorted(saved["clauses"]) == ["one", "two"]
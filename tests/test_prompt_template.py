@@ -0,0 +1,34 @@
+from Orca.utils.PromptTemplate import PromptTemplate
+
+def test_renders_like_chained_replace():
+	raw = "Today is <date>, <date> at <time>. <functions>"
+	values = { "<date>": "2026-01-01", "<time>": "03:00 PM", "<functions>": "none" }
+	template = PromptTemplate(raw)
+	template.update(values)
+
+	expected = raw
+	for name, value in values.items():
+		expected = expected.replace(name, value)
+	assert template.render() == expected
+
+def test_without_values_renders_the_raw_prompt():
+	assert PromptTemplate("Hi <name>").render() == "Hi <name>"
+
+def test_update_reports_whether_the_prompt_changed():
+	template = PromptTemplate("It is <time>.")
+	assert template.update({ "<time>": "03:00 PM" })
+	assert not template.update({ "<time>": "03:00 PM" })
+	assert template.update({ "<time>": "03:01 PM" })
+	assert template.render() == "It is 03:01 PM."
+
+def test_values_for_missing_placeholders_change_nothing():
+	template = PromptTemplate("It is <time>.")
+	template.update({ "<time>": "03:00 PM" })
+	assert not template.update({ "<date>": "2026-01-01" })
+	assert not template.update({ "<date>": "2026-01-02" })
+	assert template.render() == "It is 03:00 PM."
+
+def test_longer_placeholder_is_not_split_by_its_prefix():
+	template = PromptTemplate("<time> and <timezone>")
+	template.update({ "<time>": "noon", "<timezone>": "UTC" })
+	assert template.render() == "noon and UTC"
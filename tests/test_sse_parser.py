@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from Orca.utils.SSEParser import SSEParser, parse_event
+
+def token_chunk(content: str) -> bytes:
+	chunk = { "choices": [{ "finish_reason": None, "index": 0, "delta": { "content": content } }], "object": "chat.completion.chunk" }
+	return b"data: " + json.dumps(chunk, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n\n"
+
+FINAL = b'data: {"choices":[{"finish_reason":"stop","index":0,"delta":{}}],"timings":{"prompt_n":5,"predicted_n":3}}\n\n'
+TOKENS = ["Hello", " there", ", \"friend\"", "\n", " caf\u00e9", " \U0001F600", "\\o/"]
+
+def parse_all(stream: bytes, size: int) -> list:
+	parser = SSEParser()
+	events = []
+	for i in range(0, len(stream), size):
+		events.extend(parser.feed(stream[i:i + size]))
+	return events + parser.finalize()
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, 100000])
+def test_chunk_boundaries_do_not_change_the_tokens(size):
+	stream = b"".join(token_chunk(token) for token in TOKENS) + FINAL + b"data: [DONE]\n\n"
+	events = parse_all(stream, size)
+
+	assert [event.content for event in events[:len(TOKENS)]] == TOKENS
+	assert events[len(TOKENS)].finish_reason == "stop"
+	assert events[len(TOKENS)].timings == { "prompt_n": 5, "predicted_n": 3 }
+	assert events[-1].done
+
+def test_crlf_line_endings():
+	events = parse_all(token_chunk("Hi").replace(b"\n", b"\r\n"), 3)
+	assert [event.content for event in events] == ["Hi"]
+
+def test_multi_line_data_is_joined():
+	block = b'data: {"choices":[{"finish_reason":null,\ndata: "index":0,"delta":{"content":"Hi"}}]}\n\n'
+	assert [event.content for event in parse_all(block, 5)] == ["Hi"]
+
+def test_comments_and_other_fields_are_ignored():
+	stream = b": keep-alive\n\nevent: message\nid: 1\n" + token_chunk("Hi")
+	assert [event.content for event in parse_all(stream, 4) if event.content] == ["Hi"]
+
+def test_finalize_dispatches_a_trailing_event():
+	parser = SSEParser()
+	assert parser.feed(token_chunk("Hi")[:-2]) == []
+	assert [event.content for event in parser.finalize()] == ["Hi"]
+
+def test_similar_keys_are_not_mistaken_for_content():
+	event = parse_event(b'{"choices":[{"finish_reason":null,"index":0,"delta":{"reasoning_content":"hmm"}}]}')
+	assert event.content == ""
+	assert event.finish_reason is None
+
+def test_other_key_orders_fall_back_to_a_full_parse():
+	event = parse_event(b'{"choices": [{"delta": {"content": "Hi"}, "finish_reason": "length"}]}')
+	assert event.content == "Hi"
+	assert event.finish_reason == "length"
+
+def test_malformed_chunks_are_skipped():
+	event = parse_event(b'{"choices":[{"delta":{"content": "Hi"')
+	assert event.content == ""
+	assert not event.done
@@ -0,0 +1,65 @@
+import asyncio
+
+from Orca.utils.StopSequences import StopSequences
+
+def feed_all(stops: StopSequences, tokens: list[str]) -> str:
+	return "".join(stops.feed(token) for token in tokens) + stops.flush()
+
+def test_stop_split_across_tokens():
+	stops = StopSequences(["<silence>"])
+	assert feed_all(stops, ["Bye", " <sil", "ence", "> more"]) == "Bye "
+	assert stops.matched == "<silence>"
+
+def test_partial_match_is_held_back_then_released():
+	stops = StopSequences(["<silence>"])
+	assert stops.feed("a <si") == "a "
+	assert stops.feed("p") == "<sip"
+	assert stops.matched is None
+
+def test_text_held_back_at_the_end_is_flushed():
+	stops = StopSequences(["<silence>"])
+	assert feed_all(stops, ["ok <sil"]) == "ok <sil"
+	assert stops.matched is None
+
+def test_earliest_stop_wins():
+	stops = StopSequences(["END", "<silence>"])
+	assert feed_all(stops, ["a <silence> END"]) == "a "
+	assert stops.matched == "<silence>"
+
+def test_nothing_passes_after_a_match():
+	stops = StopSequences(["STOP"])
+	stops.feed("STOP")
+	assert stops.feed("more") == ""
+	assert stops.flush() == ""
+
+def test_empty_and_duplicate_stops_are_dropped():
+	assert StopSequences(["", "a", "a"]).stops == ["a"]
+
+def test_filter_closes_the_stream_on_a_match():
+	closed = []
+
+	async def tokens():
+		try:
+			for token in ["Hi", " <sile", "nce>", " never"]:
+				yield token
+		finally:
+			closed.append(True)
+
+	async def run():
+		stops = StopSequences(["<silence>"])
+		return [item async for item in stops.filter(tokens())], stops.matched
+
+	items, matched = asyncio.run(run())
+	assert items == [("Hi", "Hi"), (" <sile", " "), ("nce>", "")]
+	assert matched == "<silence>"
+	assert closed == [True]
+
+def test_filter_flushes_when_the_stream_ends():
+	async def tokens():
+		for token in ["Hi", None, " <"]:
+			yield token
+
+	async def run():
+		return [item async for item in StopSequences(["<silence>"]).filter(tokens())]
+
+	assert asyncio.run(run()) == [("Hi", "Hi"), (" <", " "), (None, "<")]
@@ -0,0 +1,56 @@
+import asyncio
+
+from types import SimpleNamespace
+
+import pytest
+
+from Orca.utils.StreamOutputHandler import StreamOutputHandler
+
+class FakeSockets:
+	def __init__(self):
+		self.sent = []
+
+	async def broadcast_json_to(self, sockets, payload: dict):
+		self.sent.append(payload)
+
+class FakeJob:
+	def __init__(self, text: str, fail: bool):
+		self.text = text
+		self.fail = fail
+
+	def cancel(self):
+		pass
+
+	async def __aiter__(self):
+		if self.fail:
+			raise RuntimeError("synthesis failed")
+		yield 2400, "audio"
+
+class FakeTTS:
+	sample_rate = 24000
+
+	def __init__(self, failing: set[str]):
+		self.failing = failing
+
+	def submit(self, text: str, transform=None, first: bool = False) -> FakeJob:
+		return FakeJob(text, text in self.failing)
+
+def speak(sentences: list[str], failing: set[str]) -> StreamOutputHandler:
+	async def run():
+		ws = SimpleNamespace(ws=FakeSockets())
+		handler = StreamOutputHandler("gid", ws, FakeTTS(failing), { "audio": ["listener"] })
+		for sentence in sentences:
+			await handler.handle_token(sentence)
+		await handler.finalize()
+		return handler
+
+	return asyncio.run(run())
+
+def test_spoken_sentences_count_as_delivered():
+	handler = speak(["One.", " Two."], set())
+	assert handler.delivered_chars(9) == 9
+	assert handler.speech_length == pytest.approx(0.2)
+
+def test_a_sentence_that_failed_to_synthesize_is_not_delivered():
+	handler = speak(["One.", " Two.", " Three."], { "Two." })
+	assert handler.delivered_chars(16) == len("One.")
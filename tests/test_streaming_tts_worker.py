@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+from Orca.utils.StreamingTTSWorker import StreamingTTSWorker
+
+class SlowTTS:
+	sample_rate = 24000
+
+	def __init__(self):
+		self.synthesizing = False
+		self.saved_while_synthesizing = None
+
+	def text_to_audio(self, text: str):
+		self.synthesizing = True
+		try:
+			for i in range(100):
+				time.sleep(0.01)
+				yield i
+		finally:
+			self.synthesizing = False
+
+	def close(self):
+		self.saved_while_synthesizing = self.synthesizing
+
+def test_close_saves_after_the_synthesis_in_progress_stopped():
+	async def run():
+		tts = SlowTTS()
+		worker = StreamingTTSWorker(tts)
+		worker.submit("One.")
+		worker.submit("Two.")
+		await asyncio.sleep(0.05)
+		started = time.perf_counter()
+		worker.close()
+		return tts, time.perf_counter() - started
+
+	tts, took = asyncio.run(run())
+	assert tts.saved_while_synthesizing is False
+	# The running job is cancelled rather than finished
+	assert took < 0.5
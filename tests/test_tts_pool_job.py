@@ -0,0 +1,86 @@
+import asyncio
+import queue
+import threading
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from Orca.utils.TTSPool import TTSPool, TTSPoolJob
+
+async def collect(job: TTSPoolJob) -> list:
+	return [chunk async for chunk in job]
+
+def test_clauses_come_back_in_order_whatever_finishes_first():
+	async def run():
+		job = TTSPoolJob(3)
+		reader = asyncio.create_task(collect(job))
+		job._push(2, "c1")
+		job._finish(2)
+		job._push(1, "b1")
+		await asyncio.sleep(0)
+		job._push(0, "a1")
+		job._push(0, "a2")
+		await asyncio.sleep(0)
+		job._finish(0)
+		job._push(1, "b2")
+		job._finish(1)
+		return await reader
+
+	assert asyncio.run(run()) == ["a1", "a2", "b1", "b2", "c1"]
+
+def test_chunks_stream_before_their_clause_finishes():
+	async def run():
+		job = TTSPoolJob(1)
+		iterator = aiter(job)
+		job._push(0, "a1")
+		first = await anext(iterator)
+		job._finish(0)
+		return first, [chunk async for chunk in iterator]
+
+	assert asyncio.run(run()) == ("a1", [])
+
+def test_a_failed_clause_raises_after_its_chunks():
+	async def run():
+		job = TTSPoolJob(2)
+		job._push(0, "a1")
+		job._finish(0, RuntimeError("worker died"))
+		job._push(1, "b1")
+		job._finish(1)
+		received = []
+		with pytest.raises(RuntimeError, match="worker died"):
+			async for chunk in job:
+				received.append(chunk)
+		return received
+
+	assert asyncio.run(run()) == ["a1"]
+
+class DrainOnlyOutbox:
+	""" Blocking reads time out, so the messages are only ever seen by the dead worker drain """
+	def __init__(self, messages: list):
+		self.messages = messages
+
+	def get(self, timeout: float):
+		time.sleep(timeout)
+		raise queue.Empty
+
+	def get_nowait(self):
+		if not self.messages:
+			raise queue.Empty
+		return self.messages.pop(0)
+
+def test_reader_stops_when_the_close_sentinel_is_drained_with_a_dead_worker():
+	forwarded = []
+	pool = TTSPool.__new__(TTSPool)
+	pool._outbox = DrainOnlyOutbox([("chunk", 0, "a1"), None])
+	pool._processes = [SimpleNamespace(is_alive=lambda: False, exitcode=-9)]
+	pool._dead = set()
+	pool._forward = forwarded.append
+
+	reader = threading.Thread(target=pool._read, daemon=True)
+	reader.start()
+	reader.join(timeout=3)
+
+	assert not reader.is_alive()
+	assert forwarded == [("chunk", 0, "a1"), ("died", 0, -9)]
@@ -0,0 +1,71 @@
+import asyncio
+
+from types import SimpleNamespace
+
+import pytest
+
+from Orca.utils.TurnGate import TurnGate, TurnGateConfig
+
+# "<" starts both "<silence>" and "<thinking>", like it does in most vocabularies
+VOCAB = { "<": 1, "silence": 2, ">": 3, "thinking": 4, "`": 5, "Hi": 6 }
+
+class FakeLLM:
+	def __init__(self, probs: dict[str, dict[int, float]]):
+		# prefill -> token id -> probability
+		self.probs = probs
+		self.prefills = []
+
+	async def tokenize(self, text: str) -> list[int]:
+		ids = []
+		while text:
+			piece = max((piece for piece in VOCAB if text.startswith(piece)), key=len, default=None)
+			if piece is None:
+				return ids + [0]
+			ids.append(VOCAB[piece])
+			text = text[len(piece):]
+		return ids
+
+	async def next_token_probs(self, prompt: bytes, top_n: int, id_slot: int = -1, prefill: str = "", key: str | None = None) -> dict[int, float]:
+		self.prefills.append(prefill)
+		return self.probs.get(prefill, {})
+
+def gate(probs: dict[str, dict[int, float]] | None = None, **config) -> TurnGate:
+	return TurnGate(FakeLLM(probs or {}), "<silence>", TurnGateConfig(enabled=True, audit_rate=0.0, **config), others=["<thinking>", "`"])
+
+def p_silence(turn_gate: TurnGate) -> float:
+	return asyncio.run(turn_gate._p_silence(b"[]", SimpleNamespace(slot_id=0, route="conversation")))
+
+def test_shared_tokens_are_probed_past():
+	turn_gate = gate({ "": { 1: 0.9, 6: 0.1 }, "<": { 2: 0.8, 4: 0.2 } }, threshold=0.5)
+	assert p_silence(turn_gate) == pytest.approx(0.72)
+	assert turn_gate.llm.prefills == ["", "<"]
+	assert turn_gate._path == [("", 1), ("<", 2)]
+
+def test_a_likely_delimiter_is_not_silence():
+	turn_gate = gate({ "": { 1: 0.9 }, "<": { 2: 0.1, 4: 0.9 } })
+	assert p_silence(turn_gate) == pytest.approx(0.09)
+
+def test_unlikely_first_tokens_skip_the_second_probe():
+	turn_gate = gate({ "": { 1: 0.3, 6: 0.7 } }, threshold=0.6)
+	assert p_silence(turn_gate) == pytest.approx(0.3)
+	assert turn_gate.llm.prefills == [""]
+
+def test_a_silence_token_spelled_by_another_delimiter_never_counts():
+	turn_gate = TurnGate(FakeLLM({ "": { 1: 1.0 } }), "<", TurnGateConfig(enabled=True), others=["<thinking>"])
+	assert p_silence(turn_gate) == 0.0
+	assert turn_gate._path == []
+
+def test_unknown_mode_is_rejected():
+	with pytest.raises(ValueError):
+		gate(mode="guess")
+
+@pytest.mark.parametrize("probs, silent", [
+	({ "": { 1: 1.0 }, "<": { 2: 0.7, 6: 0.3 } }, True),
+	({ "": { 1: 1.0 }, "<": { 2: 0.5, 6: 0.5 } }, False)
+])
+def test_check_compares_with_the_threshold(probs, silent):
+	turn_gate = gate(probs, threshold=0.6)
+	decision = asyncio.run(turn_gate.check(b"[]", SimpleNamespace(slot_id=0, route="conversation")))
+	assert decision.silent is silent
+	assert not decision.audited
+	assert turn_gate.skipped == int(silent)